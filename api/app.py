@@ -1,12 +1,27 @@
-from fastapi import FastAPI, Form, UploadFile, File
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, Form, Request, UploadFile, File
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-import os, requests, smtplib, mimetypes, base64, json
-from typing import List, Optional
+import os, re, mimetypes, base64, json, asyncio, time, math, hashlib, hmac, smtplib
+from typing import AsyncIterator, BinaryIO, List, Optional, Union
 from email.message import EmailMessage
 from dotenv import load_dotenv
 import sys
+from contextlib import asynccontextmanager
 from pathlib import Path
+from smtp_pool import SMTPPool, describe_refused
+from mail_queue import MailQueue
+from llm_client import AzureConfig, AzureOpenAIClient, CohereClient, CohereConfig, http_status
+from providers import AzureProvider, CohereProvider, MockProvider, ProviderRouter
+from generation_cache import GenerationCache, cache_key
+from similar_drafts import Match, SimilarDrafts, estimate_tokens
+from attachment_optimizer import optimize as optimize_attachment, pillow_installed
+from functools import partial
+from concurrency import AdaptiveLimiter, Overloaded, SingleFlight, current_client
+from rate_limit import RateLimiter
+from metrics import (ATTACHMENT_BYTES, CACHE_LOOKUPS, RATE_LIMITED, REQUEST_SECONDS, SIMILAR_LOOKUPS,
+                     SIMILAR_TOKENS, STAGE_SECONDS)
+from lazy_metrics import render as render_metrics
+from starlette.background import BackgroundTask
 
 # Get the project root directory (one level up from current directory)
 ROOT_DIR = Path(__file__).resolve().parent.parent
@@ -14,9 +29,147 @@ ENV_PATH = os.path.join(ROOT_DIR, '.env')
 
 # Load environment variables from the root .env file
 load_dotenv(ENV_PATH)
-print(f"Loading .env from: {ENV_PATH}")
 
-app = FastAPI(title="Email Generator & Sender")
+# Local state (mail spool, caches) lives here
+DATA_DIR = Path(os.getenv("DATA_DIR", ROOT_DIR / "data"))
+
+smtp_pool: Optional[SMTPPool] = None
+
+def get_smtp_pool() -> SMTPPool:
+    # Created on first send so a missing GMAIL_* config doesn't break startup
+    global smtp_pool
+    if smtp_pool is None:
+        smtp_pool = SMTPPool(
+            os.getenv("SMTP_HOST", "smtp.gmail.com"),
+            int(os.getenv("SMTP_PORT", "465")),
+            GMAIL_USER, GMAIL_PASS,
+            size=int(os.getenv("SMTP_POOL_SIZE", "4")),
+            timeout=float(os.getenv("SMTP_TIMEOUT", "30")),
+            max_idle=float(os.getenv("SMTP_MAX_IDLE", "240")),
+            use_ssl=os.getenv("SMTP_USE_SSL", "true").lower() == "true",
+        )
+    return smtp_pool
+
+async def _pooled_send(msg):
+    return await get_smtp_pool().send(msg)
+
+mail_queue = MailQueue(
+    Path(os.getenv("MAIL_QUEUE_PATH", DATA_DIR / "mail_queue.sqlite3")),
+    _pooled_send,
+    workers=int(os.getenv("MAIL_QUEUE_WORKERS", "2")),
+    max_attempts=int(os.getenv("MAIL_QUEUE_MAX_ATTEMPTS", "5")),
+    backoff_base=float(os.getenv("MAIL_QUEUE_BACKOFF", "2")),
+    backoff_max=float(os.getenv("MAIL_QUEUE_BACKOFF_MAX", "300")),
+    lease=float(os.getenv("MAIL_QUEUE_LEASE", "300")),
+)
+
+# Read once at startup rather than on every request
+azure_config = AzureConfig.from_env()
+cohere_config = CohereConfig.from_env()
+# Generation providers in order of preference; unconfigured ones are skipped
+LLM_PROVIDERS = [p.strip().lower() for p in os.getenv("LLM_PROVIDERS", "azure,cohere").split(",") if p.strip()]
+router: Optional[ProviderRouter] = None
+
+generation_cache = GenerationCache(
+    max_entries=int(os.getenv("GENERATION_CACHE_SIZE", "1024")),
+    ttl=float(os.getenv("GENERATION_CACHE_TTL", "3600")),
+    disk_path=(Path(os.getenv("GENERATION_CACHE_PATH", DATA_DIR / "generation_cache.sqlite3"))
+               if os.getenv("GENERATION_CACHE_DISK", "false").lower() == "true" else None),
+    disk_max_entries=int(os.getenv("GENERATION_CACHE_DISK_SIZE", "10240")),
+)
+
+# Near-duplicate topics (same role, tone and temperature) reuse or revise an earlier draft
+similar_drafts = SimilarDrafts(
+    mode=os.getenv("SIMILAR_DRAFTS", "off").lower(),
+    threshold=float(os.getenv("SIMILAR_DRAFTS_THRESHOLD", "0.75")),
+    max_entries=int(os.getenv("SIMILAR_DRAFTS_SIZE", "2000")),
+    ttl=float(os.getenv("SIMILAR_DRAFTS_TTL", "86400")),
+)
+
+def parse_weights(raw: str) -> dict:
+    # "tg:42=3,key:1a2b3c=2" -> {"tg:42": 3, "key:1a2b3c": 2}: turns per round in the Azure queue
+    weights = {}
+    for item in filter(None, (p.strip() for p in raw.split(","))):
+        client, _, weight = item.rpartition("=")
+        weights[client.strip()] = max(1, int(weight))
+    return weights
+
+# Identical in-flight prompts share one completion; all completions share the Azure quota
+inflight = SingleFlight()
+azure_limiter = AdaptiveLimiter(
+    initial=int(os.getenv("AZURE_CONCURRENCY", "8")),
+    max_limit=int(os.getenv("AZURE_MAX_CONCURRENCY", "32")),
+    max_queue=int(os.getenv("AZURE_QUEUE_SIZE", "100")),
+    max_wait=float(os.getenv("AZURE_QUEUE_TIMEOUT", "10")),
+    tokens_per_minute=int(os.getenv("AZURE_TOKENS_PER_MINUTE", "0")),
+    weights=parse_weights(os.getenv("FAIR_WEIGHTS", "")),
+)
+# Cohere gets its own slots, queued with the same per-client round-robin
+cohere_limiter = AdaptiveLimiter(
+    initial=int(os.getenv("COHERE_CONCURRENCY", "8")),
+    max_limit=int(os.getenv("COHERE_MAX_CONCURRENCY", "32")),
+    max_queue=int(os.getenv("COHERE_QUEUE_SIZE", "100")),
+    max_wait=float(os.getenv("COHERE_QUEUE_TIMEOUT", "10")),
+    weights=parse_weights(os.getenv("FAIR_WEIGHTS", "")),
+)
+
+# Per-client token buckets (requests per minute, 0 = unlimited). Batches cost one
+# token per variant or recipient.
+generate_limits = RateLimiter(float(os.getenv("RATE_LIMIT_GENERATE", "0")),
+                              float(os.getenv("RATE_LIMIT_GENERATE_BURST", "10")))
+send_limits = RateLimiter(float(os.getenv("RATE_LIMIT_SEND", "0")),
+                          float(os.getenv("RATE_LIMIT_SEND_BURST", "10")))
+
+def build_router() -> ProviderRouter:
+    providers = []
+    for name in LLM_PROVIDERS:
+        if name == "azure" and azure_config.configured:
+            providers.append(AzureProvider(AzureOpenAIClient.from_env(azure_config), azure_limiter))
+        elif name == "cohere" and cohere_config.configured:
+            providers.append(CohereProvider(CohereClient.from_env(cohere_config), cohere_limiter))
+        elif name == "mock":
+            providers.append(MockProvider(latency=float(os.getenv("MOCK_PROVIDER_LATENCY", "0.05")),
+                                          failure_rate=float(os.getenv("MOCK_PROVIDER_FAILURE_RATE", "0"))))
+    return ProviderRouter(
+        providers,
+        hedge_percentile=float(os.getenv("HEDGE_PERCENTILE", "0.95")),
+        hedge_initial_delay=float(os.getenv("HEDGE_INITIAL_DELAY", "8")),
+        hedge_min_delay=float(os.getenv("HEDGE_MIN_DELAY", "0.5")),
+        hedge_max_delay=float(os.getenv("HEDGE_MAX_DELAY", "20")),
+        window=int(os.getenv("HEDGE_WINDOW", "200")),
+        breaker_failures=int(os.getenv("CIRCUIT_FAILURES", "5")),
+        breaker_reset=float(os.getenv("CIRCUIT_RESET", "30")),
+    )
+
+# Optional attachment optimization (downscale/recompress/zip + base64) in worker processes
+ATTACHMENT_OPTIMIZE = os.getenv("ATTACHMENT_OPTIMIZE", "false").lower() == "true"
+attachment_workers = None
+
+def get_attachment_workers():
+    # multiprocessing is only imported once someone asks for optimization
+    global attachment_workers
+    if attachment_workers is None:
+        from concurrent.futures import ProcessPoolExecutor
+        attachment_workers = ProcessPoolExecutor(max_workers=int(os.getenv("ATTACHMENT_WORKERS", "2")))
+    return attachment_workers
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global router
+    router = build_router()
+    if not pillow_installed():
+        print("Pillow is not installed: image attachments are sent without resizing or recompression")
+    await mail_queue.start()
+    yield
+    await mail_queue.stop()
+    await router.aclose()
+    generation_cache.close()
+    if smtp_pool is not None:
+        smtp_pool.close()
+    if attachment_workers is not None:
+        attachment_workers.shutdown(wait=False, cancel_futures=True)
+
+app = FastAPI(title="Email Generator & Sender", lifespan=lifespan)
 
 # CORS (optional, helpful during local dev)
 app.add_middleware(
@@ -25,26 +178,73 @@ app.add_middleware(
     allow_methods=["*"], allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def record_latency(request: Request, call_next):
+    started = time.perf_counter()
+    response = await call_next(request)
+    elapsed = time.perf_counter() - started
+    # Label by route template (/jobs/{job_id}), not the raw path, to keep cardinality bounded
+    route = getattr(request.scope.get("route"), "path", "unmatched")
+    # Recorded once the response is out, so the first request after a cold start
+    # doesn't wait for prometheus_client to load
+    response.background = BackgroundTask(_observe_request, response.background, request.method, route,
+                                         str(response.status_code), elapsed)
+    return response
+
+async def _observe_request(previous: Optional[BackgroundTask], method: str, route: str, status: str,
+                           elapsed: float):
+    if previous is not None:
+        await previous()
+    REQUEST_SECONDS.labels(method, route, status).observe(elapsed)
+
+# X-Client-Id is only believed from callers that also send the shared
+# CLIENT_ID_SECRET (the bot); API keys only count if they are listed in API_KEYS.
+# Anything else is keyed on the peer address, so a caller can't get a fresh
+# bucket and the front of the queue by making up a new id per request.
+CLIENT_ID_SECRET = os.getenv("CLIENT_ID_SECRET", "")
+API_KEYS = {k.strip() for k in os.getenv("API_KEYS", "").split(",") if k.strip()}
+
+def _trusted_id(request: Request) -> bool:
+    return bool(CLIENT_ID_SECRET) and hmac.compare_digest(
+        request.headers.get("x-client-secret", "").encode(), CLIENT_ID_SECRET.encode())
+
+@app.middleware("http")
+async def identify_client(request: Request, call_next):
+    # Who a request counts against for rate limits and fair queueing
+    client = request.headers.get("x-client-id")
+    api_key = request.headers.get("x-api-key")
+    if client and _trusted_id(request):
+        client = client[:64]
+    elif api_key and api_key in API_KEYS:
+        client = "key:" + hashlib.sha256(api_key.encode()).hexdigest()[:12]
+    else:
+        client = "ip:" + (request.client.host if request.client else "unknown")
+    current_client.set(client)
+    return await call_next(request)
+
 # Get environment variables
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 COHERE_API_KEY = os.getenv("COHERE_API_KEY")
 
-# Extract Google credentials from base64
-google_credentials = None
-token_json = None
-if os.getenv("GOOGLE_CREDENTIALS_BASE64"):
-    try:
-        decoded_credentials = base64.b64decode(os.getenv("GOOGLE_CREDENTIALS_BASE64")).decode('utf-8')
-        google_credentials = json.loads(decoded_credentials)
-    except Exception as e:
-        print(f"Error decoding Google credentials: {e}")
+# Google credentials from base64, decoded on first use (nothing sends through the
+# Gmail API yet; /health only reports whether they parse)
+_decoded: dict = {}
 
-if os.getenv("TOKEN_JSON_BASE64"):
-    try:
-        decoded_token = base64.b64decode(os.getenv("TOKEN_JSON_BASE64")).decode('utf-8')
-        token_json = json.loads(decoded_token)
-    except Exception as e:
-        print(f"Error decoding token JSON: {e}")
+def _base64_json(var: str) -> Optional[dict]:
+    if var not in _decoded:
+        _decoded[var] = None
+        if os.getenv(var):
+            try:
+                _decoded[var] = json.loads(base64.b64decode(os.getenv(var)).decode('utf-8'))
+            except Exception as e:
+                print(f"Error decoding {var}: {e}")
+    return _decoded[var]
+
+def google_credentials() -> Optional[dict]:
+    return _base64_json("GOOGLE_CREDENTIALS_BASE64")
+
+def token_json() -> Optional[dict]:
+    return _base64_json("TOKEN_JSON_BASE64")
 
 # Set Gmail credentials - need to add these to your .env file
 GMAIL_USER = os.getenv("GMAIL_USER")
@@ -52,41 +252,76 @@ GMAIL_PASS = os.getenv("GMAIL_PASS")
 
 @app.get("/")
 def root():
-    return {"ok": True, "service": "email-api", "endpoints": ["/generate-email", "/send-email"]}
+    return {"ok": True, "service": "email-api", "endpoints": ["/generate-email", "/generate-email/stream", "/generate-batch", "/send-email", "/send-batch", "/jobs/{job_id}", "/metrics"]}
+
+@app.get("/metrics")
+def metrics():
+    body, content_type = render_metrics()
+    return Response(body, media_type=content_type)
 
 @app.get("/health")
 def health():
     env_status = {
         "TELEGRAM_TOKEN": bool(TELEGRAM_TOKEN),
         "COHERE_API_KEY": bool(COHERE_API_KEY),
-        "GMAIL_CREDENTIALS": bool(google_credentials),
-        "GMAIL_TOKEN": bool(token_json),
+        "GMAIL_CREDENTIALS": bool(google_credentials()),
+        "GMAIL_TOKEN": bool(token_json()),
         "GMAIL_USER": bool(GMAIL_USER),
         "GMAIL_PASS": bool(GMAIL_PASS),
     }
-    return {"status": "ok", "environment": env_status}
+    return {
+        "status": "ok",
+        "environment": env_status,
+        "mail_queue": mail_queue.counts(),
+        # Created on the first send
+        "smtp_pool": smtp_pool.snapshot() if smtp_pool is not None else None,
+        "generation_cache": generation_cache.stats(),
+        "similar_drafts": similar_drafts.stats(),
+        "azure_limiter": {**azure_limiter.snapshot(), "coalesced": inflight.coalesced},
+        "cohere_limiter": cohere_limiter.snapshot(),
+        "providers": router.snapshot() if router is not None else None,
+        "rate_limits": {"generate": generate_limits.snapshot(), "send": send_limits.snapshot()},
+    }
 
 def _auto_subject(topic: str, tone: str) -> str:
     return f"Regarding: {topic}" if tone.lower() == "formal" else f"Let's talk about {topic}"
 
-@app.post("/generate-email")
-def generate_email(
-    role: str = Form(...),
-    tone: str = Form(...),
-    topic: str = Form(...),
-    subject: str = Form("auto"),
-    name: str = Form(""),
-    position: str = Form(""),
-    recipient_name: str = Form("Dear Sir/Madam")
-):
-    # Check for Azure OpenAI credentials
-    azure_key = os.getenv("AZURE_OPENAI_KEY")
-    azure_endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
-    azure_deployment = os.getenv("AZURE_OPENAI_DEPLOYMENT")
-    azure_api_version = os.getenv("AZURE_API_VERSION", "2023-05-15")
-    
-    if not (azure_key and azure_endpoint and azure_deployment):
-        return JSONResponse(status_code=500, content={"error": "Missing Azure OpenAI credentials"})
+class ApiError(Exception):
+    def __init__(self, status_code: int, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+    def response(self) -> JSONResponse:
+        headers = {"Retry-After": str(max(1, round(self.retry_after)))} if self.retry_after else None
+        return JSONResponse(status_code=self.status_code, content={"error": str(self)}, headers=headers)
+
+def _throttle(limits: RateLimiter, kind: str, cost: int = 1):
+    wait = limits.take(current_client.get(), cost)
+    if wait:
+        RATE_LIMITED.labels(kind).inc()
+        raise ApiError(429, f"Too many {kind} requests, try again in {math.ceil(wait)}s", retry_after=wait)
+
+def _generation_configured() -> bool:
+    return router is not None and router.configured
+
+async def _complete(messages: List[dict], key: str, temperature: Optional[float] = None,
+                    max_tokens: Optional[int] = None) -> str:
+    try:
+        return await inflight.do(key, lambda: router.complete(messages, temperature, max_tokens))
+    except Overloaded as e:
+        raise ApiError(503, str(e), retry_after=e.retry_after)
+    except Exception as e:
+        if http_status(e) is None:
+            raise
+        raise ApiError(502, f"Generation provider returned {http_status(e)}")
+
+def _prepare(role: str, tone: str, topic: str, subject: str, name: str, position: str, recipient_name: str,
+             temperature: Optional[float] = None):
+    fields = {"role": role, "tone": tone, "topic": topic, "subject": subject, "name": name,
+              "position": position, "recipient_name": recipient_name}
+    key = cache_key(fields, azure_config.deployment,
+                    azure_config.temperature if temperature is None else temperature)
 
     subject_final = _auto_subject(topic, tone) if subject.strip().lower() == "auto" else subject.strip()
     
@@ -95,68 +330,494 @@ def generate_email(
 Address it to "{recipient_name}". 
 Subject: "{subject_final}"."""
 
-    try:
-        # Azure OpenAI API call
-        headers = {
-            "api-key": azure_key,
-            "Content-Type": "application/json"
-        }
-        
-        body = {
-            "messages": [
-                {"role": "system", "content": "You are a professional email assistant."},
-                {"role": "user", "content": prompt}
-            ],
-            "temperature": 0.7,
-            "max_tokens": 800
-        }
-        
-        # Format Azure OpenAI URL
-        url = f"{azure_endpoint}openai/deployments/{azure_deployment}/chat/completions?api-version={azure_api_version}"
-        
-        r = requests.post(url, headers=headers, json=body, timeout=30)
-        r.raise_for_status()
-        data = r.json()
-        
-        # Extract text from Azure OpenAI response
-        text = data.get("choices", [{}])[0].get("message", {}).get("content", "").strip()
-        
+    messages = [
+        {"role": "system", "content": "You are a professional email assistant."},
+        {"role": "user", "content": prompt}
+    ]
+    fields["temperature"] = azure_config.temperature if temperature is None else temperature
+    return subject_final, messages, key, fields
+
+def _find_similar(fields: dict, use_cache: bool) -> Optional[Match]:
+    if not (similar_drafts.enabled and use_cache):
+        return None
+    match = similar_drafts.lookup(fields)
+    SIMILAR_LOOKUPS.labels("miss" if match is None else "reuse" if match.reusable else "revise").inc()
+    return match
+
+def _revision(fields: dict, subject_final: str, match: Match):
+    # A close draft for someone else: ask for a rewrite, capped near the old draft's length
+    prompt = f"""Here is a {fields["tone"]} email about: {match.topic}.
+Rewrite it to be about: {fields["topic"]}, from a {fields["role"]} named {fields["name"]} ({fields["position"]}), addressed to "{fields["recipient_name"]}", subject "{subject_final}".
+Keep the structure and change only what is needed. Reply with the email only.
+
+{match.draft["email"]}"""
+    messages = [
+        {"role": "system", "content": "You are a professional email assistant."},
+        {"role": "user", "content": prompt}
+    ]
+    return messages, min(azure_config.max_tokens, estimate_tokens(match.draft["email"]) * 5 // 4 + 32)
+
+def _count_similar(fresh: List[dict], match: Match, revision: Optional[List[dict]] = None, text: str = ""):
+    # Estimated tokens a fresh generation would have used, minus what the revision did use
+    avoided = sum(estimate_tokens(m["content"]) for m in fresh) + estimate_tokens(match.draft["email"])
+    spent = sum(estimate_tokens(m["content"]) for m in revision) + estimate_tokens(text) if revision else 0
+    SIMILAR_TOKENS.labels("avoided").inc(avoided)
+    SIMILAR_TOKENS.labels("spent").inc(spent)
+    similar_drafts.record(revision is not None, avoided - spent)
+
+async def generate_draft(role: str, tone: str, topic: str, subject: str = "auto", name: str = "",
+                         position: str = "", recipient_name: str = "Dear Sir/Madam",
+                         use_cache: bool = True, temperature: Optional[float] = None) -> dict:
+    if not _generation_configured():
+        raise ApiError(500, "Missing Azure OpenAI or Cohere credentials")
+
+    with STAGE_SECONDS.labels("prompt_build").time():
+        subject_final, messages, key, fields = _prepare(role, tone, topic, subject, name, position,
+                                                        recipient_name, temperature)
+    if generation_cache.enabled and use_cache:
+        # A bypassed request skips the lookup but still refreshes the entry
+        cached = await generation_cache.get(key)
+        CACHE_LOOKUPS.labels("miss" if cached is None else "hit").inc()
+        if cached is not None:
+            return cached
+
+    match = _find_similar(fields, use_cache)
+    if match is not None and match.reusable:
+        result = {"subject": subject_final, "email": match.draft["email"]}
+        _count_similar(messages, match)
+    else:
+        revision, max_tokens = _revision(fields, subject_final, match) if match else (None, None)
+        text = (await _complete(revision or messages, key, temperature, max_tokens)).strip()
         if not text:
-            return JSONResponse(status_code=502, content={"error": "Empty response from Azure OpenAI"})
-        return {"subject": subject_final, "email": text}
+            raise ApiError(502, "Empty response from the generation provider")
+        result = {"subject": subject_final, "email": text}
+        if match is not None:
+            _count_similar(messages, match, revision, text)
+        if similar_drafts.enabled:
+            similar_drafts.add(key, fields, result)
+    if generation_cache.enabled:
+        await generation_cache.set(key, result)
+    return result
+
+async def stream_draft(role: str, tone: str, topic: str, subject: str = "auto", name: str = "",
+                       position: str = "", recipient_name: str = "Dear Sir/Madam",
+                       use_cache: bool = True) -> AsyncIterator[tuple]:
+    # Yields ("meta", {subject}), then ("delta", {text}) chunks, then ("done", {subject, email})
+    if not _generation_configured():
+        raise ApiError(500, "Missing Azure OpenAI or Cohere credentials")
+
+    with STAGE_SECONDS.labels("prompt_build").time():
+        subject_final, messages, key, fields = _prepare(role, tone, topic, subject, name, position,
+                                                        recipient_name)
+    yield "meta", {"subject": subject_final}
+    cached = None
+    if generation_cache.enabled and use_cache:
+        cached = await generation_cache.get(key)
+        CACHE_LOOKUPS.labels("miss" if cached is None else "hit").inc()
+    match = _find_similar(fields, use_cache) if cached is None else None
+    if match is not None and match.reusable:
+        cached = {"subject": subject_final, "email": match.draft["email"]}
+        _count_similar(messages, match)
+        if generation_cache.enabled:
+            await generation_cache.set(key, cached)
+    if cached is not None:
+        yield "delta", {"text": cached["email"]}
+        yield "done", cached
+        return
+
+    revision, max_tokens = _revision(fields, subject_final, match) if match else (None, None)
+    chunks = []
+    try:
+        async for delta in router.stream(revision or messages, max_tokens=max_tokens):
+            chunks.append(delta)
+            yield "delta", {"text": delta}
+    except Overloaded as e:
+        raise ApiError(503, str(e), retry_after=e.retry_after)
+    except Exception as e:
+        if http_status(e) is None:
+            raise
+        raise ApiError(502, f"Generation provider returned {http_status(e)}")
+
+    text = "".join(chunks).strip()
+    if not text:
+        raise ApiError(502, "Empty response from the generation provider")
+    result = {"subject": subject_final, "email": text}
+    if match is not None:
+        _count_similar(messages, match, revision, text)
+    if similar_drafts.enabled:
+        similar_drafts.add(key, fields, result)
+    if generation_cache.enabled:
+        await generation_cache.set(key, result)
+    yield "done", result
+
+@app.post("/generate-email")
+async def generate_email(
+    role: str = Form(...),
+    tone: str = Form(...),
+    topic: str = Form(...),
+    subject: str = Form("auto"),
+    name: str = Form(""),
+    position: str = Form(""),
+    recipient_name: str = Form("Dear Sir/Madam"),
+    no_cache: bool = Form(False)
+):
+    try:
+        _throttle(generate_limits, "generation")
+        return await generate_draft(role, tone, topic, subject, name, position, recipient_name,
+                                    use_cache=not no_cache)
+    except ApiError as e:
+        return e.response()
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": str(e)})
 
+# Per-variant overrides accepted by /generate-batch
+VARIANT_FIELDS = {"tone", "subject", "recipient_name", "temperature"}
+MAX_VARIANTS = int(os.getenv("MAX_VARIANTS", "6"))
+
+def parse_variants(raw: str) -> List[dict]:
+    # raw is a JSON list of override objects, e.g. [{"tone": "formal"}, {"tone": "casual", "temperature": 1}]
+    variants = json.loads(raw)
+    if not isinstance(variants, list) or not variants:
+        raise ValueError("expected a non-empty JSON list")
+    if len(variants) > MAX_VARIANTS:
+        raise ValueError(f"at most {MAX_VARIANTS} variants per request")
+    for v in variants:
+        if not isinstance(v, dict):
+            raise ValueError("each variant must be an object")
+        unknown = set(v) - VARIANT_FIELDS
+        if unknown:
+            raise ValueError(f"unsupported field(s): {', '.join(sorted(unknown))}")
+        if any(not isinstance(value, str) for key, value in v.items() if key != "temperature"):
+            raise ValueError("tone, subject and recipient_name must be strings")
+        if "temperature" in v:
+            v["temperature"] = min(2.0, max(0.0, float(v["temperature"])))
+    return variants
+
+async def generate_variants(base: dict, variants: List[dict], use_cache: bool = True,
+                            ordered: bool = False) -> AsyncIterator[dict]:
+    # Fans the variants out at once; they go through the same providers and Azure
+    # limiter as every other request, so a batch can't take more than its share. Yields {"index", "variant",
+    # "subject", "email"} (or "error"/"status") per variant as each one completes, or
+    # strictly by index when ordered.
+    async def one(index: int, overrides: dict) -> dict:
+        try:
+            draft = await generate_draft(**{**base, **overrides}, use_cache=use_cache)
+            return {"index": index, "variant": overrides, **draft}
+        except ApiError as e:
+            return {"index": index, "variant": overrides, "error": str(e), "status": e.status_code}
+        except Exception as e:
+            return {"index": index, "variant": overrides, "error": str(e), "status": 500}
+
+    tasks = [asyncio.ensure_future(one(i, v)) for i, v in enumerate(variants)]
+    try:
+        for next_done in (tasks if ordered else asyncio.as_completed(tasks)):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.post("/generate-email/stream")
+async def generate_email_stream(
+    role: str = Form(...),
+    tone: str = Form(...),
+    topic: str = Form(...),
+    subject: str = Form("auto"),
+    name: str = Form(""),
+    position: str = Form(""),
+    recipient_name: str = Form("Dear Sir/Madam"),
+    no_cache: bool = Form(False)
+):
+    # Server-sent events: meta (subject), delta (text chunks), then done or error
+    if not _generation_configured():
+        return JSONResponse(status_code=500, content={"error": "Missing Azure OpenAI or Cohere credentials"})
+    try:
+        _throttle(generate_limits, "generation")
+    except ApiError as e:
+        return e.response()
+    events = stream_draft(role, tone, topic, subject, name, position, recipient_name, use_cache=not no_cache)
+
+    async def body():
+        try:
+            async for event, data in events:
+                yield _sse(event, data)
+        except ApiError as e:
+            yield _sse("error", {"error": str(e), "status": e.status_code, "retry_after": e.retry_after})
+        except Exception as e:
+            yield _sse("error", {"error": str(e), "status": 500})
+
+    return StreamingResponse(body(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.post("/generate-batch")
+async def generate_batch(
+    role: str = Form(...),
+    tone: str = Form(...),
+    topic: str = Form(...),
+    variants: str = Form(...),
+    subject: str = Form("auto"),
+    name: str = Form(""),
+    position: str = Form(""),
+    recipient_name: str = Form("Dear Sir/Madam"),
+    no_cache: bool = Form(False),
+    ordered: bool = Form(False)
+):
+    # NDJSON: one line per variant as it finishes, then {"done": true, ...}
+    if not _generation_configured():
+        return JSONResponse(status_code=500, content={"error": "Missing Azure OpenAI or Cohere credentials"})
+    try:
+        overrides = parse_variants(variants)
+    except (ValueError, TypeError) as e:
+        return JSONResponse(status_code=400, content={"error": f"Invalid variants: {e}"})
+    try:
+        _throttle(generate_limits, "generation", len(overrides))
+    except ApiError as e:
+        return e.response()
+    base = {"role": role, "tone": tone, "topic": topic, "subject": subject, "name": name,
+            "position": position, "recipient_name": recipient_name}
+
+    async def body():
+        started = time.perf_counter()
+        failed = 0
+        async for result in generate_variants(base, overrides, use_cache=not no_cache, ordered=ordered):
+            failed += "error" in result
+            yield json.dumps(result) + "\n"
+        yield json.dumps({"done": True, "count": len(overrides), "failed": failed,
+                          "elapsed_ms": round((time.perf_counter() - started) * 1000, 1)}) + "\n"
+
+    return StreamingResponse(body(), media_type="application/x-ndjson",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def _compose(recipient: str, subject: str, body: str, parts) -> EmailMessage:
+    with STAGE_SECONDS.labels("mime_build").time():
+        msg = EmailMessage()
+        msg["From"] = GMAIL_USER
+        msg["To"] = recipient
+        msg["Subject"] = subject
+        msg.set_content(body)
+        if parts:
+            msg.make_mixed()
+            for part in parts:
+                msg.attach(part)
+    return msg
+
+# Multiple of 57 so every chunk encodes to whole 76-character base64 lines
+_B64_CHUNK = 57 * 1024
+
+def attachment_part(filename: str, data: Union[bytes, BinaryIO], mime: Optional[str] = None) -> EmailMessage:
+    # Built (and base64-encoded) once; the same part can be attached to many messages.
+    # File objects are encoded chunk by chunk, so the raw bytes are never held in full.
+    guessed = mime or mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    maintype, subtype = guessed.split("/")
+    with STAGE_SECONDS.labels("attachment_encode").time():
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            part = EmailMessage()
+            part.set_content(data, maintype=maintype, subtype=subtype, filename=filename)
+            size = len(data)
+        else:
+            lines, size = [], 0
+            while chunk := data.read(_B64_CHUNK):
+                lines.append(base64.encodebytes(chunk).decode("ascii"))
+                size += len(chunk)
+            part = _encoded_part(filename, f"{maintype}/{subtype}", "".join(lines))
+    ATTACHMENT_BYTES.labels("in").inc(size)
+    ATTACHMENT_BYTES.labels("out").inc(len(part.get_payload()))
+    return part
+
+def _encoded_part(filename: str, mime: str, payload: str) -> EmailMessage:
+    # payload is already base64 text
+    part = EmailMessage()
+    part["Content-Type"] = mime
+    part["Content-Transfer-Encoding"] = "base64"
+    part.add_header("Content-Disposition", "attachment", filename=filename)
+    part.set_payload(payload)
+    return part
+
+async def _attachment_part(file: UploadFile) -> EmailMessage:
+    # UploadFile spools big uploads to disk; encode from there in a worker thread
+    await file.seek(0)
+    return await asyncio.to_thread(attachment_part, file.filename, file.file)
+
+async def optimized_parts(files: List[tuple]) -> tuple:
+    # files are (filename, bytes, mime); returns (parts, report). The shrinking and
+    # base64 work happens in the process pool, off the event loop.
+    loop = asyncio.get_running_loop()
+    job = partial(
+        optimize_attachment,
+        max_image_dim=int(os.getenv("ATTACHMENT_MAX_IMAGE_DIM", "1600")),
+        jpeg_quality=int(os.getenv("ATTACHMENT_JPEG_QUALITY", "80")),
+        zip_min_bytes=int(os.getenv("ATTACHMENT_ZIP_MIN_BYTES", str(256 * 1024))),
+    )
+    results = await asyncio.gather(*(
+        loop.run_in_executor(get_attachment_workers(), job, filename, data,
+                             mime or mimetypes.guess_type(filename)[0] or "application/octet-stream")
+        for filename, data, mime in files
+    ))
+    parts = [_encoded_part(r["filename"], r["mime"], r["payload"]) for r in results]
+    for r in results:
+        STAGE_SECONDS.labels("attachment_encode").observe(r["encode_ms"] / 1000)
+        ATTACHMENT_BYTES.labels("in").inc(r["original_bytes"])
+        ATTACHMENT_BYTES.labels("out").inc(len(r["payload"]))
+    details = [{
+        "filename": r["filename"],
+        "original_bytes": r["original_bytes"],
+        "sent_bytes": r["sent_bytes"],
+        "saved_bytes": r["original_bytes"] - r["sent_bytes"],
+        "encode_ms": r["encode_ms"],
+    } for r in results]
+    report = {
+        "saved_bytes": sum(d["saved_bytes"] for d in details),
+        "encode_ms": round(sum(d["encode_ms"] for d in details), 2),
+        "files": details,
+    }
+    return parts, report
+
+async def _upload_parts(attachments: Optional[List[UploadFile]], optimize: bool) -> tuple:
+    if not attachments:
+        return [], None
+    if not optimize:
+        return [await _attachment_part(file) for file in attachments], None
+    return await optimized_parts([(file.filename, await file.read(), None) for file in attachments])
+
+_PLACEHOLDER = re.compile(r"\{(\w+)\}")
+# One plain address: no display name, whitespace, or header/list separators
+_ADDRESS = re.compile(r"[^@\s<>,;\"]+@[^@\s<>,;\"]+\.[^@\s<>,;\"]+")
+
+def _parse_recipients(raw: str) -> List[dict]:
+    # A non-empty JSON list of addresses or {"email": ..., <variables>} objects.
+    # Every address is checked before anything is sent or queued.
+    try:
+        entries = json.loads(raw)
+    except ValueError:
+        raise ValueError("not valid JSON")
+    if not isinstance(entries, list) or not entries:
+        raise ValueError("expected a non-empty JSON list")
+    parsed = []
+    for i, entry in enumerate(entries):
+        if isinstance(entry, str):
+            entry = {"email": entry}
+        elif not isinstance(entry, dict):
+            raise ValueError(f"recipient {i} must be an address or an object with an email")
+        email = entry.get("email")
+        if not isinstance(email, str) or not _ADDRESS.fullmatch(email.strip()):
+            raise ValueError(f"recipient {i} has no valid email address")
+        parsed.append({**entry, "email": email.strip()})
+    return parsed
+
+
+def _render(template: str, variables: dict) -> str:
+    # {name} placeholders; unknown ones are left as-is so stray braces survive
+    return _PLACEHOLDER.sub(lambda m: str(variables.get(m.group(1), m.group(0))), template)
+
 @app.post("/send-email")
 async def send_email(
     recipient: str = Form(...),
     subject: str = Form(...),
     body: str = Form(...),
-    attachments: Optional[List[UploadFile]] = File(None)
+    attachments: Optional[List[UploadFile]] = File(None),
+    deferred: bool = Form(False),
+    optimize: bool = Form(ATTACHMENT_OPTIMIZE)
 ):
-    print(f"Email credentials: {os.getenv('GMAIL_USER')}, pass length: {len(os.getenv('GMAIL_PASS', ''))}")
-    
     if not (GMAIL_USER and GMAIL_PASS):
         return JSONResponse(status_code=500, content={"error": "Missing GMAIL_USER/GMAIL_PASS"})
 
-    msg = EmailMessage()
-    msg["From"] = GMAIL_USER
-    msg["To"] = recipient
-    msg["Subject"] = subject
-    msg.set_content(body)
+    try:
+        _throttle(send_limits, "send")
+        parts, report = await _upload_parts(attachments, optimize)
+        result = await deliver(recipient, subject, body, parts, deferred=deferred)
+    except ApiError as e:
+        return e.response()
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"error": str(e)})
+    if report:
+        result["attachments_report"] = report
+    return JSONResponse(status_code=202, content=result) if deferred else result
+
+async def deliver(recipient: str, subject: str, body: str, parts: List[EmailMessage] = (),
+                  deferred: bool = False) -> dict:
+    if not (GMAIL_USER and GMAIL_PASS):
+        raise ApiError(500, "Missing GMAIL_USER/GMAIL_PASS")
+    msg = _compose(recipient, subject, body, parts)
+    if deferred:
+        # Spool it and let the queue workers deliver with retries
+        job_id = await mail_queue.enqueue(msg)
+        return {"status": "queued", "job_id": job_id, "to": recipient}
+    refused = await get_smtp_pool().send(msg)
+    if refused:
+        # Accepted for some addresses only; the rest never get it
+        return {"status": "partial", "to": recipient, "refused": describe_refused(refused)}
+    return {"status": "sent", "to": recipient}
+
+@app.get("/jobs/{job_id}")
+def job_status(job_id: str):
+    job = mail_queue.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": "Unknown job id"})
+    return job
+
+def _send_error(err: BaseException) -> str:
+    if isinstance(err, smtplib.SMTPRecipientsRefused):
+        return "Recipient refused: " + describe_refused(err.recipients)
+    return str(err)
+
+@app.post("/send-batch")
+async def send_batch(
+    subject: str = Form(...),
+    body: str = Form(...),
+    recipients: str = Form(...),
+    attachments: Optional[List[UploadFile]] = File(None),
+    deferred: bool = Form(False),
+    optimize: bool = Form(ATTACHMENT_OPTIMIZE)
+):
+    # recipients is a JSON list of {"email": ..., <template variables>} (or plain addresses);
+    # subject/body may use {recipient_name} and any other per-recipient variable
+    if not (GMAIL_USER and GMAIL_PASS):
+        return JSONResponse(status_code=500, content={"error": "Missing GMAIL_USER/GMAIL_PASS"})
+    try:
+        entries = _parse_recipients(recipients)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": f"Invalid recipients: {e}"})
+    try:
+        _throttle(send_limits, "send", len(entries))
+    except ApiError as e:
+        return e.response()
+
+    try:
+        parts, report = await _upload_parts(attachments, optimize)
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"error": f"Could not prepare attachments: {e}"})
 
-    # Attach multiple files (optional)
-    if attachments:
-        for file in attachments:
-            file_bytes = await file.read()
-            guessed = mimetypes.guess_type(file.filename)[0] or "application/octet-stream"
-            maintype, subtype = guessed.split("/")
-            msg.add_attachment(file_bytes, maintype=maintype, subtype=subtype, filename=file.filename)
+    # A bad address or header value (e.g. a newline in a template variable) fails
+    # that recipient only; the rest are still sent
+    results: List[Optional[dict]] = [None] * len(entries)
+    msgs, slots = [], []
+    for i, entry in enumerate(entries):
+        variables = {"recipient_name": "Sir/Madam", **entry}
+        try:
+            msgs.append(_compose(entry["email"], _render(subject, variables), _render(body, variables), parts))
+            slots.append(i)
+        except Exception as e:
+            results[i] = {"to": entry["email"], "status": "failed", "error": str(e)}
 
     try:
-        with smtplib.SMTP_SSL("smtp.gmail.com", 465, timeout=30) as smtp:
-            smtp.login(GMAIL_USER, GMAIL_PASS)
-            smtp.send_message(msg)
-        return {"status": "sent", "to": recipient}
+        if deferred:
+            job_ids = await asyncio.gather(*(mail_queue.enqueue(msg) for msg in msgs))
+            for i, job_id in zip(slots, job_ids):
+                results[i] = {"to": entries[i]["email"], "status": "queued", "job_id": job_id}
+        else:
+            errors = await get_smtp_pool().send_many(msgs)
+            for i, err in zip(slots, errors):
+                results[i] = ({"to": entries[i]["email"], "status": "sent"} if err is None
+                              else {"to": entries[i]["email"], "status": "failed", "error": _send_error(err)})
     except Exception as e:
-        return JSONResponse(status_code=500, content={"error": str(e)})
\ No newline at end of file
+        return JSONResponse(status_code=500, content={"error": str(e)})
+
+    summary = {}
+    for result in results:
+        summary[result["status"]] = summary.get(result["status"], 0) + 1
+    content = {"summary": summary, "results": results}
+    if report:
+        content["attachments_report"] = report
+    return JSONResponse(status_code=202 if deferred else 200, content=content)
\ No newline at end of file
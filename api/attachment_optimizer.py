@@ -0,0 +1,87 @@
+import base64, importlib.util, io, time, zipfile
+from typing import Optional
+
+# Optional: images are only recompressed when Pillow is installed. Looked up on
+# first use, in the worker process, so the API doesn't import it at startup.
+_Image = False
+
+
+def _pillow():
+    global _Image
+    if _Image is False:
+        try:
+            from PIL import Image
+        except ImportError:
+            Image = None
+        _Image = Image
+    return _Image
+
+
+def pillow_installed() -> bool:
+    # Checked at startup without importing it
+    return importlib.util.find_spec("PIL") is not None
+
+
+_IMAGE_FORMATS = {"image/jpeg": "JPEG", "image/png": "PNG", "image/webp": "WEBP"}
+# Formats that are already compressed gain nothing from zipping
+_COMPRESSIBLE_PREFIXES = ("text/",)
+_COMPRESSIBLE_TYPES = {
+    "application/json", "application/xml", "application/rtf", "application/msword",
+    "application/vnd.ms-excel", "application/vnd.ms-powerpoint", "application/x-tar",
+    "application/postscript", "application/sql", "image/bmp", "image/tiff", "image/svg+xml",
+}
+
+
+def optimize(filename: str, data: bytes, mime: str, max_image_dim: int = 1600, jpeg_quality: int = 80,
+             zip_min_bytes: int = 256 * 1024) -> dict:
+    # Runs in a worker process: shrink the attachment if that pays off, then
+    # base64-encode it so the event loop only has to splice the result in.
+    started = time.perf_counter()
+    original = len(data)
+    if mime in _IMAGE_FORMATS and _pillow() is not None:
+        data = _shrink_image(data, _IMAGE_FORMATS[mime], max_image_dim, jpeg_quality) or data
+    elif original >= zip_min_bytes and (mime.startswith(_COMPRESSIBLE_PREFIXES) or mime in _COMPRESSIBLE_TYPES):
+        zipped = _zip(filename, data)
+        if len(zipped) < original * 0.9:
+            data, filename, mime = zipped, f"{filename}.zip", "application/zip"
+    return {
+        "filename": filename,
+        "mime": mime,
+        "payload": base64.encodebytes(data).decode("ascii"),
+        "original_bytes": original,
+        "sent_bytes": len(data),
+        "encode_ms": round((time.perf_counter() - started) * 1000, 2),
+    }
+
+
+def _shrink_image(data: bytes, fmt: str, max_dim: int, quality: int) -> Optional[bytes]:
+    try:
+        from PIL import ImageOps
+        with _pillow().open(io.BytesIO(data)) as original:
+            # Phone photos are often stored sideways with an EXIF Orientation tag;
+            # re-saving drops EXIF, so rotate the pixels upright first
+            img = ImageOps.exif_transpose(original)
+            if max(img.size) > max_dim:
+                img.thumbnail((max_dim, max_dim))
+            if fmt == "JPEG" and img.mode not in ("RGB", "L"):
+                img = img.convert("RGB")
+            out = io.BytesIO()
+            options = {"quality": quality, "optimize": True} if fmt in ("JPEG", "WEBP") else {"optimize": True}
+            # Keep the rest of the metadata (camera, date) and the colour profile
+            if original.info.get("icc_profile"):
+                options["icc_profile"] = original.info["icc_profile"]
+            exif = img.getexif()
+            if exif:
+                options["exif"] = exif.tobytes()
+            img.save(out, fmt, **options)
+    except Exception:
+        return None  # not decodable as an image: send it untouched
+    shrunk = out.getvalue()
+    return shrunk if len(shrunk) < len(data) else None
+
+
+def _zip(filename: str, data: bytes) -> bytes:
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=6) as zf:
+        zf.writestr(filename, data)
+    return out.getvalue()
@@ -0,0 +1,276 @@
+import asyncio, time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Awaitable, Callable, Deque, Dict, Hashable, Optional
+
+# Who the current request is for (API client or bot chat); set once per request so
+# the limiters below can tell users apart without threading it through every call
+current_client: ContextVar[str] = ContextVar("current_client", default="anonymous")
+
+
+class Throttled(Exception):
+    # Raised by an upstream client when the provider answers 429
+    def __init__(self, retry_after: float, message: str = "Upstream rate limit"):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Overloaded(Exception):
+    # Raised when a request could not get a slot within the allowed wait
+    def __init__(self, retry_after: float, message: str = "Generation capacity exhausted, try again shortly"):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class SingleFlight:
+    # Concurrent calls with the same key share one in-flight upstream call
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Task] = {}
+        self.coalesced = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable]):
+        task = self._calls.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+        # shield: one caller disconnecting must not cancel the call for everyone else
+        return await asyncio.shield(task)
+
+
+class FairQueue:
+    # Weighted round-robin over per-client FIFO queues: the client at the front
+    # may take up to `weight` turns in a row, then moves to the back. A client
+    # with many queued requests can't starve one that has a single request.
+    def __init__(self):
+        self._queues: "OrderedDict[Hashable, Deque[object]]" = OrderedDict()
+        self._turns: Dict[Hashable, int] = {}
+
+    def __len__(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+
+    @property
+    def clients(self) -> int:
+        return len(self._queues)
+
+    def push(self, client: Hashable, item: object, weight: int = 1):
+        if client not in self._queues:
+            self._queues[client] = deque()
+            self._turns[client] = max(1, weight)
+        self._queues[client].append(item)
+
+    def head(self) -> Optional[object]:
+        # The item whose turn it is
+        for queue in self._queues.values():
+            return queue[0]
+        return None
+
+    def remove(self, client: Hashable, item: object, weight: int = 1):
+        # Removes an item that was granted (the head) or gave up waiting (anywhere)
+        queue = self._queues.get(client)
+        if queue is None or item not in queue:
+            return
+        granted = queue[0] is item and next(iter(self._queues)) == client
+        queue.remove(item)
+        if not queue:
+            del self._queues[client]
+            del self._turns[client]
+        elif granted:
+            self._turns[client] -= 1
+            if self._turns[client] <= 0:
+                self._turns[client] = max(1, weight)
+                self._queues.move_to_end(client)
+
+
+class AdaptiveLimiter:
+    # AIMD concurrency limit plus an optional tokens-per-minute bucket. A 429
+    # halves the limit and pauses everyone until Retry-After; each success grows
+    # it back by roughly one slot per round of requests. Waiters are bounded in
+    # number and in time, beyond which callers get Overloaded instead of queueing.
+    # Freed slots go to waiting clients in weighted round-robin order (see
+    # FairQueue), not first come first served; `weights` gives some clients more
+    # turns per round.
+    def __init__(self, initial: int = 8, min_limit: int = 1, max_limit: int = 32,
+                 max_queue: int = 100, max_wait: float = 10, tokens_per_minute: int = 0,
+                 max_retries: int = 2, weights: Optional[Dict[str, int]] = None):
+        self.limit = float(max(min_limit, min(initial, max_limit)))
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.max_retries = max_retries
+        self.tokens_per_minute = tokens_per_minute
+        self._tokens = float(tokens_per_minute)
+        self._refilled = time.monotonic()
+        self._blocked_until = 0.0
+        self._in_flight = 0
+        self._waiting = 0
+        self._queue = FairQueue()
+        self.weights = weights or {}
+        self._cond: Optional[asyncio.Condition] = None
+        self.stats = {"admitted": 0, "throttled": 0, "shed": 0}
+
+    def _condition(self) -> asyncio.Condition:
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    def _refill(self, now: float):
+        if self.tokens_per_minute:
+            rate = self.tokens_per_minute / 60
+            self._tokens = min(self.tokens_per_minute, self._tokens + (now - self._refilled) * rate)
+        self._refilled = now
+
+    def _delay(self, now: float, cost: float):
+        # (None, _) = go now; (seconds, True) = known wait; (_, False) = wait for a release
+        if self._blocked_until > now:
+            return self._blocked_until - now, True
+        if self._in_flight >= int(self.limit):
+            return 0.0, False
+        if self.tokens_per_minute and self._tokens < cost:
+            return (cost - self._tokens) / (self.tokens_per_minute / 60), True
+        return None, False
+
+    async def _acquire(self, cost: float, deadline: float, client: Hashable):
+        cond = self._condition()
+        if self.tokens_per_minute:
+            cost = min(cost, self.tokens_per_minute)
+        weight = self.weights.get(client, 1)
+        ticket = object()
+        async with cond:
+            if self._waiting >= self.max_queue:
+                self.stats["shed"] += 1
+                raise Overloaded(self._retry_hint())
+            self._waiting += 1
+            self._queue.push(client, ticket, weight)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    delay, exact = self._delay(now, cost)
+                    if delay is None and self._queue.head() is ticket:
+                        break
+                    if delay is None:
+                        # Capacity is free but it's another client's turn
+                        delay, exact = 0.0, False
+                    remaining = deadline - now
+                    # No point queueing for a Retry-After or refill we know ends past our deadline
+                    if remaining <= 0 or (exact and delay > remaining):
+                        self.stats["shed"] += 1
+                        raise Overloaded(max(delay, self._retry_hint()))
+                    try:
+                        await asyncio.wait_for(cond.wait(), min(delay, remaining) if exact else remaining)
+                    except asyncio.TimeoutError:
+                        pass
+            finally:
+                self._waiting -= 1
+                self._queue.remove(client, ticket, weight)
+                # The next client in line may be able to go now
+                cond.notify_all()
+            if self.tokens_per_minute:
+                self._tokens -= cost
+            self._in_flight += 1
+            self.stats["admitted"] += 1
+
+    async def _release(self, retry_after: Optional[float] = None, ok: bool = True):
+        cond = self._condition()
+        async with cond:
+            self._in_flight -= 1
+            if retry_after is not None:
+                self.stats["throttled"] += 1
+                self.limit = max(self.min_limit, self.limit / 2)
+                self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+            elif ok:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            cond.notify_all()
+
+    def _retry_hint(self) -> float:
+        return max(1.0, self._blocked_until - time.monotonic())
+
+    @asynccontextmanager
+    async def slot(self, cost: float = 0, deadline: Optional[float] = None, client: Optional[Hashable] = None):
+        # Holds one slot for the body, e.g. for the whole life of a streamed completion
+        await self._acquire(cost, deadline or time.monotonic() + self.max_wait,
+                            current_client.get() if client is None else client)
+        try:
+            yield
+        except Throttled as e:
+            await self._release(e.retry_after)
+            raise
+        except BaseException:
+            await self._release(ok=False)
+            raise
+        await self._release()
+
+    async def run(self, fn: Callable[[], Awaitable], cost: float = 0):
+        deadline = time.monotonic() + self.max_wait
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self.slot(cost, deadline):
+                    return await fn()
+            except Throttled as e:
+                if attempt == self.max_retries:
+                    raise Overloaded(e.retry_after) from e
+
+    def snapshot(self) -> dict:
+        return {
+            "limit": round(self.limit, 2),
+            "in_flight": self._in_flight,
+            "waiting": self._waiting,
+            "waiting_clients": self._queue.clients,
+            "blocked_for": round(max(0.0, self._blocked_until - time.monotonic()), 2),
+            **self.stats,
+        }
+
+
+class CircuitBreaker:
+    # Closed until `failures` calls in a row fail, then open (callers skip this
+    # upstream) for reset_timeout seconds; after that one probe call is let
+    # through (half-open) and its outcome closes or re-opens the circuit.
+    def __init__(self, failures: int = 5, reset_timeout: float = 30):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self._consecutive = 0
+        self._opened_at: Optional[float] = None
+        self._probing = False
+        self.stats = {"opened": 0}
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self._opened_at >= self.reset_timeout else "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def retry_after(self) -> float:
+        # Seconds until a probe will be allowed
+        if self._opened_at is None:
+            return 0.0
+        return max(0.0, self._opened_at + self.reset_timeout - time.monotonic())
+
+    def record_success(self):
+        self._consecutive = 0
+        self._opened_at = None
+        self._probing = False
+
+    def record_failure(self):
+        self._consecutive += 1
+        if self._probing or (self._opened_at is None and self._consecutive >= self.failures):
+            self._opened_at = time.monotonic()
+            self.stats["opened"] += 1
+        self._probing = False
+
+    def release(self):
+        # A probe that ended without a verdict (e.g. cancelled after losing a hedge race)
+        self._probing = False
@@ -0,0 +1,122 @@
+import asyncio, hashlib, json, sqlite3, threading, time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+# Fields that only steer the prompt are case-folded; the rest end up verbatim in the email
+_FOLDED = ("role", "tone", "topic")
+
+
+def cache_key(fields: dict, deployment: Optional[str], temperature: float) -> str:
+    normalized = {}
+    for k, v in sorted(fields.items()):
+        v = " ".join(str(v).split())
+        normalized[k] = v.casefold() if k in _FOLDED else v
+    raw = json.dumps([normalized, deployment, temperature], sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class GenerationCache:
+    # Bounded in-memory LRU with per-entry TTL, optionally backed by SQLite so
+    # entries survive restarts. Memory misses fall through to disk and get promoted.
+    # Disk reads and writes run in a thread, under their own lock, so a slow disk
+    # never holds up the event loop or in-memory lookups. The table is pruned of
+    # expired rows and capped at disk_max_entries every prune_every writes.
+    def __init__(self, max_entries: int = 1024, ttl: float = 3600, disk_path: Optional[Path] = None,
+                 disk_max_entries: Optional[int] = None, prune_every: int = 100):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk_max_entries = disk_max_entries if disk_max_entries is not None else 10 * max_entries
+        self.prune_every = max(1, prune_every)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        if disk_path is not None:
+            disk_path = Path(disk_path)
+            disk_path.parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(str(disk_path), check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, expires REAL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires)")
+            self._prune()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    async def get(self, key: str) -> Optional[dict]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] >= now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry:
+                del self._entries[key]
+        row = await asyncio.to_thread(self._read, key) if self._db is not None else None
+        with self._lock:
+            if row and row[1] >= now:
+                value = json.loads(row[0])
+                self._remember(key, row[1], value)
+                self.hits += 1
+                return value
+            self.misses += 1
+            return None
+
+    async def set(self, key: str, value: dict):
+        expires = time.time() + self.ttl
+        with self._lock:
+            self._remember(key, expires, value)
+        if self._db is not None:
+            await asyncio.to_thread(self._write, key, json.dumps(value), expires)
+
+    def _read(self, key: str) -> Optional[tuple]:
+        with self._db_lock:
+            if self._db is None:
+                return None
+            return self._db.execute("SELECT value, expires FROM cache WHERE key=?", (key,)).fetchone()
+
+    def _write(self, key: str, value: str, expires: float):
+        with self._db_lock:
+            if self._db is None:
+                return
+            self._db.execute("INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)",
+                             (key, value, expires))
+            self._writes += 1
+            if self._writes % self.prune_every == 0:
+                self._prune()
+
+    def _prune(self):
+        # Expired rows, then the soonest to expire (the oldest writes) beyond the cap
+        self._db.execute("DELETE FROM cache WHERE expires < ?", (time.time(),))
+        self._db.execute("DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY expires DESC "
+                         "LIMIT -1 OFFSET ?)", (self.disk_max_entries,))
+
+    def _remember(self, key: str, expires: float, value: dict):
+        self._entries[key] = (expires, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "disk": self._db is not None,
+        }
+
+    def close(self):
+        with self._db_lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
@@ -0,0 +1,46 @@
+import threading
+
+# Prometheus metric factories that defer importing prometheus_client until a
+# metric is first used, which keeps the import off cold start. Standard library
+# only: the bot's metrics (telegram_bot/bot_metrics.py) are built on it too.
+
+
+class _Lazy:
+    # A metric that is only created (and prometheus_client only imported) when it
+    # is first used
+    def __init__(self, kind: str, *args, **kwargs):
+        self._spec = (kind, args, kwargs)
+        self._metric = None
+        _ALL.append(self)
+
+    def _get(self):
+        if self._metric is None:
+            with _BUILD_LOCK:
+                if self._metric is None:
+                    import prometheus_client
+                    kind, args, kwargs = self._spec
+                    self._metric = getattr(prometheus_client, kind)(*args, **kwargs)
+        return self._metric
+
+    def __getattr__(self, name):
+        return getattr(self._get(), name)
+
+
+_ALL = []
+_BUILD_LOCK = threading.Lock()
+
+
+def Counter(*args, **kwargs) -> _Lazy:
+    return _Lazy("Counter", *args, **kwargs)
+
+
+def Histogram(*args, **kwargs) -> _Lazy:
+    return _Lazy("Histogram", *args, **kwargs)
+
+
+def render() -> tuple:
+    # (body, content type) for /metrics, with every metric registered first
+    import prometheus_client
+    for metric in _ALL:
+        metric._get()
+    return prometheus_client.generate_latest(), prometheus_client.CONTENT_TYPE_LATEST
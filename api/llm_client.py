@@ -0,0 +1,256 @@
+import importlib.util, json, os, sys, time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, AsyncIterator, List, Optional
+
+from concurrency import Throttled
+from metrics import AZURE_RESPONSES, STAGE_SECONDS
+
+if TYPE_CHECKING:
+    import httpx  # imported for real on first use, see _LazyHttpClient
+
+
+@dataclass(frozen=True)
+class AzureConfig:
+    key: Optional[str]
+    endpoint: Optional[str]
+    deployment: Optional[str]
+    api_version: str = "2023-05-15"
+    temperature: float = 0.7
+    max_tokens: int = 800
+
+    @classmethod
+    def from_env(cls) -> "AzureConfig":
+        return cls(
+            key=os.getenv("AZURE_OPENAI_KEY"),
+            endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+            deployment=os.getenv("AZURE_OPENAI_DEPLOYMENT"),
+            api_version=os.getenv("AZURE_API_VERSION", "2023-05-15"),
+            temperature=float(os.getenv("AZURE_OPENAI_TEMPERATURE", "0.7")),
+            max_tokens=int(os.getenv("AZURE_OPENAI_MAX_TOKENS", "800")),
+        )
+
+    @property
+    def configured(self) -> bool:
+        return bool(self.key and self.endpoint and self.deployment)
+
+    @property
+    def url(self) -> str:
+        return (f"{self.endpoint}openai/deployments/{self.deployment}/chat/completions"
+                f"?api-version={self.api_version}")
+
+
+class _LazyHttpClient:
+    # httpx is imported and the AsyncClient built on first use: loading the CA
+    # bundle into its TLS context takes a few hundred ms, which a cold start
+    # shouldn't pay before the first request that actually needs the provider.
+    def _setup(self, timeout: float, connect_timeout: float, max_connections: int, max_keepalive: int,
+               **kwargs):
+        self._limits = (timeout, connect_timeout, max_connections, max_keepalive)
+        self._client_kwargs = kwargs
+        self._http = None
+
+    @property
+    def _client(self) -> "httpx.AsyncClient":
+        if self._http is None:
+            import httpx
+            timeout, connect_timeout, max_connections, max_keepalive = self._limits
+            self._http = httpx.AsyncClient(
+                timeout=httpx.Timeout(timeout, connect=connect_timeout),
+                limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive),
+                **self._client_kwargs,
+            )
+        return self._http
+
+    async def aclose(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+
+class AzureOpenAIClient(_LazyHttpClient):
+    # One long-lived AsyncClient per process: keep-alive (and HTTP/2 when the
+    # h2 package is installed) instead of a fresh TCP+TLS handshake per call.
+    def __init__(self, config: AzureConfig, timeout: float = 30, connect_timeout: float = 5,
+                 max_connections: int = 20, max_keepalive: int = 10, http2: bool = False):
+        self.config = config
+        if http2 and importlib.util.find_spec("h2") is None:
+            print("h2 not installed, Azure OpenAI client falls back to HTTP/1.1")
+            http2 = False
+        self._setup(
+            timeout, connect_timeout, max_connections, max_keepalive,
+            http2=http2,
+            headers={"api-key": config.key or "", "Content-Type": "application/json"},
+        )
+
+    @classmethod
+    def from_env(cls, config: AzureConfig) -> "AzureOpenAIClient":
+        return cls(
+            config,
+            timeout=float(os.getenv("AZURE_OPENAI_TIMEOUT", "30")),
+            connect_timeout=float(os.getenv("AZURE_OPENAI_CONNECT_TIMEOUT", "5")),
+            max_connections=int(os.getenv("AZURE_OPENAI_MAX_CONNECTIONS", "20")),
+            max_keepalive=int(os.getenv("AZURE_OPENAI_MAX_KEEPALIVE", "10")),
+            http2=os.getenv("AZURE_OPENAI_HTTP2", "false").lower() == "true",
+        )
+
+    async def chat(self, messages: List[dict], temperature: Optional[float] = None,
+                   max_tokens: Optional[int] = None) -> dict:
+        body = {
+            "messages": messages,
+            "temperature": self.config.temperature if temperature is None else temperature,
+            "max_tokens": max_tokens or self.config.max_tokens,
+        }
+        # Streamed only so time to first byte can be told apart from the full round-trip
+        started = time.perf_counter()
+        async with self._open(body) as r:
+            await r.aread()
+        STAGE_SECONDS.labels("azure_total").observe(time.perf_counter() - started)
+        with STAGE_SECONDS.labels("response_parse").time():
+            return r.json()
+
+    async def stream_chat(self, messages: List[dict], temperature: Optional[float] = None,
+                          max_tokens: Optional[int] = None) -> AsyncIterator[str]:
+        # Yields content deltas from Azure's server-sent chat.completion.chunk events
+        body = {
+            "messages": messages,
+            "temperature": self.config.temperature if temperature is None else temperature,
+            "max_tokens": max_tokens or self.config.max_tokens,
+            "stream": True,
+        }
+        started = time.perf_counter()
+        async with self._open(body) as r:
+            async for line in r.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                payload = line[5:].strip()
+                if payload == "[DONE]":
+                    break
+                choices = json.loads(payload).get("choices") or [{}]
+                delta = (choices[0].get("delta") or {}).get("content")
+                if delta:
+                    yield delta
+        STAGE_SECONDS.labels("azure_total").observe(time.perf_counter() - started)
+
+    @asynccontextmanager
+    async def _open(self, body: dict) -> AsyncIterator["httpx.Response"]:
+        # POSTs and yields the response once its headers are in, raising on 429 and other errors
+        import httpx
+        started = time.perf_counter()
+        answered = False
+        try:
+            async with self._client.stream("POST", self.config.url, json=body) as r:
+                answered = True
+                STAGE_SECONDS.labels("azure_ttfb").observe(time.perf_counter() - started)
+                AZURE_RESPONSES.labels(str(r.status_code)).inc()
+                if r.status_code == 429:
+                    raise Throttled(retry_after_seconds(r.headers))
+                r.raise_for_status()
+                yield r
+        except httpx.TransportError as e:
+            if not answered:  # no status to count, e.g. connect timeout
+                AZURE_RESPONSES.labels(type(e).__name__).inc()
+            raise
+
+
+def http_status(exc: BaseException) -> Optional[int]:
+    # The status of an httpx.HTTPStatusError, else None. httpx is only loaded once a
+    # client exists, so an error from it means it is already in sys.modules.
+    httpx = sys.modules.get("httpx")
+    if httpx is not None and isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code
+    return None
+
+
+def retry_after_seconds(headers, default: float = 1.0) -> float:
+    # Azure sends retry-after-ms alongside (or instead of) the standard header
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return default
+
+
+@dataclass(frozen=True)
+class CohereConfig:
+    key: Optional[str]
+    model: str = "command-r-plus-08-2024"
+    base_url: str = "https://api.cohere.com"
+    temperature: float = 0.7
+    max_tokens: int = 800
+
+    @classmethod
+    def from_env(cls) -> "CohereConfig":
+        return cls(
+            key=os.getenv("COHERE_API_KEY"),
+            model=os.getenv("COHERE_MODEL", "command-r-plus-08-2024"),
+            base_url=os.getenv("COHERE_BASE_URL", "https://api.cohere.com"),
+            temperature=float(os.getenv("COHERE_TEMPERATURE", os.getenv("AZURE_OPENAI_TEMPERATURE", "0.7"))),
+            max_tokens=int(os.getenv("COHERE_MAX_TOKENS", os.getenv("AZURE_OPENAI_MAX_TOKENS", "800"))),
+        )
+
+    @property
+    def configured(self) -> bool:
+        return bool(self.key)
+
+
+class CohereClient(_LazyHttpClient):
+    # Cohere's v2 chat API, which takes the same role/content messages as Azure
+    def __init__(self, config: CohereConfig, timeout: float = 30, connect_timeout: float = 5,
+                 max_connections: int = 20):
+        self.config = config
+        self._setup(
+            timeout, connect_timeout, max_connections, max_connections,
+            base_url=config.base_url,
+            headers={"Authorization": f"Bearer {config.key or ''}", "Content-Type": "application/json"},
+        )
+
+    @classmethod
+    def from_env(cls, config: CohereConfig) -> "CohereClient":
+        return cls(config, timeout=float(os.getenv("COHERE_TIMEOUT", "30")))
+
+    def _body(self, messages: List[dict], temperature: Optional[float], max_tokens: Optional[int],
+              stream: bool) -> dict:
+        return {
+            "model": self.config.model,
+            "messages": messages,
+            "temperature": self.config.temperature if temperature is None else temperature,
+            "max_tokens": max_tokens or self.config.max_tokens,
+            "stream": stream,
+        }
+
+    async def chat(self, messages: List[dict], temperature: Optional[float] = None,
+                   max_tokens: Optional[int] = None) -> str:
+        started = time.perf_counter()
+        r = await self._client.post("/v2/chat", json=self._body(messages, temperature, max_tokens, False))
+        STAGE_SECONDS.labels("cohere_total").observe(time.perf_counter() - started)
+        if r.status_code == 429:
+            raise Throttled(retry_after_seconds(r.headers))
+        r.raise_for_status()
+        content = r.json().get("message", {}).get("content") or []
+        return "".join(part.get("text", "") for part in content if part.get("type") == "text")
+
+    async def stream_chat(self, messages: List[dict], temperature: Optional[float] = None,
+                          max_tokens: Optional[int] = None) -> AsyncIterator[str]:
+        # Yields text from content-delta events
+        started = time.perf_counter()
+        body = self._body(messages, temperature, max_tokens, True)
+        async with self._client.stream("POST", "/v2/chat", json=body) as r:
+            STAGE_SECONDS.labels("cohere_ttfb").observe(time.perf_counter() - started)
+            if r.status_code == 429:
+                raise Throttled(retry_after_seconds(r.headers))
+            r.raise_for_status()
+            async for line in r.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                event = json.loads(line[5:])
+                if event.get("type") == "content-delta":
+                    text = event.get("delta", {}).get("message", {}).get("content", {}).get("text")
+                    if text:
+                        yield text
+                elif event.get("type") == "message-end":
+                    break
+        STAGE_SECONDS.labels("cohere_total").observe(time.perf_counter() - started)
@@ -0,0 +1,190 @@
+import asyncio, logging, random, smtplib, sqlite3, threading, time, uuid
+from email import message_from_bytes
+from pathlib import Path
+from typing import Awaitable, Callable, List, Optional
+
+from smtp_pool import describe_refused
+
+# Errors that will not go away by retrying; these go straight to the dead letter state
+PERMANENT_ERRORS = (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, ValueError)
+
+logger = logging.getLogger(__name__)
+
+
+class MailQueue:
+    # SQLite-backed spool for outgoing mail, safe to share between API processes.
+    # A worker claims a job with a conditional UPDATE, so only one process wins it,
+    # and holds it for `lease` seconds. A job left in "sending" by a process that
+    # died is picked up again once its lease runs out; jobs other live processes
+    # are sending are left alone.
+    def __init__(self, path: Path, send: Callable[..., Awaitable], workers: int = 2,
+                 max_attempts: int = 5, backoff_base: float = 2.0, backoff_max: float = 300,
+                 poll_interval: float = 1.0, lease: float = 300, drain_timeout: float = 30):
+        self.path = Path(path)
+        self._send = send
+        self.workers = max(1, workers)
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.drain_timeout = drain_timeout
+        self.owner = uuid.uuid4().hex
+        self._stopping = False
+        self._db: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+
+    def _open(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        db = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY, status TEXT NOT NULL, recipient TEXT, message BLOB,
+            attempts INTEGER NOT NULL DEFAULT 0, next_attempt REAL NOT NULL,
+            last_error TEXT, created REAL NOT NULL, updated REAL NOT NULL,
+            owner TEXT, lease_until REAL NOT NULL DEFAULT 0)""")
+        columns = {row[1] for row in db.execute("PRAGMA table_info(jobs)")}
+        if "owner" not in columns:  # spools from before leases
+            db.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+            db.execute("ALTER TABLE jobs ADD COLUMN lease_until REAL NOT NULL DEFAULT 0")
+        db.execute("CREATE INDEX IF NOT EXISTS jobs_due ON jobs (status, next_attempt)")
+        self._db = db
+
+    async def start(self):
+        if self._db is None:
+            await asyncio.to_thread(self._open)
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        # Workers finish the send they are in (up to drain_timeout) and take no new
+        # jobs. Cancelling mid-send would leave a message that may already have
+        # gone out in "sending", to be sent again once its lease expires.
+        self._stopping = True
+        if self._wakeup is not None:
+            self._wakeup.set()
+        done, pending = await asyncio.wait(self._tasks, timeout=self.drain_timeout) if self._tasks else ((), ())
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        self._tasks = []
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _execute(self, sql: str, args=()):
+        with self._lock:
+            return self._db.execute(sql, args).fetchall()
+
+    async def enqueue(self, msg) -> str:
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        await asyncio.to_thread(
+            self._execute,
+            "INSERT INTO jobs (id, status, recipient, message, next_attempt, created, updated) "
+            "VALUES (?, 'queued', ?, ?, ?, ?, ?)",
+            (job_id, msg["To"], msg.as_bytes(), now, now, now),
+        )
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return job_id
+
+    def get(self, job_id: str) -> Optional[dict]:
+        rows = self._execute(
+            "SELECT id, status, recipient, attempts, next_attempt, last_error, created, updated "
+            "FROM jobs WHERE id=?", (job_id,))
+        if not rows:
+            return None
+        keys = ("id", "status", "to", "attempts", "next_attempt", "last_error", "created", "updated")
+        return dict(zip(keys, rows[0]))
+
+    def counts(self) -> dict:
+        if self._db is None:
+            return {}
+        return dict(self._execute("SELECT status, COUNT(*) FROM jobs GROUP BY status"))
+
+    def _claim(self):
+        # Due queued jobs, or jobs whose sender's lease ran out. The UPDATE only
+        # succeeds if nobody claimed the row in between, which makes it safe
+        # across processes sharing the spool.
+        now = time.time()
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, status, lease_until FROM jobs WHERE (status='queued' AND next_attempt<=?) "
+                "OR (status='sending' AND lease_until<?) ORDER BY next_attempt LIMIT 5", (now, now)).fetchall()
+            for job_id, status, lease_until in rows:
+                claimed = self._db.execute(
+                    "UPDATE jobs SET status='sending', owner=?, lease_until=?, updated=? "
+                    "WHERE id=? AND status=? AND lease_until=?",
+                    (self.owner, now + self.lease, now, job_id, status, lease_until)).rowcount
+                if claimed:
+                    return self._db.execute("SELECT id, message, attempts FROM jobs WHERE id=?",
+                                            (job_id,)).fetchone()
+            return None
+
+    def _finish(self, job_id: str, attempts: int, error: Optional[BaseException], refused: Optional[str] = None):
+        now = time.time()
+        if refused:
+            # Delivered to some recipients and refused for the rest; a retry would
+            # send it to the first ones again
+            self._execute("UPDATE jobs SET status='partial', message=NULL, attempts=?, last_error=?, updated=? "
+                          "WHERE id=? AND owner=?", (attempts, refused, now, job_id, self.owner))
+        elif error is None:
+            # Keep the row for /jobs lookups but drop the payload
+            self._execute("UPDATE jobs SET status='sent', message=NULL, attempts=?, last_error=NULL, updated=? "
+                          "WHERE id=? AND owner=?", (attempts, now, job_id, self.owner))
+        elif isinstance(error, PERMANENT_ERRORS) or attempts >= self.max_attempts:
+            self._execute("UPDATE jobs SET status='dead', attempts=?, last_error=?, updated=? "
+                          "WHERE id=? AND owner=?", (attempts, str(error), now, job_id, self.owner))
+        else:
+            delay = min(self.backoff_max, self.backoff_base * 2 ** (attempts - 1))
+            delay *= random.uniform(0.5, 1.0)
+            self._execute("UPDATE jobs SET status='queued', attempts=?, last_error=?, next_attempt=?, updated=? "
+                          "WHERE id=? AND owner=?", (attempts, str(error), now + delay, now, job_id, self.owner))
+
+    async def _idle(self, timeout: float):
+        # Sleeps until the timeout, a new job, or stop()
+        self._wakeup.clear()
+        if self._stopping:
+            return
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _worker(self):
+        # The spool itself can fail (a shared file locked for too long, a full
+        # disk); the worker logs it, backs off and carries on rather than dying
+        failures = 0
+        while not self._stopping:
+            try:
+                sent = await self._work_once()
+                failures = 0
+            except Exception:
+                failures += 1
+                delay = min(self.backoff_max, self.poll_interval * 2 ** (failures - 1)) * random.uniform(0.5, 1.0)
+                logger.exception("Mail queue worker failed, retrying in %.1fs", delay)
+                await self._idle(delay)
+                continue
+            if not sent:
+                await self._idle(self.poll_interval)
+
+    async def _work_once(self) -> bool:
+        # Sends one due job; False when there was none
+        job = await asyncio.to_thread(self._claim)
+        if job is None:
+            return False
+        job_id, raw, attempts = job
+        error = refused = None
+        from email.policy import default  # loaded on the first job, not at startup
+        try:
+            # send() may return smtplib's {address: (code, reply)} of refused recipients
+            refused = await self._send(message_from_bytes(raw, policy=default))
+        except Exception as e:
+            error = e
+        refused = describe_refused(refused) if isinstance(refused, dict) and refused else None
+        await asyncio.to_thread(self._finish, job_id, attempts + 1, error, refused)
+        return True
@@ -0,0 +1,36 @@
+from lazy_metrics import Counter, Histogram
+
+# Prometheus metrics for the API, served on /metrics. Stage timings share one
+# histogram so a latency spike can be pinned on Azure, Gmail or our own code:
+#   prompt_build, azure_ttfb, azure_total, response_parse  (generation)
+#   mime_build, attachment_encode                          (message assembly)
+#   cohere_ttfb, cohere_total                              (fallback provider)
+#   smtp_connect, smtp_login, smtp_send                    (delivery)
+
+# Azure completions can take tens of seconds, so the buckets go past the defaults
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+STAGE_SECONDS = Histogram("email_api_stage_seconds", "Time spent per processing stage", ["stage"],
+                          buckets=BUCKETS)
+REQUEST_SECONDS = Histogram("email_api_request_seconds", "HTTP request latency until the response starts",
+                            ["method", "route", "status"], buckets=BUCKETS)
+AZURE_RESPONSES = Counter("email_api_azure_responses_total", "Azure OpenAI responses by HTTP status",
+                          ["status"])
+CACHE_LOOKUPS = Counter("email_api_generation_cache_lookups_total", "Generation cache lookups", ["result"])
+SMTP_SENDS = Counter("email_api_smtp_sends_total", "SMTP send attempts by outcome", ["result"])
+ATTACHMENT_BYTES = Counter("email_api_attachment_bytes_total",
+                           "Attachment bytes received (in) and put on the wire after encoding (out)",
+                           ["direction"])
+PROVIDER_CALLS = Counter("email_api_provider_calls_total", "Generation calls per provider by outcome",
+                         ["provider", "result"])
+PROVIDER_SECONDS = Histogram("email_api_provider_seconds", "Latency of winning generation calls per provider",
+                             ["provider"], buckets=BUCKETS)
+HEDGES = Counter("email_api_hedges_total", "Hedged generation requests started, and won by the hedge",
+                 ["outcome"])
+SIMILAR_LOOKUPS = Counter("email_api_similar_draft_lookups_total",
+                          "Near-duplicate lookups: drafts reused as-is, revised, or missed", ["result"])
+SIMILAR_TOKENS = Counter("email_api_similar_draft_tokens_total",
+                         "Estimated tokens a fresh generation would have used (avoided) and revisions used (spent)",
+                         ["kind"])
+RATE_LIMITED = Counter("email_api_rate_limited_total", "Requests rejected by the per-client rate limits",
+                       ["kind"])
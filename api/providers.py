@@ -0,0 +1,318 @@
+import asyncio, random, time
+from collections import deque
+from typing import AsyncIterator, Awaitable, Callable, List, Optional, Tuple
+
+from concurrency import AdaptiveLimiter, CircuitBreaker, Overloaded, Throttled
+from llm_client import AzureOpenAIClient, CohereClient, http_status
+from metrics import HEDGES, PROVIDER_CALLS, PROVIDER_SECONDS
+
+
+class Provider:
+    # A chat-completion backend. complete() returns the draft text; stream()
+    # yields it in chunks.
+    name = "provider"
+
+    async def complete(self, messages: List[dict], temperature: Optional[float] = None,
+                       max_tokens: Optional[int] = None) -> str:
+        raise NotImplementedError
+
+    def stream(self, messages: List[dict], temperature: Optional[float] = None,
+               max_tokens: Optional[int] = None) -> AsyncIterator[str]:
+        raise NotImplementedError
+
+    async def aclose(self):
+        pass
+
+
+class _LimitedProvider(Provider):
+    # A provider behind an AdaptiveLimiter, which queues callers fairly per client
+    # and absorbs 429s with its own retries
+    def __init__(self, limiter: AdaptiveLimiter):
+        self.limiter = limiter
+
+    def _cost(self, messages: List[dict], max_tokens: Optional[int]) -> float:
+        return 0
+
+    async def _limited_stream(self, open_stream: Callable[[], AsyncIterator[str]],
+                              cost: float) -> AsyncIterator[str]:
+        deadline = time.monotonic() + self.limiter.max_wait
+        for attempt in range(self.limiter.max_retries + 1):
+            try:
+                async with self.limiter.slot(cost, deadline):
+                    async for delta in open_stream():
+                        yield delta
+                return
+            except Throttled as e:
+                # 429s arrive before the first chunk, so nothing has been sent yet
+                if attempt == self.limiter.max_retries:
+                    raise Overloaded(e.retry_after, "Generation provider rate limit, try again shortly") from e
+
+
+class AzureProvider(_LimitedProvider):
+    name = "azure"
+
+    def __init__(self, client: AzureOpenAIClient, limiter: AdaptiveLimiter):
+        super().__init__(limiter)
+        self.client = client
+
+    def _cost(self, messages: List[dict], max_tokens: Optional[int]) -> float:
+        # Rough token estimate for the TPM budget: ~4 chars per token plus the completion allowance
+        return sum(len(m["content"]) for m in messages) / 4 + (max_tokens or self.client.config.max_tokens)
+
+    async def complete(self, messages: List[dict], temperature: Optional[float] = None,
+                       max_tokens: Optional[int] = None) -> str:
+        data = await self.limiter.run(lambda: self.client.chat(messages, temperature=temperature,
+                                                               max_tokens=max_tokens),
+                                      self._cost(messages, max_tokens))
+        return data.get("choices", [{}])[0].get("message", {}).get("content", "")
+
+    def stream(self, messages: List[dict], temperature: Optional[float] = None,
+               max_tokens: Optional[int] = None) -> AsyncIterator[str]:
+        return self._limited_stream(lambda: self.client.stream_chat(messages, temperature=temperature,
+                                                                    max_tokens=max_tokens),
+                                    self._cost(messages, max_tokens))
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+class CohereProvider(_LimitedProvider):
+    name = "cohere"
+
+    def __init__(self, client: CohereClient, limiter: AdaptiveLimiter):
+        super().__init__(limiter)
+        self.client = client
+
+    async def complete(self, messages: List[dict], temperature: Optional[float] = None,
+                       max_tokens: Optional[int] = None) -> str:
+        return await self.limiter.run(lambda: self.client.chat(messages, temperature=temperature,
+                                                               max_tokens=max_tokens))
+
+    def stream(self, messages: List[dict], temperature: Optional[float] = None,
+               max_tokens: Optional[int] = None) -> AsyncIterator[str]:
+        return self._limited_stream(lambda: self.client.stream_chat(messages, temperature=temperature,
+                                                                    max_tokens=max_tokens), 0)
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+class MockProvider(Provider):
+    # Offline stand-in for tests, demos and benchmarks: a canned draft after a
+    # configurable delay, failing a given fraction of calls
+    name = "mock"
+
+    def __init__(self, latency: float = 0.05, failure_rate: float = 0.0, seed: Optional[int] = None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self._rng = random.Random(seed)
+
+    def _draft(self, messages: List[dict]) -> str:
+        prompt = messages[-1]["content"].splitlines()[0] if messages else ""
+        return (f"Hello,\n\nThis is a mock draft for the request: {prompt}\n\n"
+                "It was written without calling a real model.\n\nBest regards")
+
+    async def complete(self, messages: List[dict], temperature: Optional[float] = None,
+                       max_tokens: Optional[int] = None) -> str:
+        await asyncio.sleep(self.latency)
+        if self._rng.random() < self.failure_rate:
+            raise RuntimeError("mock provider failure")
+        return self._draft(messages)
+
+    async def stream(self, messages: List[dict], temperature: Optional[float] = None,
+                     max_tokens: Optional[int] = None) -> AsyncIterator[str]:
+        text = await self.complete(messages, temperature, max_tokens)
+        for word in text.split(" "):
+            yield word + " "
+            await asyncio.sleep(0)
+
+
+class LatencyWindow:
+    # Recent latencies of one provider; calls cancelled after losing a race count
+    # with the time they had run
+    def __init__(self, size: int = 200, min_samples: int = 20):
+        self._samples = deque(maxlen=size)
+        self.min_samples = min_samples
+
+    def add(self, seconds: float):
+        self._samples.append(seconds)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if len(self._samples) < self.min_samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def _upstream_failure(exc: BaseException) -> bool:
+    # Whether an error says the provider is unhealthy. Our own limiter shedding
+    # load (Overloaded, unless it gave up on repeated 429s) and requests the
+    # provider rejected (4xx such as a content-filter 400) say nothing about it,
+    # so they must not open its circuit.
+    if isinstance(exc, Overloaded):
+        return isinstance(exc.__cause__, Throttled)
+    status = http_status(exc)
+    return status is None or status >= 500 or status in (408, 429)
+
+
+class _Route:
+    # Per-provider routing state: circuit breaker plus latency history for
+    # whole completions and for the first streamed chunk
+    def __init__(self, provider: Provider, breaker: CircuitBreaker, window: int):
+        self.provider = provider
+        self.breaker = breaker
+        self.total = LatencyWindow(window)
+        self.first_chunk = LatencyWindow(window)
+
+
+class ProviderRouter:
+    # Sends each generation to the first provider whose circuit is closed. If it
+    # hasn't answered within its own rolling `hedge_percentile` latency (clamped to
+    # [hedge_min_delay, hedge_max_delay]; hedge_initial_delay until enough samples
+    # exist), the next provider is started too and the first answer wins. A
+    # provider that fails outright is failed over immediately. Streams are hedged
+    # on time to first chunk and stick to the winner after that.
+    def __init__(self, providers: List[Provider], hedge_percentile: float = 0.95,
+                 hedge_initial_delay: float = 8.0, hedge_min_delay: float = 0.5, hedge_max_delay: float = 20.0,
+                 window: int = 200, breaker_failures: int = 5, breaker_reset: float = 30):
+        self.routes = [_Route(p, CircuitBreaker(breaker_failures, breaker_reset), window) for p in providers]
+        self.hedge_percentile = hedge_percentile
+        self.hedge_initial_delay = hedge_initial_delay
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_max_delay = hedge_max_delay
+        self.stats = {"hedged": 0, "hedge_wins": 0, "failovers": 0}
+
+    @property
+    def configured(self) -> bool:
+        return bool(self.routes)
+
+    def _hedge_delay(self, window: LatencyWindow) -> float:
+        p = window.percentile(self.hedge_percentile)
+        if p is None:
+            return self.hedge_initial_delay
+        return min(self.hedge_max_delay, max(self.hedge_min_delay, p))
+
+    def _candidates(self) -> List[_Route]:
+        candidates = [r for r in self.routes if r.breaker.allow()]
+        if not candidates:
+            retry = min(r.breaker.retry_after() for r in self.routes) if self.routes else 30
+            raise Overloaded(max(1.0, retry), "All generation providers are failing, try again shortly")
+        return candidates
+
+    async def _race(self, attempt: Callable[[_Route], Awaitable], window: Callable[[_Route], LatencyWindow],
+                    discard: Optional[Callable[[object], Awaitable]] = None) -> Tuple[_Route, object]:
+        # Runs attempt(route) on the candidates with hedging and failover; returns the
+        # first success. Losers are cancelled, and their results (if any) discarded.
+        queue = self._candidates()
+        primary = queue[0]
+        running = {}  # task -> (route, started)
+
+        def launch():
+            route = queue.pop(0)
+            running[asyncio.ensure_future(attempt(route))] = (route, time.perf_counter())
+            return route
+
+        last = launch()
+        errors = []
+        winner = None
+        hedged = False
+        try:
+            while running:
+                timeout = self._hedge_delay(window(last)) if queue else None
+                done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedged = True
+                    self.stats["hedged"] += 1
+                    HEDGES.labels("started").inc()
+                    last = launch()
+                    continue
+                for task in done:
+                    route, started = running.pop(task)
+                    elapsed = time.perf_counter() - started
+                    if task.exception() is None and winner is None:
+                        winner = (route, task.result())
+                        route.breaker.record_success()
+                        window(route).add(elapsed)
+                        PROVIDER_SECONDS.labels(route.provider.name).observe(elapsed)
+                        PROVIDER_CALLS.labels(route.provider.name, "ok").inc()
+                        if hedged and route is not primary:
+                            HEDGES.labels("won").inc()
+                            self.stats["hedge_wins"] += 1
+                    elif task.exception() is None:
+                        route.breaker.release()
+                        if discard is not None:
+                            await discard(task.result())
+                    else:
+                        errors.append(task.exception())
+                        if _upstream_failure(task.exception()):
+                            route.breaker.record_failure()
+                        else:
+                            route.breaker.release()
+                        PROVIDER_CALLS.labels(route.provider.name, type(task.exception()).__name__).inc()
+                if winner is not None:
+                    return winner
+                if not running and queue:
+                    self.stats["failovers"] += 1
+                    last = launch()
+            raise errors[0]
+        finally:
+            for task, (route, started) in running.items():
+                task.cancel()
+                route.breaker.release()
+                # It took at least this long; leaving it out would bias the percentile low
+                window(route).add(time.perf_counter() - started)
+            for route in queue:
+                route.breaker.release()
+
+    async def complete(self, messages: List[dict], temperature: Optional[float] = None,
+                       max_tokens: Optional[int] = None) -> str:
+        _, text = await self._race(lambda r: r.provider.complete(messages, temperature, max_tokens),
+                                   lambda r: r.total)
+        return text
+
+    async def stream(self, messages: List[dict], temperature: Optional[float] = None,
+                     max_tokens: Optional[int] = None) -> AsyncIterator[str]:
+        async def first_chunk(route: _Route):
+            chunks = route.provider.stream(messages, temperature, max_tokens)
+            try:
+                return chunks, await chunks.__anext__()
+            except StopAsyncIteration:
+                return chunks, None
+            except BaseException:
+                await chunks.aclose()
+                raise
+
+        async def discard(result):
+            await result[0].aclose()
+
+        route, (chunks, first) = await self._race(first_chunk, lambda r: r.first_chunk, discard)
+        try:
+            if first is None:
+                return
+            yield first
+            async for delta in chunks:
+                yield delta
+        except Exception as e:
+            if _upstream_failure(e):
+                route.breaker.record_failure()
+            raise
+        finally:
+            await chunks.aclose()
+
+    async def aclose(self):
+        for route in self.routes:
+            await route.provider.aclose()
+
+    def snapshot(self) -> dict:
+        def ms(value):
+            return None if value is None else round(value * 1000)
+        return {
+            **self.stats,
+            "providers": [{
+                "name": r.provider.name,
+                "circuit": r.breaker.state,
+                "opened": r.breaker.stats["opened"],
+                "p50_ms": ms(r.total.percentile(0.5)),
+                "hedge_after_ms": ms(self._hedge_delay(r.total)),
+            } for r in self.routes],
+        }
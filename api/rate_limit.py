@@ -0,0 +1,55 @@
+import time
+from itertools import islice
+from typing import Dict, Hashable
+
+# Standard library only: the Telegram bot imports this module from the API
+# directory for its per-chat limits, without loading the rest of the API.
+
+
+class RateLimiter:
+    # Token bucket per client (an API client, or a chat in the bot): `rate` tokens
+    # a minute, holding at most `burst`. A request may cost more than one token (a
+    # batch); it is admitted once the bucket holds min(cost, burst) tokens and may
+    # leave it in debt, which the client then waits off.
+    def __init__(self, rate: float, burst: float, max_clients: int = 10000):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.max_clients = max_clients
+        self._buckets: Dict[Hashable, list] = {}  # client -> [tokens, last seen], least recently seen first
+        self.stats = {"allowed": 0, "throttled": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def take(self, client: Hashable, cost: float = 1) -> float:
+        # 0 when admitted (tokens are taken); otherwise seconds until it would be
+        if not self.enabled:
+            return 0.0
+        now = time.monotonic()
+        bucket = self._buckets.pop(client, None)
+        if bucket is None:
+            if len(self._buckets) >= self.max_clients:
+                self._prune()
+            bucket = [self.burst, now]
+        self._buckets[client] = bucket  # now the most recently seen
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate / 60)
+        bucket[1] = now
+        needed = min(cost, self.burst)
+        if bucket[0] < needed:
+            self.stats["throttled"] += 1
+            return (needed - bucket[0]) * 60 / self.rate
+        bucket[0] -= cost
+        self.stats["allowed"] += 1
+        return 0.0
+
+    def _prune(self):
+        # Forgets the clients seen least recently, whatever their balance, so many
+        # one-off clients can't grow the table; a forgotten client starts full again
+        excess = len(self._buckets) - self.max_clients + 1
+        # A tenth at a time, so a steady stream of new clients doesn't prune on every call
+        for client in list(islice(self._buckets, max(excess, len(self._buckets) // 10))):
+            del self._buckets[client]
+
+    def snapshot(self) -> dict:
+        return {"per_minute": self.rate, "burst": self.burst, "clients": len(self._buckets), **self.stats}
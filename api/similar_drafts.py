@@ -0,0 +1,176 @@
+import hashlib, random, re, threading, time
+from collections import OrderedDict
+from typing import Dict, FrozenSet, List, Optional, Set, Tuple
+
+# Words that carry no topic on their own
+_STOPWORDS = frozenset("""
+a an and are as at be by for from in into is it its of on or our re regarding the this to with about
+please email mail write request my your we i you me us
+""".split())
+_MERSENNE = (1 << 61) - 1
+# Fields that end up verbatim in the email: a draft is only reused as-is if they match
+_VERBATIM = ("name", "position", "recipient_name")
+
+
+def topic_tokens(text: str) -> FrozenSet[str]:
+    # Bag of normalized words: case-folded, stopwords dropped, plural "s" trimmed,
+    # so "Q3 project status updates" and "project update for Q3" share most tokens
+    tokens = set()
+    for word in re.findall(r"\w+", text.casefold()):
+        if word in _STOPWORDS:
+            continue
+        if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        tokens.add(word)
+    return frozenset(tokens)
+
+
+def estimate_tokens(text: str) -> int:
+    # Same rough rule the Azure limiter budgets with: ~4 characters per token
+    return len(text) // 4
+
+
+def _fold(value: str) -> str:
+    return " ".join(str(value).split()).casefold()
+
+
+class Match:
+    def __init__(self, draft: dict, reusable: bool, topic: str):
+        self.draft = draft
+        self.reusable = reusable  # same verbatim fields, so the draft can be returned as-is
+        self.topic = topic
+
+
+class _Entry:
+    __slots__ = ("key", "group", "verbatim", "topic", "tokens", "bands", "draft", "expires")
+
+    def __init__(self, key, group, verbatim, topic, tokens, bands, draft, expires):
+        self.key = key
+        self.group = group
+        self.verbatim = verbatim
+        self.topic = topic
+        self.tokens = tokens
+        self.bands = bands
+        self.draft = draft
+        self.expires = expires
+
+
+class SimilarDrafts:
+    # In-memory index of past drafts for near-duplicate topics. Each topic gets a
+    # MinHash signature; locality-sensitive hashing over `bands` bands finds
+    # candidates with the same role, tone and temperature, and the best one is
+    # kept if the exact Jaccard similarity of the topic words reaches `threshold`.
+    # Oldest entries are evicted past max_entries, and entries expire after ttl.
+    def __init__(self, mode: str = "off", threshold: float = 0.75, max_entries: int = 2000, ttl: float = 86400,
+                 num_perm: int = 64, bands: int = 16):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.mode = mode  # "off", "reuse" (return matching drafts) or "revise" (also rewrite close ones)
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.bands = bands
+        self._rows = num_perm // bands
+        rng = random.Random(1)
+        self._perms = [(rng.randrange(1, _MERSENNE), rng.randrange(0, _MERSENNE)) for _ in range(num_perm)]
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._buckets: Dict[Tuple, Set[str]] = {}
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.reused = 0
+        self.revised = 0
+        self.tokens_saved = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode in ("reuse", "revise") and self.max_entries > 0
+
+    def _signature(self, tokens: FrozenSet[str]) -> List[int]:
+        hashes = [int.from_bytes(hashlib.blake2b(t.encode(), digest_size=8).digest(), "big") for t in tokens]
+        return [min((a * h + b) % _MERSENNE for h in hashes) for a, b in self._perms]
+
+    def _bands(self, group: Tuple, tokens: FrozenSet[str]) -> List[Tuple]:
+        sig = self._signature(tokens)
+        return [(group, i, tuple(sig[i * self._rows:(i + 1) * self._rows])) for i in range(self.bands)]
+
+    @staticmethod
+    def _keys(fields: dict) -> Tuple[Tuple, Tuple]:
+        # Temperature too: a high-temperature batch variant must not get a draft written at 0
+        group = (_fold(fields["role"]), _fold(fields["tone"]), round(float(fields.get("temperature") or 0), 2))
+        verbatim = tuple(" ".join(str(fields.get(k, "")).split()) for k in _VERBATIM)
+        return group, verbatim
+
+    def lookup(self, fields: dict) -> Optional[Match]:
+        tokens = topic_tokens(fields["topic"])
+        if not tokens:
+            return None
+        group, verbatim = self._keys(fields)
+        now = time.time()
+        with self._lock:
+            self.lookups += 1
+            candidates = set()
+            for band in self._bands(group, tokens):
+                candidates |= self._buckets.get(band, set())
+            best, best_score = None, 0.0
+            for key in candidates:
+                entry = self._entries.get(key)
+                if entry is None or entry.expires < now:
+                    continue
+                score = len(tokens & entry.tokens) / len(tokens | entry.tokens)
+                # Prefer drafts that can be reused as-is over slightly closer ones that can't
+                rank = (entry.verbatim == verbatim, score)
+                if score >= self.threshold and (best is None or rank > (best.verbatim == verbatim, best_score)):
+                    best, best_score = entry, score
+            if best is None:
+                return None
+            reusable = best.verbatim == verbatim
+            if not reusable and self.mode != "revise":
+                return None
+            self._entries.move_to_end(best.key)
+            return Match(best.draft, reusable, best.topic)
+
+    def add(self, key: str, fields: dict, draft: dict):
+        tokens = topic_tokens(fields["topic"])
+        if not tokens:
+            return
+        group, verbatim = self._keys(fields)
+        entry = _Entry(key, group, verbatim, fields["topic"], tokens, self._bands(group, tokens), draft,
+                       time.time() + self.ttl)
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = entry
+            for band in entry.bands:
+                self._buckets.setdefault(band, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+
+    def _drop(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for band in entry.bands:
+            bucket = self._buckets.get(band)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self._buckets[band]
+
+    def record(self, revised: bool, tokens_saved: int):
+        with self._lock:
+            if revised:
+                self.revised += 1
+            else:
+                self.reused += 1
+            self.tokens_saved += tokens_saved
+
+    def stats(self) -> dict:
+        hits = self.reused + self.revised
+        return {
+            "mode": self.mode,
+            "entries": len(self._entries),
+            "lookups": self.lookups,
+            "reused": self.reused,
+            "revised": self.revised,
+            "hit_rate": round(hits / self.lookups, 4) if self.lookups else 0.0,
+            "tokens_saved": self.tokens_saved,
+        }
@@ -0,0 +1,186 @@
+import asyncio, smtplib, threading, time
+from typing import List, Optional
+
+from metrics import SMTP_SENDS, STAGE_SECONDS
+
+
+class SMTPPool:
+    # Bounded pool of logged-in SMTP sessions. smtplib is blocking, so every
+    # network call runs in a worker thread and the event loop never waits on it.
+    def __init__(self, host: str, port: int, user: str, password: str,
+                 size: int = 4, timeout: float = 30, max_idle: float = 240, use_ssl: bool = True):
+        self.host, self.port = host, port
+        self.user, self.password = user, password
+        self.size = max(1, size)
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.use_ssl = use_ssl
+        self._idle: List[tuple] = []  # (smtp, last_used)
+        self._lock = threading.Lock()
+        self._slots: Optional[asyncio.Semaphore] = None
+        self.stats = {"connects": 0, "reuses": 0, "reconnects": 0, "sent": 0}
+
+    def _connect(self) -> smtplib.SMTP:
+        with STAGE_SECONDS.labels("smtp_connect").time():
+            if self.use_ssl:
+                smtp = smtplib.SMTP_SSL(self.host, self.port, timeout=self.timeout)
+            else:
+                smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            if self.user:
+                with STAGE_SECONDS.labels("smtp_login").time():
+                    smtp.login(self.user, self.password)
+        except Exception:
+            _quietly_close(smtp)
+            raise
+        self.stats["connects"] += 1
+        return smtp
+
+    def _checkout(self) -> smtplib.SMTP:
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                smtp, last_used = self._idle.pop()
+            if time.monotonic() - last_used > self.max_idle:
+                _quietly_close(smtp)
+                continue
+            # Gmail drops idle sessions without telling us; NOOP catches that
+            try:
+                if smtp.noop()[0] == 250:
+                    self.stats["reuses"] += 1
+                    return smtp
+            except smtplib.SMTPException:
+                pass
+            except OSError:
+                pass
+            _quietly_close(smtp)
+        return self._connect()
+
+    def _checkin(self, smtp: smtplib.SMTP):
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append((smtp, time.monotonic()))
+                return
+        _quietly_close(smtp)
+
+    def _send_sync(self, msg) -> dict:
+        smtp = self._checkout()
+        try:
+            refused = _transmit(smtp, msg)
+        except (smtplib.SMTPServerDisconnected, ConnectionError):
+            # Session died between NOOP and send; one fresh connection, then give up
+            _quietly_close(smtp)
+            self.stats["reconnects"] += 1
+            smtp = self._connect()
+            try:
+                refused = _transmit(smtp, msg)
+            except Exception:
+                _quietly_close(smtp)
+                raise
+        except smtplib.SMTPRecipientsRefused:
+            self._checkin(smtp)
+            raise
+        except Exception:
+            _quietly_close(smtp)
+            raise
+        self._checkin(smtp)
+        self.stats["sent"] += 1
+        return refused
+
+    def _send_many_sync(self, msgs) -> list:
+        # Pipeline a run of messages over one session; returns an exception (or None) per message.
+        # A message some of whose recipients were refused gets an SMTPRecipientsRefused
+        # naming them, though the server took it for the others.
+        results = []
+        try:
+            smtp = self._checkout()
+        except Exception as e:
+            return [e] * len(msgs)
+        try:
+            for msg in msgs:
+                try:
+                    refused = _transmit(smtp, msg)
+                except (smtplib.SMTPServerDisconnected, ConnectionError):
+                    _quietly_close(smtp)
+                    self.stats["reconnects"] += 1
+                    smtp = self._connect()
+                    try:
+                        refused = _transmit(smtp, msg)
+                    except Exception as e:
+                        results.append(e)
+                        continue
+                except (smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError, smtplib.SMTPSenderRefused) as e:
+                    results.append(e)
+                    continue
+                results.append(smtplib.SMTPRecipientsRefused(refused) if refused else None)
+                self.stats["sent"] += 1
+        except Exception as e:
+            # Could not (re)connect at all: fail whatever is left of this run
+            _quietly_close(smtp)
+            return results + [e] * (len(msgs) - len(results))
+        self._checkin(smtp)
+        return results
+
+    def _get_slots(self) -> asyncio.Semaphore:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.size)
+        return self._slots
+
+    async def send(self, msg) -> dict:
+        async with self._get_slots():
+            return await asyncio.to_thread(self._send_sync, msg)
+
+    async def send_many(self, msgs) -> list:
+        if not msgs:
+            return []
+        # One run per pooled session so the whole pool works the batch in parallel
+        runs = min(self.size, len(msgs))
+        chunk = -(-len(msgs) // runs)
+
+        async def run(part):
+            async with self._get_slots():
+                return await asyncio.to_thread(self._send_many_sync, part)
+
+        chunks = await asyncio.gather(*(run(msgs[i:i + chunk]) for i in range(0, len(msgs), chunk)))
+        return [result for part in chunks for result in part]
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            idle = len(self._idle)
+        return {"size": self.size, "idle": idle, **self.stats}
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for smtp, _ in idle:
+            try:
+                smtp.quit()
+            except Exception:
+                _quietly_close(smtp)
+
+
+def _quietly_close(smtp):
+    try:
+        smtp.close()
+    except Exception:
+        pass
+
+
+def describe_refused(refused: dict) -> str:
+    # {address: (code, reply)} as smtplib reports refused recipients, made readable
+    return "; ".join(f"{address}: {code} {reply.decode('utf-8', 'replace') if isinstance(reply, bytes) else reply}"
+                     for address, (code, reply) in refused.items())
+
+
+def _transmit(smtp: smtplib.SMTP, msg) -> dict:
+    # Returns the recipients the server refused while accepting the message for the rest
+    started = time.perf_counter()
+    try:
+        refused = smtp.send_message(msg)
+    except Exception as e:
+        SMTP_SENDS.labels(type(e).__name__).inc()
+        raise
+    STAGE_SECONDS.labels("smtp_send").observe(time.perf_counter() - started)
+    SMTP_SENDS.labels("ok").inc()
+    return refused
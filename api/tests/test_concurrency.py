@@ -0,0 +1,121 @@
+import asyncio
+
+import pytest
+
+from concurrency import AdaptiveLimiter, FairQueue, Overloaded, Throttled, current_client
+
+
+def test_fair_queue_round_robin():
+    queue = FairQueue()
+    for i in range(3):
+        queue.push("bulk", f"bulk-{i}")
+    queue.push("light", "light-0")
+    order = []
+    while queue.head() is not None:
+        item = queue.head()
+        order.append(item)
+        queue.remove(item.split("-")[0], item)
+    assert order == ["bulk-0", "light-0", "bulk-1", "bulk-2"]
+
+
+def test_fair_queue_weights_give_extra_turns():
+    queue = FairQueue()
+    for i in range(3):
+        queue.push("vip", f"vip-{i}", weight=2)
+        queue.push("user", f"user-{i}")
+    order = []
+    while queue.head() is not None:
+        item = queue.head()
+        order.append(item)
+        client = item.split("-")[0]
+        queue.remove(client, item, weight=2 if client == "vip" else 1)
+    assert order == ["vip-0", "vip-1", "user-0", "vip-2", "user-1", "user-2"]
+
+
+def test_fair_queue_forgets_waiters_that_give_up():
+    queue = FairQueue()
+    queue.push("a", "a-0")
+    queue.push("b", "b-0")
+    queue.remove("b", "b-0")
+    assert len(queue) == 1 and queue.clients == 1
+
+
+def test_limiter_serves_clients_round_robin():
+    limiter = AdaptiveLimiter(initial=1, max_limit=1, max_wait=5)
+    order = []
+
+    async def request(client, tag):
+        current_client.set(client)
+        await limiter.run(lambda: _record(order, tag))
+
+    async def main():
+        # bulk-0 takes the only slot; the rest queue in this order
+        tasks = [asyncio.create_task(request("bulk", f"bulk-{i}")) for i in range(3)]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(request("light", "light-0")))
+        await asyncio.gather(*tasks)
+
+    asyncio.run(main())
+    # First come first served would put light-0 last
+    assert order == ["bulk-0", "bulk-1", "light-0", "bulk-2"]
+
+
+async def _record(order, tag):
+    order.append(tag)
+    await asyncio.sleep(0.01)
+
+
+def test_limiter_halves_on_429_and_retries():
+    limiter = AdaptiveLimiter(initial=8, max_limit=8, max_wait=5)
+    calls = []
+
+    async def flaky():
+        calls.append(1)
+        if len(calls) == 1:
+            raise Throttled(0.01)
+        return "ok"
+
+    assert asyncio.run(limiter.run(flaky)) == "ok"
+    assert len(calls) == 2
+    assert limiter.stats["throttled"] == 1
+    assert limiter.limit < 8
+
+
+def test_limiter_gives_up_after_retries():
+    limiter = AdaptiveLimiter(initial=2, max_wait=5, max_retries=1)
+
+    async def always_throttled():
+        raise Throttled(0.01)
+
+    with pytest.raises(Overloaded) as raised:
+        asyncio.run(limiter.run(always_throttled))
+    assert isinstance(raised.value.__cause__, Throttled)
+
+
+def test_limiter_sheds_when_queue_is_full():
+    limiter = AdaptiveLimiter(initial=1, max_limit=1, max_queue=1, max_wait=5)
+
+    async def main():
+        slow = asyncio.create_task(limiter.run(lambda: asyncio.sleep(0.2)))
+        await asyncio.sleep(0.01)
+        waiting = asyncio.create_task(limiter.run(lambda: asyncio.sleep(0)))
+        await asyncio.sleep(0.01)
+        with pytest.raises(Overloaded):
+            await limiter.run(lambda: asyncio.sleep(0))
+        await asyncio.gather(slow, waiting)
+
+    asyncio.run(main())
+    assert limiter.stats["shed"] == 1
+
+
+def test_limiter_times_out_waiters():
+    limiter = AdaptiveLimiter(initial=1, max_limit=1, max_wait=0.05)
+
+    async def main():
+        slow = asyncio.create_task(limiter.run(lambda: asyncio.sleep(0.3)))
+        await asyncio.sleep(0.01)
+        with pytest.raises(Overloaded):
+            await limiter.run(lambda: asyncio.sleep(0))
+        await slow
+
+    asyncio.run(main())
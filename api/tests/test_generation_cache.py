@@ -0,0 +1,57 @@
+import asyncio, time
+
+from generation_cache import GenerationCache
+
+
+def test_disk_entries_survive_a_restart(tmp_path):
+    path = tmp_path / "cache.sqlite3"
+    first = GenerationCache(disk_path=path)
+    asyncio.run(first.set("k", {"email": "hi"}))
+    first.close()
+    second = GenerationCache(disk_path=path)
+    assert asyncio.run(second.get("k")) == {"email": "hi"}
+    assert second.hits == 1
+
+
+def test_disk_rows_are_capped(tmp_path):
+    cache = GenerationCache(max_entries=2, disk_path=tmp_path / "cache.sqlite3", disk_max_entries=5, prune_every=1)
+
+    async def fill():
+        for i in range(20):
+            await cache.set(f"k{i}", {"email": str(i)})
+
+    asyncio.run(fill())
+    assert cache._db.execute("SELECT COUNT(*) FROM cache").fetchone()[0] == 5
+    assert asyncio.run(cache.get("k19")) == {"email": "19"}
+    assert asyncio.run(cache.get("k0")) is None
+
+
+def test_expired_rows_are_pruned_on_write(tmp_path):
+    cache = GenerationCache(ttl=-1, disk_path=tmp_path / "cache.sqlite3", prune_every=1)
+    asyncio.run(cache.set("old", {"email": "x"}))
+    assert cache._db.execute("SELECT COUNT(*) FROM cache").fetchone()[0] == 0
+
+
+def test_disk_lookup_does_not_block_the_event_loop(tmp_path):
+    class SlowDisk(GenerationCache):
+        def _read(self, key):
+            time.sleep(0.3)
+            return super()._read(key)
+
+    cache = SlowDisk(disk_path=tmp_path / "cache.sqlite3")
+
+    async def main():
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        task = asyncio.create_task(ticker())
+        await cache.get("missing")
+        task.cancel()
+        return ticks
+
+    assert asyncio.run(main()) >= 10
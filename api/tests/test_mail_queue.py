@@ -0,0 +1,93 @@
+import asyncio, sqlite3
+from email.message import EmailMessage
+
+from mail_queue import MailQueue
+
+
+def _message(to: str = "a@example.com") -> EmailMessage:
+    msg = EmailMessage()
+    msg["To"] = to
+    msg["Subject"] = "Hi"
+    msg.set_content("Hello")
+    return msg
+
+
+def test_worker_survives_spool_errors(tmp_path, caplog):
+    sent = []
+
+    async def send(msg):
+        sent.append(msg["To"])
+
+    queue = MailQueue(tmp_path / "spool.sqlite3", send, workers=1, poll_interval=0.01)
+    claim, failures = queue._claim, []
+
+    def flaky_claim():
+        if len(failures) < 3:
+            failures.append(1)
+            raise sqlite3.OperationalError("database is locked")
+        return claim()
+
+    queue._claim = flaky_claim
+
+    async def main():
+        await queue.start()
+        job_id = await queue.enqueue(_message())
+        for _ in range(200):
+            if queue.get(job_id)["status"] == "sent":
+                break
+            await asyncio.sleep(0.01)
+        await queue.stop()
+
+    asyncio.run(main())
+    assert sent == ["a@example.com"]
+    assert len(failures) == 3
+    assert "Mail queue worker failed" in caplog.text
+
+
+def test_stop_interrupts_backoff(tmp_path):
+    async def send(msg):
+        pass
+
+    queue = MailQueue(tmp_path / "spool.sqlite3", send, workers=1, poll_interval=60, drain_timeout=5)
+
+    def broken_claim():
+        raise sqlite3.OperationalError("disk I/O error")
+
+    queue._claim = broken_claim
+
+    async def main():
+        await queue.start()
+        await asyncio.sleep(0.05)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        await queue.stop()
+        return loop.time() - started
+
+    assert asyncio.run(main()) < 1
+
+
+def test_partial_delivery_is_not_retried(tmp_path):
+    sends = []
+
+    async def send(msg):
+        sends.append(msg["To"])
+        return {"b@example.com": (550, b"No such user")}
+
+    queue = MailQueue(tmp_path / "spool.sqlite3", send, workers=1, poll_interval=0.01)
+
+    async def main():
+        await queue.start()
+        job_id = await queue.enqueue(_message("a@example.com, b@example.com"))
+        for _ in range(200):
+            if queue.get(job_id)["status"] != "queued":
+                break
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.05)
+        job = queue.get(job_id)
+        await queue.stop()
+        return job
+
+    job = asyncio.run(main())
+    assert job["status"] == "partial"
+    assert job["last_error"] == "b@example.com: 550 No such user"
+    assert sends == ["a@example.com, b@example.com"]
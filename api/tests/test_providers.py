@@ -0,0 +1,168 @@
+import asyncio, time
+
+import httpx
+import pytest
+
+from concurrency import CircuitBreaker, Overloaded, Throttled
+from providers import MockProvider, ProviderRouter
+
+MESSAGES = [{"role": "user", "content": "Write a formal email about tests."}]
+
+
+class Recording(MockProvider):
+    # MockProvider that remembers how each call ended
+    def __init__(self, name: str, latency: float = 0.0, error: BaseException = None):
+        super().__init__(latency=latency)
+        self.name = name
+        self.error = error
+        self.calls = 0
+        self.cancelled = 0
+
+    async def complete(self, messages, temperature=None, max_tokens=None):
+        self.calls += 1
+        try:
+            await asyncio.sleep(self.latency)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        if self.error is not None:
+            raise self.error
+        return f"draft from {self.name}"
+
+
+def _router(*providers, **kwargs) -> ProviderRouter:
+    options = dict(hedge_initial_delay=0.05, hedge_min_delay=0.01, breaker_failures=2, breaker_reset=0.1)
+    options.update(kwargs)
+    return ProviderRouter(list(providers), **options)
+
+
+def _status_error(status: int) -> httpx.HTTPStatusError:
+    request = httpx.Request("POST", "http://provider.invalid/chat")
+    return httpx.HTTPStatusError("error", request=request, response=httpx.Response(status, request=request))
+
+
+def test_fails_over_to_next_provider():
+    primary = Recording("primary", error=RuntimeError("down"))
+    router = _router(primary, Recording("backup"))
+    assert asyncio.run(router.complete(MESSAGES)) == "draft from backup"
+    assert router.stats["failovers"] == 1
+
+
+def test_hedge_wins_and_loser_is_cancelled():
+    slow, fast = Recording("slow", latency=1.0), Recording("fast", latency=0.01)
+    router = _router(slow, fast)
+    started = time.monotonic()
+    assert asyncio.run(router.complete(MESSAGES)) == "draft from fast"
+    assert time.monotonic() - started < 0.5
+    assert router.stats["hedged"] == 1 and router.stats["hedge_wins"] == 1
+    assert slow.cancelled == 1
+    # A cancelled loser is no verdict on its health
+    assert router.routes[0].breaker.state == "closed"
+
+
+def test_no_hedge_when_primary_answers_in_time():
+    primary, backup = Recording("primary", latency=0.01), Recording("backup")
+    router = _router(primary, backup, hedge_initial_delay=1.0)
+    assert asyncio.run(router.complete(MESSAGES)) == "draft from primary"
+    assert backup.calls == 0 and router.stats["hedged"] == 0
+
+
+def test_stream_hedge_closes_losing_stream():
+    class SlowStream(Recording):
+        closed = 0
+
+        async def stream(self, messages, temperature=None, max_tokens=None):
+            try:
+                await asyncio.sleep(1.0)
+                yield "late"
+            finally:
+                SlowStream.closed += 1
+
+    router = _router(SlowStream("slow"), MockProvider(latency=0.01))
+
+    async def collect():
+        return "".join([chunk async for chunk in router.stream(MESSAGES)])
+
+    assert "mock draft" in asyncio.run(collect())
+    assert SlowStream.closed == 1
+
+
+def test_breaker_opens_then_probes_half_open():
+    failing = Recording("failing", error=RuntimeError("down"))
+    router = _router(failing)
+    breaker = router.routes[0].breaker
+
+    async def attempts(n):
+        for _ in range(n):
+            with pytest.raises((RuntimeError, Overloaded)):
+                await router.complete(MESSAGES)
+
+    asyncio.run(attempts(2))
+    assert breaker.state == "open"
+    # While open the provider is skipped altogether
+    asyncio.run(attempts(1))
+    assert failing.calls == 2
+
+    time.sleep(0.12)
+    assert breaker.state == "half_open"
+    failing.error = None
+    assert asyncio.run(router.complete(MESSAGES)) == "draft from failing"
+    assert breaker.state == "closed"
+
+
+def test_failed_probe_reopens_circuit():
+    breaker = CircuitBreaker(failures=1, reset_timeout=0.05)
+    breaker.record_failure()
+    assert breaker.state == "open" and not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert not breaker.allow()  # only one probe at a time
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert breaker.stats["opened"] == 2
+
+
+@pytest.mark.parametrize("error", [
+    Overloaded(1.0),
+    _status_error(400),
+    _status_error(404),
+])
+def test_local_shedding_and_rejected_requests_leave_circuit_closed(error):
+    provider = Recording("primary", error=error)
+    router = _router(provider, breaker_failures=1)
+    with pytest.raises(type(error)):
+        asyncio.run(router.complete(MESSAGES))
+    assert router.routes[0].breaker.state == "closed"
+
+
+@pytest.mark.parametrize("error", [
+    _status_error(500),
+    _status_error(429),
+    _status_error(408),
+    httpx.ConnectError("refused"),
+])
+def test_upstream_failures_open_circuit(error):
+    router = _router(Recording("primary", error=error), breaker_failures=1)
+    with pytest.raises(type(error)):
+        asyncio.run(router.complete(MESSAGES))
+    assert router.routes[0].breaker.state == "open"
+
+
+def test_repeated_429s_count_against_circuit():
+    try:
+        raise Overloaded(1.0) from Throttled(1.0)
+    except Overloaded as e:
+        error = e
+    router = _router(Recording("primary", error=error), breaker_failures=1)
+    with pytest.raises(Overloaded):
+        asyncio.run(router.complete(MESSAGES))
+    assert router.routes[0].breaker.state == "open"
+
+
+def test_all_circuits_open_raises_overloaded():
+    router = _router(Recording("a", error=RuntimeError("down")), breaker_failures=1, breaker_reset=30)
+    with pytest.raises(RuntimeError):
+        asyncio.run(router.complete(MESSAGES))
+    with pytest.raises(Overloaded) as raised:
+        asyncio.run(router.complete(MESSAGES))
+    assert raised.value.retry_after >= 1
@@ -0,0 +1,35 @@
+from rate_limit import RateLimiter
+
+
+def test_burst_then_wait():
+    limits = RateLimiter(rate=60, burst=2)
+    assert limits.take("a") == 0 and limits.take("a") == 0
+    wait = limits.take("a")
+    assert 0 < wait <= 1
+    assert limits.take("b") == 0  # buckets are per client
+    assert limits.stats == {"allowed": 3, "throttled": 1}
+
+
+def test_batch_may_leave_bucket_in_debt():
+    limits = RateLimiter(rate=60, burst=2)
+    assert limits.take("a", cost=5) == 0
+    assert limits.take("a") > 3
+
+
+def test_disabled_when_rate_is_zero():
+    limits = RateLimiter(rate=0, burst=5)
+    assert not limits.enabled
+    assert all(limits.take("a") == 0 for _ in range(100))
+
+
+def test_least_recently_seen_clients_are_forgotten():
+    limits = RateLimiter(rate=1, burst=5, max_clients=100)
+    limits.take("regular")
+    # One-off clients each leave a partly drained bucket behind
+    for i in range(1000):
+        limits.take(f"one-off-{i}")
+        if i % 50 == 0:
+            limits.take("regular")
+    assert len(limits._buckets) <= 100
+    assert "regular" in limits._buckets
+    assert "one-off-0" not in limits._buckets
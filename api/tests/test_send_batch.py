@@ -0,0 +1,76 @@
+import asyncio, smtplib
+
+import pytest
+from fastapi.testclient import TestClient
+
+import app
+
+
+class FakePool:
+    def __init__(self):
+        self.sent = []
+
+    async def send_many(self, msgs):
+        self.sent.extend(msgs)
+        return [None] * len(msgs)
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setattr(app, "GMAIL_USER", "sender@example.com")
+    monkeypatch.setattr(app, "GMAIL_PASS", "secret")
+    fake = FakePool()
+    monkeypatch.setattr(app, "get_smtp_pool", lambda: fake)
+    return fake
+
+
+def _post(recipients: str):
+    return TestClient(app.app).post("/send-batch", data={"subject": "Hi", "body": "Hello {recipient_name}",
+                                                          "recipients": recipients})
+
+
+@pytest.mark.parametrize("recipients", [
+    '"abc"',
+    '{"a@example.com": 1, "b@example.com": 2}',
+    "[]",
+    "not json",
+    '[42]',
+    '[{"name": "Ana"}]',
+    '["a@example.com", "not-an-address"]',
+    '[{"email": "a@example.com\\nBcc: x@example.com"}]',
+])
+def test_rejects_bad_recipients_before_sending(pool, recipients):
+    response = _post(recipients)
+    assert response.status_code == 400
+    assert pool.sent == []
+
+
+def test_sends_to_addresses_and_objects(pool):
+    response = _post('["a@example.com", {"email": "b@example.com", "recipient_name": "Ben"}]')
+    assert response.status_code == 200
+    assert [r["to"] for r in response.json()["results"]] == ["a@example.com", "b@example.com"]
+    assert "Hello Ben" in pool.sent[1].get_content()
+
+
+def test_reports_refused_recipients_as_failed(pool):
+    async def send_many(msgs):
+        return [None, smtplib.SMTPRecipientsRefused({"b@example.com": (550, b"No such user")})]
+
+    pool.send_many = send_many
+    results = _post('["a@example.com", "b@example.com"]').json()["results"]
+    assert [r["status"] for r in results] == ["sent", "failed"]
+    assert "b@example.com: 550 No such user" in results[1]["error"]
+
+
+def test_send_email_reports_partial_delivery(monkeypatch):
+    monkeypatch.setattr(app, "GMAIL_USER", "sender@example.com")
+    monkeypatch.setattr(app, "GMAIL_PASS", "secret")
+
+    class Pool:
+        async def send(self, msg):
+            return {"b@example.com": (550, b"No such user")}
+
+    monkeypatch.setattr(app, "get_smtp_pool", lambda: Pool())
+    result = asyncio.run(app.deliver("a@example.com, b@example.com", "Hi", "Hello"))
+    assert result["status"] == "partial"
+    assert result["refused"] == "b@example.com: 550 No such user"
@@ -0,0 +1,43 @@
+import smtplib
+from email.message import EmailMessage
+
+from smtp_pool import SMTPPool, describe_refused
+
+
+class FakeSMTP:
+    def __init__(self, refusals):
+        self.refusals = refusals
+
+    def send_message(self, msg):
+        return self.refusals.get(msg["To"], {})
+
+    def close(self):
+        pass
+
+
+def _message(to: str) -> EmailMessage:
+    msg = EmailMessage()
+    msg["To"] = to
+    msg.set_content("Hello")
+    return msg
+
+
+def _pool(refusals) -> SMTPPool:
+    pool = SMTPPool("localhost", 465, "", "")
+    smtp = FakeSMTP(refusals)
+    pool._checkout = lambda: smtp
+    return pool
+
+
+def test_send_returns_refused_recipients():
+    pool = _pool({"a@example.com, b@example.com": {"b@example.com": (550, b"No such user")}})
+    refused = pool._send_sync(_message("a@example.com, b@example.com"))
+    assert describe_refused(refused) == "b@example.com: 550 No such user"
+
+
+def test_send_many_marks_refused_recipients():
+    pool = _pool({"b@example.com": {"b@example.com": (550, b"No such user")}})
+    results = pool._send_many_sync([_message("a@example.com"), _message("b@example.com")])
+    assert results[0] is None
+    assert isinstance(results[1], smtplib.SMTPRecipientsRefused)
+    assert results[1].recipients == {"b@example.com": (550, b"No such user")}
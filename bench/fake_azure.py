@@ -0,0 +1,84 @@
+import argparse, asyncio, json, os, random
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# Stand-in for Azure OpenAI chat completions. Behaviour comes from env vars so
+# the benchmark runner can configure a subprocess:
+#   FAKE_AZURE_LATENCY      seconds before the first byte (default 0.3)
+#   FAKE_AZURE_JITTER       +/- fraction applied to the latency (default 0.2)
+#   FAKE_AZURE_TOKENS       completion length in words (default 120)
+#   FAKE_AZURE_CHUNK_DELAY  seconds between streamed chunks (default 0.01)
+#   FAKE_AZURE_429_RATE     fraction of requests answered with 429 (default 0)
+#   FAKE_AZURE_RETRY_MS     retry-after-ms sent with a 429 (default 200)
+#   FAKE_AZURE_SEED         RNG seed, so runs are repeatable (default 1)
+
+LATENCY = float(os.getenv("FAKE_AZURE_LATENCY", "0.3"))
+JITTER = float(os.getenv("FAKE_AZURE_JITTER", "0.2"))
+TOKENS = int(os.getenv("FAKE_AZURE_TOKENS", "120"))
+CHUNK_DELAY = float(os.getenv("FAKE_AZURE_CHUNK_DELAY", "0.01"))
+RATE_429 = float(os.getenv("FAKE_AZURE_429_RATE", "0"))
+RETRY_MS = int(os.getenv("FAKE_AZURE_RETRY_MS", "200"))
+
+rng = random.Random(int(os.getenv("FAKE_AZURE_SEED", "1")))
+stats = {"requests": 0, "streamed": 0, "throttled": 0}
+
+app = FastAPI()
+
+_WORDS = ("thank you for your time we would like to discuss the project update and "
+          "share the next steps with the team before the meeting on friday").split()
+
+
+def _completion(messages: list) -> list:
+    # Deterministic per prompt, so identical requests get identical drafts
+    seed = sum(len(m.get("content", "")) for m in messages)
+    return [_WORDS[(seed + i * 7) % len(_WORDS)] for i in range(TOKENS)]
+
+
+@app.post("/openai/deployments/{deployment}/chat/completions")
+async def chat_completions(deployment: str, request: Request):
+    body = await request.json()
+    stats["requests"] += 1
+    if RATE_429 and rng.random() < RATE_429:
+        stats["throttled"] += 1
+        return JSONResponse(status_code=429, headers={"retry-after-ms": str(RETRY_MS)},
+                            content={"error": {"code": "429", "message": "Rate limit is exceeded."}})
+    await asyncio.sleep(LATENCY * rng.uniform(1 - JITTER, 1 + JITTER))
+    words = _completion(body.get("messages", []))
+    text = "Dear Sir/Madam,\n\n" + " ".join(words)
+    usage = {"prompt_tokens": sum(len(m.get("content", "")) // 4 for m in body.get("messages", [])),
+             "completion_tokens": len(words)}
+    usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+
+    if not body.get("stream"):
+        return {"object": "chat.completion", "model": deployment, "usage": usage,
+                "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": text}}]}
+
+    stats["streamed"] += 1
+
+    async def chunks():
+        pieces = text.split(" ")
+        for i, piece in enumerate(pieces):
+            delta = piece if i == 0 else " " + piece
+            event = {"object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {"content": delta}}]}
+            yield f"data: {json.dumps(event)}\n\n"
+            if CHUNK_DELAY:
+                await asyncio.sleep(CHUNK_DELAY)
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(chunks(), media_type="text/event-stream")
+
+
+@app.get("/stats")
+def get_stats():
+    return stats
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Fake Azure OpenAI server for benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8711)
+    args = parser.parse_args()
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,505 @@
+import argparse, asyncio, itertools, json, os, platform, random, socket, subprocess, sys, tempfile, time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import httpx
+
+from smtp_sink import SMTPSink
+
+# Offline load test: starts the fake Azure server and an SMTP sink, runs the API
+# against them in a subprocess, then drives each scenario at a fixed concurrency
+# and prints one JSON report. Pass --baseline with an earlier report to fail
+# (exit 1) on regressions, e.g. in CI.
+
+BENCH_DIR = Path(__file__).resolve().parent
+ROOT_DIR = BENCH_DIR.parent
+API_DIR = ROOT_DIR / "api"
+BOT_DIR = ROOT_DIR / "telegram_bot"
+# Shared with the API so the fair-scheduling scenario may name its clients
+CLIENT_SECRET = "bench"
+
+SCENARIOS = ["generate", "generate_stream", "generate_fair", "send", "send_attachments", "bot_generate", "bot_send"]
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def _wait_for(url: str, proc: subprocess.Popen, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if proc.poll() is not None:
+                raise RuntimeError(f"{proc.args} exited with {proc.returncode}")
+            try:
+                await client.get(url, timeout=1)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.1)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+def _peak_rss_mb(pid: Optional[int] = None) -> Optional[float]:
+    # VmHWM is the resident-set high-water mark; only Linux has it
+    try:
+        with open(f"/proc/{pid or 'self'}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    if pid is None:
+        try:
+            import resource
+            return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+        except ImportError:
+            pass
+    return None
+
+
+def _percentile(values: List[float], q: float) -> float:
+    # Linear interpolation between closest ranks (same as numpy's default)
+    if not values:
+        return 0.0
+    pos = (len(values) - 1) * q
+    lo = int(pos)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+
+def _latency_summary(samples: List[float]) -> dict:
+    values = sorted(s * 1000 for s in samples)
+    return {
+        "p50": round(_percentile(values, 0.50), 2),
+        "p95": round(_percentile(values, 0.95), 2),
+        "p99": round(_percentile(values, 0.99), 2),
+        "mean": round(sum(values) / len(values), 2) if values else 0.0,
+        "max": round(values[-1], 2) if values else 0.0,
+    }
+
+
+class Scenario:
+    # One named workload. call(i) performs request i and returns an outcome label
+    # ("ok" or an HTTP status / exception name); it may report time to first
+    # byte through the ttfb list. background(), if given, runs alongside the
+    # measured requests (after warmup) and is cancelled when they finish; it can
+    # add to the report through extra.
+    def __init__(self, name: str, call: Callable[[int], Awaitable[str]],
+                 background: Optional[Callable[[], Awaitable]] = None):
+        self.name = name
+        self.call = call
+        self.background = background
+        self.ttfb: List[float] = []
+        self.extra: dict = {}
+
+    async def run(self, requests: int, concurrency: int, warmup: int) -> dict:
+        for i in range(warmup):
+            await self._timed(-1 - i)
+        self.ttfb.clear()
+
+        slots = asyncio.Semaphore(concurrency)
+        latencies: List[float] = []
+        outcomes: Dict[str, int] = {}
+
+        async def one(i: int):
+            async with slots:
+                elapsed, outcome = await self._timed(i)
+            latencies.append(elapsed)
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+        load = None
+        if self.background is not None:
+            load = asyncio.ensure_future(self.background())
+            await asyncio.sleep(1)  # let it fill the queues first
+        started = time.perf_counter()
+        try:
+            await asyncio.gather(*(one(i) for i in range(requests)))
+        finally:
+            if load is not None:
+                load.cancel()
+                await asyncio.gather(load, return_exceptions=True)
+        wall = time.perf_counter() - started
+
+        errors = requests - outcomes.get("ok", 0)
+        result = {
+            "requests": requests,
+            "concurrency": concurrency,
+            "duration_s": round(wall, 3),
+            "throughput_rps": round(requests / wall, 2) if wall else 0.0,
+            "errors": errors,
+            "error_rate": round(errors / requests, 4) if requests else 0.0,
+            "outcomes": outcomes,
+            "latency_ms": _latency_summary(latencies),
+        }
+        if self.ttfb:
+            result["ttfb_ms"] = _latency_summary(self.ttfb)
+        return {**result, **self.extra}
+
+    async def _timed(self, i: int):
+        started = time.perf_counter()
+        try:
+            outcome = await self.call(i)
+        except Exception as e:
+            outcome = type(e).__name__
+        return time.perf_counter() - started, outcome
+
+
+def _fields(tag: str, i: int) -> dict:
+    # A distinct topic per scenario and request, so the generation cache can't answer for Azure
+    return {"role": "developer", "tone": "formal", "topic": f"{tag} request {i}", "subject": "auto",
+            "name": "Bench", "position": "Backend Developer", "recipient_name": "Dear Team"}
+
+
+def _client_headers(client: str) -> dict:
+    # The API only takes X-Client-Id from callers that know CLIENT_ID_SECRET
+    return {"X-Client-Id": client, "X-Client-Secret": CLIENT_SECRET}
+
+
+def _attachments(kb: int, seed: int) -> List[tuple]:
+    # One compressible document and one incompressible blob, identical on every run
+    rng = random.Random(seed)
+    rows = "\n".join(f"{n},{rng.randint(0, 10 ** 6)},benchmark row" for n in range(kb * 1024 // 24))
+    return [("report.csv", rows.encode(), "text/csv"),
+            ("blob.bin", rng.randbytes(kb * 1024), "application/octet-stream")]
+
+
+def api_scenarios(client: httpx.AsyncClient, args) -> List[Scenario]:
+    files = _attachments(args.attachment_kb, args.seed)
+
+    def outcome(r: httpx.Response) -> str:
+        return "ok" if r.is_success else str(r.status_code)
+
+    async def generate(i):
+        return outcome(await client.post("/generate-email", data=_fields("generate", i)))
+
+    stream = Scenario("generate_stream", None)
+
+    async def generate_stream(i):
+        started = time.perf_counter()
+        first = True
+        async with client.stream("POST", "/generate-email/stream", data=_fields("stream", i)) as r:
+            if not r.is_success:
+                return str(r.status_code)
+            event = None
+            async for line in r.aiter_lines():
+                if line.startswith("event:"):
+                    event = line[6:].strip()
+                    if event == "delta" and first:
+                        stream.ttfb.append(time.perf_counter() - started)
+                        first = False
+                    elif event == "error":
+                        return "stream_error"
+            return "ok" if event == "done" else "incomplete"
+
+    stream.call = generate_stream
+
+    # Light clients, one request each, measured while a single bulk client keeps
+    # --bulk-concurrency generations queued; with fair scheduling their latency
+    # should stay close to the plain generate scenario
+    fair = Scenario("generate_fair", None)
+
+    async def generate_fair(i):
+        r = await client.post("/generate-email", data=_fields("fair", i), headers=_client_headers(f"light-{i}"))
+        return outcome(r)
+
+    async def bulk_load():
+        counter = itertools.count()
+        outcomes = fair.extra.setdefault("bulk_outcomes", {})
+        limits = httpx.Limits(max_connections=args.bulk_concurrency, max_keepalive_connections=args.bulk_concurrency)
+
+        async def worker(bulk):
+            while True:
+                try:
+                    r = await bulk.post("/generate-email", data=_fields("bulk", next(counter)),
+                                        headers=_client_headers("bulk"))
+                    result = outcome(r)
+                except httpx.HTTPError as e:
+                    result = type(e).__name__
+                outcomes[result] = outcomes.get(result, 0) + 1
+
+        # Its own connection pool, so the bulk client can't hold up the light ones on our side
+        async with httpx.AsyncClient(base_url=client.base_url, limits=limits, timeout=120) as bulk:
+            await asyncio.gather(*(worker(bulk) for _ in range(args.bulk_concurrency)))
+
+    fair.call, fair.background = generate_fair, bulk_load
+
+    def message(i) -> dict:
+        return {"recipient": f"user{i}@example.com", "subject": f"Benchmark {i}", "body": "Hello from the benchmark."}
+
+    async def send(i):
+        return outcome(await client.post("/send-email", data=message(i)))
+
+    async def send_attachments(i):
+        upload = [("attachments", (name, data, mime)) for name, data, mime in files]
+        return outcome(await client.post("/send-email", data=message(i), files=upload))
+
+    return [Scenario("generate", generate), stream, fair, Scenario("send", send),
+            Scenario("send_attachments", send_attachments)]
+
+
+# --- Bot handlers, driven with stand-ins for the Telegram objects -------------
+
+class _Message:
+    def __init__(self, text: str = ""):
+        self.text = text
+        self.document = None
+        self.photo = ()
+        self.media_group_id = None
+
+    async def reply_text(self, text, **kwargs):
+        return _Message(text)
+
+    async def edit_text(self, text, **kwargs):
+        self.text = text
+        return self
+
+
+class _Ident:
+    def __init__(self, id: int):
+        self.id = id
+
+
+class _Update:
+    def __init__(self, user_id: int, text: str = ""):
+        self.message = self.effective_message = _Message(text)
+        self.effective_user = _Ident(user_id)
+        self.effective_chat = _Ident(user_id)
+
+
+class _Application:
+    def __init__(self):
+        self.bot_data = {}
+        self.persistence = None
+
+    def create_task(self, coro, update=None, name=None):
+        return asyncio.ensure_future(coro)
+
+
+class _Context:
+    def __init__(self, application: _Application, user_data: dict):
+        self.application = application
+        self.bot_data = application.bot_data
+        self.user_data = user_data
+
+
+async def bot_scenarios(args, api_base: str, api_env: dict):
+    # Imports bot.py with its env pointed at the benchmark API; returns the
+    # scenarios and a coroutine function that shuts the bot's services down.
+    os.environ.update({"API_BASE": api_base, "CLIENT_ID_SECRET": api_env["CLIENT_ID_SECRET"], "FILE_CACHE_MAX_BYTES": "0",
+                       "BOT_BACKEND": args.bot_backend, "BOT_STREAMING": str(args.bot_streaming),
+                       "STREAM_EDIT_INTERVAL": "0.2"})
+    if args.bot_backend == "inprocess":
+        os.environ.update(api_env)
+    sys.path.insert(0, str(BOT_DIR))
+    import bot
+
+    application = _Application()
+    await bot._startup(application)
+    store = application.bot_data["attachments"]
+    name, data, mime = _attachments(args.attachment_kb, args.seed)[0]
+    user_data = {"role": "developer", "name": "Bench", "position": "Backend Developer", "tone": "formal",
+                 "recipient_name": "Dear Team"}
+
+    async def bot_generate(i):
+        context = _Context(application, {**user_data, "topic": f"bot benchmark {i}",
+                                         "recipient": f"user{i}@example.com"})
+        state = await bot.get_subject(_Update(i, "auto"), context)
+        return "ok" if state == bot.CONFIRM and not context.user_data["generated_email"].startswith("⚠️") else "failed"
+
+    async def bot_send(i):
+        owner = 10 ** 6 + i
+        attachment = store.open(owner, name, mime, len(data))
+        attachment.fileobj.write(data)
+        store.add(attachment)
+        update = _Update(owner, "Send now")
+        replies = []
+
+        async def reply_text(text, **kwargs):
+            replies.append(text)
+            return _Message(text)
+
+        update.message.reply_text = reply_text
+        context = _Context(application, {**user_data, "topic": "bot send", "recipient": f"user{i}@example.com",
+                                         "generated_email": "Hello from the benchmark.",
+                                         "generated_subject": f"Benchmark {i}"})
+        await bot._send_now(update, context)
+        return "ok" if replies and replies[-1].startswith(("✅", "📬")) else "failed"
+
+    return [Scenario("bot_generate", bot_generate), Scenario("bot_send", bot_send)], lambda: bot._shutdown(application)
+
+
+# --- Runner ------------------------------------------------------------------
+
+def _git_commit() -> Optional[str]:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, capture_output=True,
+                             text=True, timeout=10)
+        return out.stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> List[str]:
+    # p95 latency and throughput may drift by `tolerance` (a fraction); the error
+    # rate may rise by at most one percentage point
+    regressions = []
+    for name, current in report["scenarios"].items():
+        before = baseline.get("scenarios", {}).get(name)
+        if before is None:
+            continue
+        p95, base_p95 = current["latency_ms"]["p95"], before["latency_ms"]["p95"]
+        if base_p95 and p95 > base_p95 * (1 + tolerance):
+            regressions.append(f"{name}: p95 {base_p95}ms -> {p95}ms")
+        rps, base_rps = current["throughput_rps"], before["throughput_rps"]
+        if base_rps and rps < base_rps * (1 - tolerance):
+            regressions.append(f"{name}: throughput {base_rps}/s -> {rps}/s")
+        if current["error_rate"] > before["error_rate"] + 0.01:
+            regressions.append(f"{name}: error rate {before['error_rate']} -> {current['error_rate']}")
+    return regressions
+
+
+async def run(args) -> dict:
+    selected = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(selected) - set(SCENARIOS)
+    if unknown:
+        raise SystemExit(f"Unknown scenario(s): {', '.join(sorted(unknown))}")
+
+    workdir = tempfile.TemporaryDirectory(prefix="email-bench-")
+    azure_port, smtp_port, api_port = _free_port(), _free_port(), _free_port()
+
+    sink = SMTPSink("127.0.0.1", smtp_port, delay=args.smtp_delay)
+    await sink.start()
+
+    fake_env = {
+        **os.environ,
+        "FAKE_AZURE_LATENCY": str(args.latency),
+        "FAKE_AZURE_JITTER": str(args.jitter),
+        "FAKE_AZURE_TOKENS": str(args.tokens),
+        "FAKE_AZURE_CHUNK_DELAY": str(args.chunk_delay),
+        "FAKE_AZURE_429_RATE": str(args.rate_429),
+        "FAKE_AZURE_SEED": str(args.seed),
+    }
+    fake = subprocess.Popen([sys.executable, str(BENCH_DIR / "fake_azure.py"), "--port", str(azure_port)],
+                            env=fake_env, stdout=subprocess.DEVNULL)
+
+    api_env = {
+        "AZURE_OPENAI_KEY": "bench",
+        "AZURE_OPENAI_ENDPOINT": f"http://127.0.0.1:{azure_port}/",
+        "AZURE_OPENAI_DEPLOYMENT": "bench",
+        "GMAIL_USER": "bench@example.com",
+        "GMAIL_PASS": "bench",
+        "SMTP_HOST": "127.0.0.1",
+        "SMTP_PORT": str(smtp_port),
+        "SMTP_USE_SSL": "false",
+        "DATA_DIR": workdir.name,
+        "CLIENT_ID_SECRET": CLIENT_SECRET,
+    }
+    for item in args.api_env:
+        key, _, value = item.partition("=")
+        api_env[key] = value
+    api_log = open(Path(workdir.name) / "api.log", "w")
+    api = subprocess.Popen([sys.executable, "-m", "uvicorn", "app:app", "--port", str(api_port),
+                            "--log-level", "warning"],
+                           cwd=API_DIR, env={**os.environ, **api_env}, stdout=api_log, stderr=subprocess.STDOUT)
+
+    api_base = f"http://127.0.0.1:{api_port}"
+    results, stop_bot = {}, None
+    try:
+        await _wait_for(f"http://127.0.0.1:{azure_port}/stats", fake)
+        await _wait_for(f"{api_base}/", api)
+
+        limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+        async with httpx.AsyncClient(base_url=api_base, limits=limits, timeout=120) as client:
+            scenarios = api_scenarios(client, args)
+            if any(name.startswith("bot_") for name in selected):
+                bot_list, stop_bot = await bot_scenarios(args, api_base, api_env)
+                scenarios += bot_list
+            for scenario in scenarios:
+                if scenario.name in selected:
+                    print(f"running {scenario.name} ...", file=sys.stderr)
+                    results[scenario.name] = await scenario.run(args.requests, args.concurrency, args.warmup)
+            health = (await client.get("/health")).json()
+        async with httpx.AsyncClient() as client:
+            azure_stats = (await client.get(f"http://127.0.0.1:{azure_port}/stats")).json()
+        api_rss = _peak_rss_mb(api.pid)
+    except Exception:
+        api_log.flush()
+        print((Path(workdir.name) / "api.log").read_text()[-4000:], file=sys.stderr)
+        raise
+    finally:
+        if stop_bot is not None:
+            await stop_bot()
+        for proc in (api, fake):
+            proc.terminate()
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        api_log.close()
+        await sink.close()
+        workdir.cleanup()
+
+    return {
+        "meta": {
+            "commit": _git_commit(),
+            "started": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "config": {k: v for k, v in vars(args).items() if k not in ("output", "baseline")},
+        },
+        "scenarios": results,
+        "peak_rss_mb": {"api": api_rss, "bench": _peak_rss_mb()},
+        "fake_azure": azure_stats,
+        "smtp_sink": {"messages": sink.messages, "bytes": sink.bytes, "connections": sink.connections},
+        "api_health": {k: health.get(k) for k in ("generation_cache", "azure_limiter", "providers", "rate_limits", "mail_queue")},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark for the email API and bot")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma-separated: " + ", ".join(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--warmup", type=int, default=5, help="unmeasured requests before each scenario")
+    parser.add_argument("--latency", type=float, default=0.3, help="fake Azure seconds to first byte")
+    parser.add_argument("--jitter", type=float, default=0.2, help="fake Azure latency jitter (fraction)")
+    parser.add_argument("--tokens", type=int, default=120, help="fake Azure completion length in words")
+    parser.add_argument("--chunk-delay", type=float, default=0.01, help="fake Azure seconds between stream chunks")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="fraction of Azure calls answered with 429")
+    parser.add_argument("--smtp-delay", type=float, default=0.0, help="SMTP sink seconds per message")
+    parser.add_argument("--attachment-kb", type=int, default=256, help="size of each benchmark attachment")
+    parser.add_argument("--bulk-concurrency", type=int, default=64,
+                        help="in-flight requests of the bulk client in generate_fair")
+    parser.add_argument("--bot-backend", choices=["remote", "inprocess"], default="remote")
+    parser.add_argument("--bot-streaming", type=lambda v: v.lower() == "true", default=True)
+    parser.add_argument("--api-env", action="append", default=[], metavar="KEY=VALUE",
+                        help="extra environment for the API, e.g. AZURE_CONCURRENCY=4 (repeatable)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--baseline", help="earlier report to compare against; exit 1 on regression")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed p95/throughput drift vs baseline")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text())
+        report["baseline"] = {"commit": baseline.get("meta", {}).get("commit"),
+                              "regressions": compare(report, baseline, args.tolerance)}
+
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        Path(args.output).write_text(text + "\n")
+    else:
+        print(text)
+    if args.baseline and report["baseline"]["regressions"]:
+        for line in report["baseline"]["regressions"]:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
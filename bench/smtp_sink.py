@@ -0,0 +1,97 @@
+import argparse, asyncio
+
+# Minimal SMTP server that accepts (and throws away) every message. Speaks just
+# enough ESMTP for smtplib: EHLO, AUTH PLAIN/LOGIN (any credentials), MAIL, RCPT,
+# DATA, NOOP, RSET and QUIT.
+
+
+class SMTPSink:
+    def __init__(self, host: str = "127.0.0.1", port: int = 2525, delay: float = 0.0):
+        self.host = host
+        self.port = port
+        self.delay = delay  # simulated server time per accepted message
+        self.messages = 0
+        self.bytes = 0
+        self.connections = 0
+        self._server = None
+        self._sessions = {}
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._session, self.host, self.port, limit=64 * 1024 * 1024)
+
+    async def serve_forever(self):
+        await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            # Pooled clients keep their connections open; drop them so wait_closed() returns
+            sessions = dict(self._sessions)
+            for writer in sessions:
+                writer.close()
+            await asyncio.gather(*sessions.values(), return_exceptions=True)
+            await self._server.wait_closed()
+
+    async def _session(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        self._sessions[writer] = asyncio.current_task()
+
+        async def reply(line: str):
+            writer.write(line.encode() + b"\r\n")
+            await writer.drain()
+
+        try:
+            await reply("220 bench sink ready")
+            while line := await reader.readline():
+                verb = line.decode("utf-8", "replace").strip().split(" ", 1)[0].upper()
+                if verb == "EHLO":
+                    writer.write(b"250-bench\r\n250-8BITMIME\r\n250-AUTH PLAIN LOGIN\r\n")
+                    await reply("250 SIZE 52428800")
+                elif verb == "HELO":
+                    await reply("250 bench")
+                elif verb == "AUTH":
+                    args = line.decode().split()
+                    if args[1].upper() == "LOGIN":
+                        # The username may come with the command (initial response)
+                        prompts = ["334 UGFzc3dvcmQ6"] if len(args) > 2 else ["334 VXNlcm5hbWU6", "334 UGFzc3dvcmQ6"]
+                        for prompt in prompts:
+                            await reply(prompt)
+                            await reader.readline()
+                    elif len(args) < 3:
+                        await reply("334 ")
+                        await reader.readline()
+                    await reply("235 2.7.0 Authentication successful")
+                elif verb == "DATA":
+                    await reply("354 End data with <CR><LF>.<CR><LF>")
+                    body = await reader.readuntil(b"\r\n.\r\n")
+                    if self.delay:
+                        await asyncio.sleep(self.delay)
+                    self.messages += 1
+                    self.bytes += len(body) - 3
+                    await reply("250 2.0.0 OK")
+                elif verb == "QUIT":
+                    await reply("221 Bye")
+                    break
+                elif verb in ("MAIL", "RCPT", "NOOP", "RSET"):
+                    await reply("250 OK")
+                else:
+                    await reply("502 Command not implemented")
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._sessions.pop(writer, None)
+            writer.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local SMTP sink for benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=2525)
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds spent per message")
+    args = parser.parse_args()
+    try:
+        asyncio.run(SMTPSink(args.host, args.port, args.delay).serve_forever())
+    except KeyboardInterrupt:
+        pass
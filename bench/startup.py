@@ -0,0 +1,258 @@
+import argparse, asyncio, json, os, platform, socket, statistics, subprocess, sys, tempfile, time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import httpx
+
+# Cold-start profile for scale-to-zero hosting. Starts each process from scratch
+# several times and reports medians of:
+#   api: time from spawn until uvicorn answers GET /health
+#   bot: time from spawn until the bot replies to a /start it gets from polling
+#        (Telegram is faked inside the child)
+#   bot_webhook: the same in webhook mode (PRODUCTION=true), with the /start
+#        POSTed to the webhook as soon as it accepts connections
+# plus the import-time breakdown of app.py and bot.py by top-level module, taken
+# from separate `python -X importtime` runs (it slows imports down). Prints one
+# JSON report, like run.py, so CI can keep it next to the load test.
+
+BENCH_DIR = Path(__file__).resolve().parent
+ROOT_DIR = BENCH_DIR.parent
+API_DIR = ROOT_DIR / "api"
+BOT_DIR = ROOT_DIR / "telegram_bot"
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _import_breakdown(stderr: str, target: str) -> Dict[str, float]:
+    # -X importtime lines look like "import time: self | cumulative |   name", one
+    # extra indent per nesting level, children before their parent. Returns ms
+    # for the target module itself ("total") and for each module it imports directly.
+    children, out = {}, {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[12:].split("|", 2)
+        if not cumulative.strip().isdigit():
+            continue
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        name, ms = name.strip(), int(cumulative) / 1000
+        if depth == 1:
+            children[name] = ms
+        elif depth == 0:
+            if name == target:
+                out = {"total": ms, **children}
+            children = {}
+    return out
+
+
+def _median_breakdown(runs: List[Dict[str, float]], top: int) -> dict:
+    names = {n for run in runs for n in run}
+    medians = {n: round(statistics.median(run.get(n, 0.0) for run in runs), 1) for n in names}
+    total = medians.pop("total", None)
+    ranked = sorted(medians.items(), key=lambda kv: -kv[1])[:top]
+    return {"total_ms": total, "top_imports_ms": dict(ranked)}
+
+
+def _summary(samples: List[float]) -> dict:
+    return {"median": round(statistics.median(samples) * 1000, 1), "min": round(min(samples) * 1000, 1),
+            "max": round(max(samples) * 1000, 1)}
+
+
+def _child_env(workdir: str) -> dict:
+    # Credentials are placeholders: nothing at startup may need to reach them
+    return {
+        **os.environ,
+        "DATA_DIR": workdir,
+        "AZURE_OPENAI_KEY": "startup", "AZURE_OPENAI_ENDPOINT": "http://127.0.0.1:9/",
+        "AZURE_OPENAI_DEPLOYMENT": "startup",
+        "COHERE_API_KEY": "startup",
+        "GMAIL_USER": "startup@example.com", "GMAIL_PASS": "startup",
+        "GOOGLE_CREDENTIALS_BASE64": "eyJpbnN0YWxsZWQiOiB7fX0=",
+        "TELEGRAM_TOKEN": "123456:startup", "API_BASE": "http://127.0.0.1:9",
+        "BOT_PERSISTENCE": "sqlite", "PERSISTENCE_PATH": os.path.join(workdir, "conversations.sqlite3"),
+        "FILE_CACHE_DIR": os.path.join(workdir, "file_cache"),
+        "PRODUCTION": "false", "METRICS_PORT": "0",
+    }
+
+
+def _imports(cwd: Path, module: str, env: dict) -> Dict[str, float]:
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=cwd, env=env,
+                         capture_output=True, text=True, timeout=60)
+    return _import_breakdown(out.stderr, module)
+
+
+async def _api_once(env: dict) -> float:
+    port = _free_port()
+    started = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, str(Path(__file__).resolve()), "--api-child", str(port)],
+                            cwd=API_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    try:
+        async with httpx.AsyncClient(timeout=1) as client:
+            while True:
+                if proc.poll() is not None:
+                    raise RuntimeError(f"API exited early:\n{proc.stderr.read()[-2000:]}")
+                try:
+                    if (await client.get(f"http://127.0.0.1:{port}/health")).status_code == 200:
+                        break
+                except httpx.TransportError:
+                    pass
+                await asyncio.sleep(0.002)
+        elapsed = time.perf_counter() - started
+    finally:
+        proc.terminate()
+        proc.communicate(timeout=30)
+    return elapsed
+
+
+def _start_update() -> dict:
+    message = {"message_id": 1, "date": int(time.time()), "chat": {"id": 7, "type": "private"},
+               "from": {"id": 7, "is_bot": False, "first_name": "u"}, "text": "/start",
+               "entities": [{"type": "bot_command", "offset": 0, "length": 6}]}
+    return {"update_id": 1, "message": message}
+
+
+def _bot_once(env: dict, webhook: bool = False) -> float:
+    port = _free_port()
+    if webhook:
+        env = {**env, "PRODUCTION": "true", "PORT": str(port), "WEBHOOK_URL": "https://bot.example.invalid",
+               "WEBHOOK_PATH": "/telegram", "WEBHOOK_SECRET": "startup"}
+    started = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, str(Path(__file__).resolve()), "--bot-child"],
+                            cwd=BOT_DIR, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if webhook:
+        with httpx.Client(timeout=1) as client:
+            while proc.poll() is None:
+                try:
+                    r = client.post(f"http://127.0.0.1:{port}/telegram", json=_start_update(),
+                                    headers={"X-Telegram-Bot-Api-Secret-Token": "startup"})
+                    if r.status_code == 200:
+                        break
+                except httpx.TransportError:
+                    pass
+                time.sleep(0.002)
+    # The bot prints its own startup lines first
+    line = None
+    while line != "" and line != "first-reply\n":
+        line = proc.stdout.readline()
+    elapsed = time.perf_counter() - started
+    try:
+        _, stderr = proc.communicate(timeout=30)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        _, stderr = proc.communicate()
+    if line != "first-reply\n":
+        raise RuntimeError(f"bot never replied:\n{stderr[-2000:]}")
+    return elapsed
+
+
+def _api_child(port: int):
+    # What `uvicorn app:app --port PORT` does
+    sys.path.insert(0, str(API_DIR))
+    import uvicorn
+    import app
+    uvicorn.run(app.app, port=port, log_level="warning")
+
+
+def _bot_child():
+    # Runs the real bot.main() against an in-process fake of the Bot API: one
+    # /start comes in (polled, or POSTed by the parent in webhook mode), and the
+    # first sendMessage ends the process.
+    sys.path.insert(0, str(BOT_DIR))
+    import bot
+    import telegram
+
+    delivered = False
+
+    async def fake_post(self, endpoint, data=None, *args, **kwargs):
+        nonlocal delivered
+        if endpoint == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "startup", "username": "startup_bot"}
+        if endpoint == "getUpdates":
+            if delivered:
+                await asyncio.sleep(1)
+                return []
+            delivered = True
+            return [_start_update()]
+        if endpoint == "sendMessage":
+            sys.stdout.write("first-reply\n")
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(0)
+        return True
+
+    telegram.Bot._do_post = fake_post
+    bot.main()
+
+
+async def _profile(args) -> dict:
+    workdir = tempfile.TemporaryDirectory(prefix="email-startup-")
+    report = {}
+    try:
+        env = _child_env(workdir.name)
+        if "api" in args.targets:
+            times, imports = [], []
+            for _ in range(args.runs):
+                times.append(await _api_once(env))
+                imports.append(await asyncio.to_thread(_imports, API_DIR, "app", env))
+            report["api"] = {"first_health_ms": _summary(times), "import": _median_breakdown(imports, args.top)}
+        if "bot" in args.targets:
+            times, imports = [], []
+            for _ in range(args.runs):
+                times.append(await asyncio.to_thread(_bot_once, env))
+                imports.append(await asyncio.to_thread(_imports, BOT_DIR, "bot", env))
+            report["bot"] = {"first_reply_ms": _summary(times), "import": _median_breakdown(imports, args.top)}
+        if "bot_webhook" in args.targets:
+            times = [await asyncio.to_thread(_bot_once, env, True) for _ in range(args.runs)]
+            report["bot_webhook"] = {"first_reply_ms": _summary(times)}
+    finally:
+        workdir.cleanup()
+    return report
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold-start profile of the email API and bot")
+    parser.add_argument("--targets", default="api,bot,bot_webhook", help="comma-separated: api, bot, bot_webhook")
+    parser.add_argument("--runs", type=int, default=5, help="cold starts per target; medians are reported")
+    parser.add_argument("--top", type=int, default=10, help="slowest direct imports to list")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--api-child", type=int, metavar="PORT", help=argparse.SUPPRESS)
+    parser.add_argument("--bot-child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.api_child:
+        return _api_child(args.api_child)
+    if args.bot_child:
+        return _bot_child()
+
+    args.targets = {t.strip() for t in args.targets.split(",") if t.strip()}
+    report = {
+        "meta": {
+            "commit": _git_commit(),
+            "started": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "runs": args.runs,
+        },
+        **asyncio.run(_profile(args)),
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+import asyncio, json, random
+from typing import AsyncIterator, Optional
+
+import httpx
+
+# Worth another try: the API is restarting, overloaded or behind a flaky proxy
+RETRY_STATUSES = {502, 503, 504}
+
+
+class ApiClient:
+    # One pooled AsyncClient to the email API for the whole bot process, so a
+    # slow generation for one chat never blocks the event loop for the others.
+    # It is created on the first call: its TLS setup would otherwise delay the
+    # bot's first reply after a cold start, and most first replies don't need the API.
+    def __init__(self, base_url: str, max_connections: int = 20, connect_timeout: float = 10,
+                 retries: int = 2, backoff: float = 0.5, max_retry_wait: float = 10,
+                 client_secret: Optional[str] = None):
+        self.client_secret = client_secret
+        self.retries = retries
+        self.backoff = backoff
+        self.max_retry_wait = max_retry_wait
+        self._client_kwargs = dict(
+            base_url=base_url or "",
+            timeout=httpx.Timeout(30, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        )
+        self._http: Optional[httpx.AsyncClient] = None
+
+    @property
+    def _client(self) -> httpx.AsyncClient:
+        if self._http is None:
+            self._http = httpx.AsyncClient(**self._client_kwargs)
+        return self._http
+
+    def _delay(self, attempt: int, response: Optional[httpx.Response] = None) -> float:
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        if retry_after:
+            try:
+                return min(float(retry_after), self.max_retry_wait)
+            except ValueError:
+                pass
+        return self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+
+    async def _request(self, method: str, url: str, idempotent: bool, rewind=(), **kwargs) -> httpx.Response:
+        for attempt in range(self.retries + 1):
+            for f in rewind:
+                f.seek(0)
+            try:
+                r = await self._client.request(method, url, **kwargs)
+            except httpx.ConnectError:
+                # The request never reached the API, so even a send is safe to repeat
+                if attempt == self.retries:
+                    raise
+                await asyncio.sleep(self._delay(attempt))
+                continue
+            except httpx.TransportError:
+                if not idempotent or attempt == self.retries:
+                    raise
+                await asyncio.sleep(self._delay(attempt))
+                continue
+            if r.status_code in RETRY_STATUSES and idempotent and attempt < self.retries:
+                await asyncio.sleep(self._delay(attempt, r))
+                continue
+            return r
+
+    async def generate(self, fields: dict, timeout: float = 30, client: Optional[str] = None) -> httpx.Response:
+        return await self._request("POST", "/generate-email", idempotent=True, data=fields, timeout=timeout,
+                                   headers=self._headers(client))
+
+    async def stream_generate(self, fields: dict, timeout: float = 60,
+                              client: Optional[str] = None) -> AsyncIterator[tuple]:
+        # Yields (event, data) pairs from /generate-email/stream
+        event = None
+        async with self._client.stream("POST", "/generate-email/stream", data=fields, timeout=timeout,
+                                       headers=self._headers(client)) as r:
+            if r.status_code != 200:
+                await r.aread()
+                raise RuntimeError(_failure(r))
+            async for line in r.aiter_lines():
+                if line.startswith("event:"):
+                    event = line[6:].strip()
+                elif line.startswith("data:"):
+                    yield event, json.loads(line[5:])
+
+    async def generate_batch(self, fields: dict, variants: list, timeout: float = 60,
+                             client: Optional[str] = None) -> AsyncIterator[dict]:
+        # Yields the NDJSON lines of /generate-batch: one per variant as it finishes, then {"done": true}
+        data = {**fields, "variants": json.dumps(variants)}
+        async with self._client.stream("POST", "/generate-batch", data=data, timeout=timeout,
+                                       headers=self._headers(client)) as r:
+            if r.status_code != 200:
+                await r.aread()
+                raise RuntimeError(_failure(r))
+            async for line in r.aiter_lines():
+                if line.strip():
+                    yield json.loads(line)
+
+    async def send(self, data: dict, files: list, timeout: float = 60, client: Optional[str] = None) -> httpx.Response:
+        # Sends are not idempotent: only retried when the connection was never made
+        rewind = [f[1][1] for f in files]
+        return await self._request("POST", "/send-email", idempotent=False, rewind=rewind,
+                                   data=data, files=files or None, timeout=timeout, headers=self._headers(client))
+
+    def _headers(self, client: Optional[str]) -> Optional[dict]:
+        # The API counts rate limits and queue turns per X-Client-Id (one per chat),
+        # and only believes it alongside the shared secret
+        if not (client and self.client_secret):
+            return None
+        return {"X-Client-Id": client, "X-Client-Secret": self.client_secret}
+
+    async def aclose(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+
+def _failure(r: httpx.Response) -> str:
+    # The API's {"error": ...} message if there is one, e.g. a rate limit with its wait
+    try:
+        return r.json()["error"]
+    except (ValueError, KeyError, TypeError):
+        return f"HTTP {r.status_code}: {r.text[:200]}"
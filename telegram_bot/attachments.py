@@ -0,0 +1,150 @@
+import asyncio, io, tempfile, threading, time
+from pathlib import Path
+from typing import Dict, Hashable, List, Optional
+
+
+class AttachmentLimitError(Exception):
+    pass
+
+
+class Attachment:
+    def __init__(self, owner: Hashable, filename: str, mime: str, fileobj, reserved: int,
+                 path: Optional[Path] = None, reference: bool = False):
+        self.owner = owner
+        self.filename = filename
+        self.mime = mime
+        self.fileobj = fileobj
+        self.reserved = reserved  # bytes charged against the memory budget (0 when on disk)
+        self.path = path
+        self.reference = reference  # path is a durable file we don't own (e.g. the file cache)
+        self.pending = False  # holds one of the owner's slots until add() or discard()
+        self.created = time.monotonic()
+
+
+class AttachmentStore:
+    # Holds attachments for in-progress conversations under one memory budget for
+    # the whole bot. Big files, files of unknown size, and anything that would push
+    # the budget over go to temp files instead. Owners that go quiet for longer
+    # than ttl are swept, so abandoned conversations don't pin memory or disk.
+    def __init__(self, memory_budget: int = 64 * 1024 * 1024, spill_threshold: int = 2 * 1024 * 1024,
+                 max_per_owner: int = 10, ttl: float = 1800, spool_dir: Optional[str] = None):
+        self.memory_budget = memory_budget
+        self.spill_threshold = spill_threshold
+        self.max_per_owner = max_per_owner
+        self.ttl = ttl
+        self.spool_dir = spool_dir
+        self._owners: Dict[Hashable, List[Attachment]] = {}
+        self._pending: Dict[Hashable, int] = {}  # owner -> attachments opened but not yet added
+        self._touched: Dict[Hashable, float] = {}
+        self._in_memory = 0
+        self._lock = threading.Lock()
+        self._sweeper: Optional[asyncio.Task] = None
+
+    def _take_slot(self, owner: Hashable):
+        # Downloads still in flight count too, so a burst of files (an album) can't
+        # get past max_per_owner while the first ones are downloading
+        if len(self._owners.get(owner, [])) + self._pending.get(owner, 0) >= self.max_per_owner:
+            raise AttachmentLimitError(f"At most {self.max_per_owner} attachments per email")
+
+    def _free_slot(self, owner: Hashable):
+        left = self._pending.get(owner, 0) - 1
+        if left > 0:
+            self._pending[owner] = left
+        else:
+            self._pending.pop(owner, None)
+
+    def _settle(self, attachment: Attachment):
+        if attachment.pending:
+            attachment.pending = False
+            self._free_slot(attachment.owner)
+
+    def open(self, owner: Hashable, filename: str, mime: str, size: Optional[int]) -> Attachment:
+        # Returns an empty attachment to download into, holding one of the owner's
+        # slots; call add() once it is filled, or discard() if the download fails
+        with self._lock:
+            self._take_slot(owner)
+            self._pending[owner] = self._pending.get(owner, 0) + 1
+            in_memory = (size is not None and size <= self.spill_threshold
+                         and self._in_memory + size <= self.memory_budget)
+            if in_memory:
+                self._in_memory += size
+        if in_memory:
+            attachment = Attachment(owner, filename, mime, io.BytesIO(), size)
+        else:
+            spool = tempfile.NamedTemporaryFile(prefix="attach_", dir=self.spool_dir)
+            attachment = Attachment(owner, filename, mime, spool, 0, Path(spool.name))
+        attachment.pending = True
+        return attachment
+
+    def add_reference(self, owner: Hashable, filename: str, mime: str, path: Path) -> Attachment:
+        # Attach a file that already lives on disk (e.g. in the file cache) without copying it
+        with self._lock:
+            self._take_slot(owner)
+            self._pending[owner] = self._pending.get(owner, 0) + 1
+        try:
+            attachment = Attachment(owner, filename, mime, open(path, "rb"), 0, Path(path), reference=True)
+        except BaseException:
+            with self._lock:
+                self._free_slot(owner)
+            raise
+        attachment.pending = True
+        self.add(attachment)
+        return attachment
+
+    def add(self, attachment: Attachment):
+        attachment.fileobj.seek(0)
+        with self._lock:
+            self._settle(attachment)
+            self._owners.setdefault(attachment.owner, []).append(attachment)
+            self._touched[attachment.owner] = time.monotonic()
+
+    def discard(self, attachment: Attachment):
+        # Frees an attachment that never made it into add(), e.g. a failed download
+        with self._lock:
+            self._settle(attachment)
+            self._in_memory -= attachment.reserved
+            attachment.reserved = 0
+        attachment.fileobj.close()
+
+    def files(self, owner: Hashable) -> List[Attachment]:
+        with self._lock:
+            self._touched[owner] = time.monotonic()
+            return list(self._owners.get(owner, []))
+
+    def release(self, owner: Hashable):
+        with self._lock:
+            attachments = self._owners.pop(owner, [])
+            self._touched.pop(owner, None)
+            for a in attachments:
+                self._in_memory -= a.reserved
+                a.reserved = 0
+        for a in attachments:
+            a.fileobj.close()  # NamedTemporaryFile deletes itself on close
+
+    def sweep(self) -> int:
+        cutoff = time.monotonic() - self.ttl
+        with self._lock:
+            stale = [owner for owner, touched in self._touched.items() if touched < cutoff]
+        for owner in stale:
+            self.release(owner)
+        return len(stale)
+
+    async def _sweep_forever(self):
+        while True:
+            await asyncio.sleep(min(60, self.ttl))
+            self.sweep()
+
+    def start(self):
+        self._sweeper = asyncio.create_task(self._sweep_forever())
+
+    async def close(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+        for owner in list(self._owners):
+            self.release(owner)
+
+    def stats(self) -> dict:
+        with self._lock:
+            count = sum(len(a) for a in self._owners.values())
+            return {"owners": len(self._owners), "attachments": count, "in_memory_bytes": self._in_memory}
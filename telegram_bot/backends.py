@@ -0,0 +1,168 @@
+import asyncio, importlib, sys
+from contextlib import AsyncExitStack
+from pathlib import Path
+from typing import AsyncIterator, List, Optional
+
+from api_client import ApiClient
+
+API_DIR = Path(__file__).resolve().parent.parent / "api"
+
+
+class BackendError(Exception):
+    def __init__(self, status_code: int, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class EmailBackend:
+    # What the bot needs from the email service: generate (whole or streamed) and send.
+    # fields are the /generate-email form fields; files are attachments.Attachment objects;
+    # client names the chat the API's rate limits and fair queueing count the call against.
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def generate(self, fields: dict, client: Optional[str] = None) -> dict:
+        raise NotImplementedError
+
+    def stream(self, fields: dict, client: Optional[str] = None) -> AsyncIterator[tuple]:
+        raise NotImplementedError
+
+    def generate_batch(self, fields: dict, variants: List[dict], client: Optional[str] = None) -> AsyncIterator[dict]:
+        # One result per variant ({"index", "subject", "email"} or {"index", "error"}), as each finishes
+        raise NotImplementedError
+
+    async def send(self, data: dict, files: List[tuple], client: Optional[str] = None) -> dict:
+        raise NotImplementedError
+
+
+class RemoteBackend(EmailBackend):
+    # The API over HTTP (API_BASE)
+    def __init__(self, client: ApiClient):
+        self.client = client
+
+    async def close(self):
+        await self.client.aclose()
+
+    async def generate(self, fields: dict, client: Optional[str] = None) -> dict:
+        r = await self.client.generate(fields, timeout=30, client=client)
+        if not r.is_success:
+            raise BackendError(r.status_code, _error(r))
+        return r.json()
+
+    async def stream(self, fields: dict, client: Optional[str] = None) -> AsyncIterator[tuple]:
+        async for event, data in self.client.stream_generate(fields, timeout=60, client=client):
+            yield event, data
+
+    async def generate_batch(self, fields: dict, variants: List[dict],
+                             client: Optional[str] = None) -> AsyncIterator[dict]:
+        async for result in self.client.generate_batch(fields, variants, timeout=60, client=client):
+            if "index" in result:
+                yield result
+
+    async def send(self, data: dict, files: List[tuple], client: Optional[str] = None) -> dict:
+        r = await self.client.send(data, [("attachments", (a.filename, a.fileobj, a.mime)) for a in files],
+                                   timeout=60, client=client)
+        if not r.is_success:
+            raise BackendError(r.status_code, _error(r))
+        return r.json()
+
+
+class InProcessBackend(EmailBackend):
+    # Calls the API's generation and sending code directly when bot and API share a
+    # host: no loopback HTTP, no multipart round-trip of attachments already in memory.
+    def __init__(self):
+        self.api = None  # the API's app module, once start() has loaded it
+        self._stack: Optional[AsyncExitStack] = None
+        self._loading: Optional[asyncio.Task] = None
+
+    async def start(self):
+        # Importing the API (FastAPI and all) takes most of a second, so it happens
+        # in the background: the bot answers right away, and the first call that
+        # needs the API waits for it
+        self._loading = asyncio.ensure_future(self._load())
+        self._loading.add_done_callback(_report_failure)
+
+    async def _load(self):
+        if str(API_DIR) not in sys.path:
+            sys.path.insert(1, str(API_DIR))
+        self.api = await asyncio.to_thread(importlib.import_module, "app")
+        # Run the API's own startup/shutdown (HTTP client, mail queue workers, ...)
+        self._stack = AsyncExitStack()
+        await self._stack.enter_async_context(self.api.lifespan(self.api.app))
+
+    async def close(self):
+        if self._loading is not None and not self._loading.done():
+            self._loading.cancel()
+            await asyncio.gather(self._loading, return_exceptions=True)
+        if self._stack is not None:
+            await self._stack.aclose()
+            self._stack = None
+
+    async def _ready(self, client: Optional[str]):
+        if self._loading is None:
+            await self.start()
+        # shield: a cancelled caller must not abort the load for everyone else
+        await asyncio.shield(self._loading)
+        # Attributes the API work to the chat for fair queueing. Each update runs in
+        # its own task, so this doesn't leak into other chats' calls.
+        if client:
+            self.api.current_client.set(client)
+
+    async def generate(self, fields: dict, client: Optional[str] = None) -> dict:
+        await self._ready(client)
+        try:
+            return await self.api.generate_draft(**fields)
+        except self.api.ApiError as e:
+            raise BackendError(e.status_code, str(e))
+
+    async def stream(self, fields: dict, client: Optional[str] = None) -> AsyncIterator[tuple]:
+        await self._ready(client)
+        try:
+            async for event, data in self.api.stream_draft(**fields):
+                yield event, data
+        except self.api.ApiError as e:
+            yield "error", {"error": str(e), "status": e.status_code}
+
+    async def generate_batch(self, fields: dict, variants: List[dict],
+                             client: Optional[str] = None) -> AsyncIterator[dict]:
+        # Per-variant failures come back as results, so nothing to translate here
+        await self._ready(client)
+        async for result in self.api.generate_variants(fields, variants):
+            yield result
+
+    async def send(self, data: dict, files: List[tuple], client: Optional[str] = None) -> dict:
+        await self._ready(client)
+        try:
+            parts = await self._parts(files)
+            return await self.api.deliver(data["recipient"], data["subject"], data["body"], parts,
+                                          deferred=str(data.get("deferred", "")).lower() == "true")
+        except self.api.ApiError as e:
+            raise BackendError(e.status_code, str(e))
+        except Exception as e:
+            # Same shape as the HTTP endpoint's 500 so the bot reports it the same way
+            raise BackendError(500, str(e))
+
+    async def _parts(self, files: List[tuple]) -> list:
+        for a in files:
+            a.fileobj.seek(0)
+        if self.api.ATTACHMENT_OPTIMIZE and files:
+            parts, _ = await self.api.optimized_parts([(a.filename, a.fileobj.read(), a.mime) for a in files])
+            return parts
+        # Encoded straight from the buffer/spool file, off the event loop
+        return [await asyncio.to_thread(self.api.attachment_part, a.filename, a.fileobj, a.mime) for a in files]
+
+
+def _report_failure(task: asyncio.Task):
+    # Calls keep raising the error; this makes sure it shows up even before one does
+    if not task.cancelled() and task.exception() is not None:
+        print(f"In-process API failed to start: {task.exception()!r}")
+
+
+def _error(r) -> str:
+    try:
+        return r.json().get("error", r.text)
+    except ValueError:
+        return r.text
@@ -5,54 +5,86 @@ from pathlib import Path
 ROOT_DIR = Path(__file__).resolve().parent.parent
 ENV_PATH = os.path.join(ROOT_DIR, '.env')
 
-# Set timezone environment variable early
+# rate_limit (and, with BOT_BACKEND=inprocess, the whole API) is imported from
+# the API directory. It goes right after the bot's own directory, ahead of
+# installed packages, so nothing installed under the same name shadows it.
+API_DIR = ROOT_DIR / "api"
+if str(API_DIR) not in sys.path:
+    sys.path.insert(1, str(API_DIR))
+
+# Set timezone environment variable early. The bot is built without a JobQueue,
+# so APScheduler (and the tzlocal/pytz patching it used to need) never loads.
 os.environ.setdefault("TZ", "UTC")
 
-# More robust timezone patch
-try:
-    import pytz
-    import importlib
-    
-    # Patch tzlocal
-    try:
-        import tzlocal
-        tzlocal.get_localzone = lambda: pytz.timezone("UTC")
-    except ImportError:
-        pass
-    
-    # Direct patch for apscheduler.util.astimezone
-    try:
-        import apscheduler.util
-        original_astimezone = getattr(apscheduler.util, "astimezone", None)
-        def patched_astimezone(tz):
-            if tz is None:
-                return pytz.UTC
-            return tz
-        apscheduler.util.astimezone = patched_astimezone
-    except (ImportError, AttributeError):
-        pass
-except ImportError:
-    pass
-
-import io, mimetypes, requests
+import asyncio, hashlib, hmac, math, mimetypes, random, time
+from contextlib import asynccontextmanager
+from typing import Optional
 import telegram
 from dotenv import load_dotenv
 from telegram import Update, ReplyKeyboardMarkup
 from telegram.ext import (
-    Application, CommandHandler, MessageHandler, ConversationHandler,
+    Application, CommandHandler, MessageHandler, ConversationHandler, TypeHandler,
     ContextTypes, filters
 )
-from fastapi import FastAPI, Request
+from api_client import ApiClient
+from backends import BackendError, EmailBackend, InProcessBackend, RemoteBackend
+from attachments import AttachmentLimitError, AttachmentStore
+from bot_metrics import DOWNLOAD_BYTES, DOWNLOAD_SECONDS, DOWNLOADS, THROTTLED, timed_call, timed_handler
+from lazy_metrics import render as render_metrics
+from file_cache import FileCache
+from ingest import IngestBatch
+from persistence import ConversationPersistence, FileStore, SQLiteStore, shared_conversation
+from rate_limit import RateLimiter  # api/rate_limit.py, see API_DIR above
+from update_processor import PerChatUpdateProcessor
 
 # Load environment variables from the root .env file
 load_dotenv(ENV_PATH)
-print(f"Loading .env from: {ENV_PATH}")
 
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 API_BASE = os.getenv("API_BASE")  # e.g., https://<username>-email-api.hf.space
+# "remote" talks to API_BASE over HTTP; "inprocess" runs the API code inside the bot
+BOT_BACKEND = os.getenv("BOT_BACKEND", "remote").lower()
+# Hand mail to the API's queue and return immediately instead of waiting on SMTP
+SEND_DEFERRED = os.getenv("SEND_DEFERRED", "False").lower() == "true"
+# Stream drafts from /generate-email/stream and edit the preview as text arrives
+BOT_STREAMING = os.getenv("BOT_STREAMING", "True").lower() == "true"
+# Minimum seconds between preview edits; Telegram throttles frequent edits of one message
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))
+# Concurrent attachment downloads per chat, and the pause that closes a burst of files
+DOWNLOAD_CONCURRENCY = int(os.getenv("DOWNLOAD_CONCURRENCY", "4"))
+ALBUM_QUIET = float(os.getenv("ALBUM_QUIET", "1.0"))
+DOWNLOAD_BACKOFF = float(os.getenv("DOWNLOAD_BACKOFF", "1.0"))
+# Updates handled at once across chats; each chat is still processed in order
+BOT_CONCURRENCY = int(os.getenv("BOT_CONCURRENCY", "32"))
+
+# Webhook mode (PRODUCTION=true)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # public base URL, e.g. https://<username>-email-bot.hf.space
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+# Derived from the token when unset, so every worker registers and checks the same secret
+WEBHOOK_SECRET = (os.getenv("WEBHOOK_SECRET")
+                  or hashlib.sha256(f"webhook:{TELEGRAM_TOKEN}".encode()).hexdigest())
+PORT = int(os.getenv("PORT", "7860"))
+# Polling mode has no web server of its own; set this to expose /metrics
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+# Where in-progress conversations are kept across restarts and shared between
+# workers: "sqlite" (default), "file" (a directory, e.g. on a shared volume) or "off"
+BOT_PERSISTENCE = os.getenv("BOT_PERSISTENCE", "sqlite").lower()
+PERSISTENCE_PATH = os.getenv("PERSISTENCE_PATH")
+# Seconds without activity before a conversation is dropped
+CONVERSATION_TIMEOUT = float(os.getenv("CONVERSATION_TIMEOUT", "86400"))
+# Per-chat limits, per minute with a burst allowance (0 = unlimited). Each draft
+# variant counts as one generation.
+GENERATE_PER_MINUTE = float(os.getenv("BOT_GENERATE_PER_MINUTE", "10"))
+GENERATE_BURST = float(os.getenv("BOT_GENERATE_BURST", "5"))
+SEND_PER_MINUTE = float(os.getenv("BOT_SEND_PER_MINUTE", "5"))
+SEND_BURST = float(os.getenv("BOT_SEND_BURST", "3"))
 
 # Add these missing state definitions at the top with your other states
-ROLE, TONE, TOPIC, SUBJECT, NAME, POSITION, RECIPIENT_NAME, RECIPIENT, ATTACH_OR_SEND, WAIT_ATTACHMENTS, CONFIRM = range(11)
+ROLE, TONE, TOPIC, SUBJECT, NAME, POSITION, RECIPIENT_NAME, RECIPIENT, ATTACH_OR_SEND, WAIT_ATTACHMENTS, CONFIRM, CHOOSE_VARIANT = range(12)
+
+# Several comma-separated tones ("formal, casual") get one draft each to choose from
+MAX_VARIANTS = 4
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
@@ -60,6 +92,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "What's your professional role? (e.g., manager, developer, student)"
     )
     context.user_data.clear()  # Reset user data
+    _attachments(context).release(update.effective_user.id)
     return ROLE
 
 async def get_role(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -91,7 +124,8 @@ async def get_position(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["position"] = position
     
     await update.message.reply_text(
-        "What tone would you like? (e.g., formal, casual)"
+        "What tone would you like? (e.g., formal or casual)\n"
+        "List several, separated by commas, to compare drafts."
     )
     return TONE
 
@@ -129,104 +163,139 @@ async def get_recipient(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def attach_or_send(update: Update, context: ContextTypes.DEFAULT_TYPE):
     choice = update.message.text.strip().lower()
     if "attach" in choice:
-        context.user_data["files"] = []  # list of (name, bytes, mime)
+        _attachments(context).release(update.effective_user.id)
         await update.message.reply_text(
             "📎 Send me document/photo(s).\n\n"
             "⚠️ *Important:*\n"
             "• When you're finished adding attachments, type /done\n"
-            "• Keep files under 5MB\n"
-            "• Wait for confirmation before sending the next file",
+            "• Keep files under 10MB\n"
+            "• You can send several files or a whole album at once",
             parse_mode="Markdown"
         )
         return WAIT_ATTACHMENTS
     else:
         return await _send_now(update, context)
 
-async def receive_attachment(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def _download(file, out, max_retries: int = 3):
+    for attempt in range(1, max_retries + 1):
+        # Start over on each try so a partial download isn't kept
+        out.seek(0)
+        out.truncate()
+        try:
+            await file.download_to_memory(out=out)
+            return
+        except (telegram.error.TimedOut, telegram.error.NetworkError):
+            if attempt == max_retries:
+                raise
+            # Jittered backoff; this runs in a background task, so the chat isn't blocked
+            await asyncio.sleep(DOWNLOAD_BACKOFF * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+
+async def _fetch_attachment(update: Update, context: ContextTypes.DEFAULT_TYPE, tg_file, filename: str, mime: str):
+    # tg_file is a Document or PhotoSize. Files seen before (same file_unique_id) come
+    # straight from the local cache; new ones are downloaded once and then cached.
+    store = _attachments(context)
+    owner = update.effective_user.id
+    cache = context.application.bot_data.get("file_cache")
+    # The cache index is SQLite, shared with put() running in other downloads' threads
+    path = await asyncio.to_thread(cache.lookup, tg_file.file_unique_id) if cache is not None else None
+    if path is not None:
+        try:
+            attachment = store.add_reference(owner, filename, mime, path)
+            DOWNLOADS.labels("cached").inc()
+            return attachment
+        except FileNotFoundError:
+            pass  # evicted since the lookup; download it again
+
+    attachment = store.open(owner, filename, mime, tg_file.file_size)
     try:
-        if document := update.message.document:
-            # Check file size (10MB limit)
-            if document.file_size > 10 * 1024 * 1024:
-                await update.message.reply_text("⚠️ File is too large (max 10MB)")
-                return WAIT_ATTACHMENTS
-            
-            file = await document.get_file()
-            bio = io.BytesIO()
-            
-            # Retry logic without timeout parameter
-            max_retries = 3
-            current_retry = 0
-            
-            while current_retry < max_retries:
-                try:
-                    # Remove timeout parameter
-                    await file.download_to_memory(out=bio)
-                    break
-                except telegram.error.TimedOut:
-                    current_retry += 1
-                    if current_retry < max_retries:
-                        await update.message.reply_text(f"⚠️ Download timed out. Retrying ({current_retry}/{max_retries})...")
-                    else:
-                        raise
-            
-            bio.seek(0)
-            filename = document.file_name or f"file_{document.file_unique_id}"
-            mime = mimetypes.guess_type(filename)[0] or "application/octet-stream"
-            context.user_data["files"].append((filename, bio, mime))
-            await update.message.reply_text(
-                f"✅ Got file: {filename}\n\n"
-                f"Send more attachments or type /done when finished"
-            )
+        try:
+            with DOWNLOAD_SECONDS.time():
+                await _download(await tg_file.get_file(), attachment.fileobj)
+        except Exception:
+            DOWNLOADS.labels("failed").inc()
+            raise
+        DOWNLOADS.labels("downloaded").inc()
+        DOWNLOAD_BYTES.inc(attachment.fileobj.tell())
+        if cache is not None:
+            path = await asyncio.to_thread(cache.put, tg_file.file_unique_id, attachment.fileobj)
+            # Keep the cached copy only, so the bytes are held once
+            store.discard(attachment)
+            return store.add_reference(owner, filename, mime, path)
+    except BaseException:
+        store.discard(attachment)
+        raise
+    store.add(attachment)
+    return attachment
 
-        elif photos := update.message.photo:
-            # Take the largest size
-            photo = photos[-1]
-            file = await photo.get_file()
-            bio = io.BytesIO()
-            
-            # Retry logic for photos without timeout
-            max_retries = 3
-            current_retry = 0
-            
-            while current_retry < max_retries:
-                try:
-                    # Remove timeout parameter
-                    await file.download_to_memory(out=bio)
-                    break
-                except telegram.error.TimedOut:
-                    current_retry += 1
-                    if current_retry < max_retries:
-                        await update.message.reply_text(f"⚠️ Download timed out. Retrying ({current_retry}/{max_retries})...")
-                    else:
-                        raise
-                        
-            bio.seek(0)
-            filename = f"photo_{file.file_unique_id}.jpg"
-            mime = "image/jpeg"
-            context.user_data["files"].append((filename, bio, mime))
-            await update.message.reply_text(
-                "✅ Got photo\n\n"
-                "Send more attachments or type /done when finished"
-            )
-    
-    except telegram.error.TimedOut:
-        await update.message.reply_text("⚠️ Download timed out. Try a smaller file or better connection.")
-    except Exception as e:
-        await update.message.reply_text(f"⚠️ Error processing attachment: {str(e)}")
+def _ingest_batch(context, owner) -> IngestBatch:
+    batches = context.application.bot_data.setdefault("ingest", {})
+    if owner not in batches:
+        batches[owner] = IngestBatch(DOWNLOAD_CONCURRENCY, quiet=ALBUM_QUIET)
+    return batches[owner]
+
+async def receive_attachment(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Downloads run in the background so albums and quick multi-file uploads are
+    # fetched concurrently; the user gets one confirmation per burst of files.
+    if document := update.message.document:
+        # Check file size (10MB limit)
+        if document.file_size and document.file_size > 10 * 1024 * 1024:
+            await update.message.reply_text("⚠️ File is too large (max 10MB)")
+            return WAIT_ATTACHMENTS
+        tg_file = document
+        filename = document.file_name or f"file_{document.file_unique_id}"
+        mime = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    elif photos := update.message.photo:
+        # Take the largest size
+        tg_file = photos[-1]
+        filename = f"photo_{tg_file.file_unique_id}.jpg"
+        mime = "image/jpeg"
+    else:
+        return WAIT_ATTACHMENTS
+
+    async def report(ok, failed):
+        await update.message.reply_text(_ingest_summary(ok, failed))
 
+    _ingest_batch(context, update.effective_user.id).submit(
+        filename, lambda: _fetch_attachment(update, context, tg_file, filename, mime), report)
     return WAIT_ATTACHMENTS
 
+def _ingest_summary(ok, failed) -> str:
+    lines = []
+    if len(ok) == 1:
+        lines.append(f"✅ Got file: {ok[0]}")
+    elif ok:
+        lines.append(f"✅ Got {len(ok)} files: " + ", ".join(ok))
+    for filename, error in failed:
+        if isinstance(error, AttachmentLimitError):
+            lines.append(f"⚠️ {filename}: {error}")
+        elif isinstance(error, telegram.error.TimedOut):
+            lines.append(f"⚠️ {filename}: download timed out. Try a smaller file or better connection.")
+        else:
+            lines.append(f"⚠️ {filename}: error processing attachment: {error}")
+    lines.append("\nSend more attachments or type /done when finished")
+    return "\n".join(lines)
+
 async def done_attachments(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Let in-flight downloads finish (and be reported) before summarizing
+    batch = context.application.bot_data.get("ingest", {}).get(update.effective_user.id)
+    if batch is not None:
+        await batch.drain()
+
     # Check if email has been generated yet
     if "generated_email" not in context.user_data or "generated_subject" not in context.user_data:
+        if await _throttled(update, context, "generate", len(_tones(context)), "then type /done again"):
+            return None
+        if len(_tones(context)) > 1:
+            return await _offer_variants(update, context)
         # We need to generate the email first
-        await update.message.reply_text("⏳ Generating your email, please wait...")
-        email_text, subject = await generate_email_from_api(context)
+        email_text, subject = await _generate_with_preview(update, context)
         context.user_data["generated_email"] = email_text
         context.user_data["generated_subject"] = subject
-    
+    return await _show_summary(update, context)
+
+async def _show_summary(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Show a summary with attachments
-    attachments_count = len(context.user_data.get("files", []))
+    attachments_count = len(_attachments(context).files(update.effective_user.id))
     attachment_text = f"📎 {attachments_count} attachment(s)" if attachments_count > 0 else "No attachments"
     
     # Show email preview
@@ -241,12 +310,69 @@ async def done_attachments(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(preview, reply_markup=kb)
     return CONFIRM
 
+def _tones(context):
+    tones = [t.strip() for t in context.user_data["tone"].split(",") if t.strip()]
+    return tones[:MAX_VARIANTS]
+
+async def _offer_variants(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # One draft per tone, generated concurrently; each is shown as soon as it is ready
+    tones = _tones(context)
+    await update.message.reply_text(f"⏳ Writing {len(tones)} versions ({', '.join(tones)}), please wait...")
+    drafts, error = [], None
+    try:
+        with timed_call("batch"):
+            async for result in _backend(context).generate_batch(_generation_fields(context),
+                                                                 [{"tone": t} for t in tones], _client(update)):
+                number, tone = result["index"] + 1, tones[result["index"]]
+                if "error" in result:
+                    error = result["error"]
+                    await update.message.reply_text(f"⚠️ Version {number} ({tone}) failed: {error}")
+                    continue
+                drafts.append({"number": number, "tone": tone, "subject": result["subject"], "email": result["email"]})
+                await update.message.reply_text(
+                    f"📝 Version {number} · {tone}\nSubject: {result['subject']}\n\n{result['email'][:1000]}")
+    except Exception as e:
+        error = str(e)
+
+    if len(drafts) <= 1:
+        # Nothing to choose between: carry on as with a single tone
+        if drafts:
+            _use_variant(context, drafts[0])
+        else:
+            context.user_data["generated_email"] = f"⚠️ Failed to generate email: {error}"
+            context.user_data["generated_subject"] = ""
+        return await _show_summary(update, context)
+
+    drafts.sort(key=lambda d: d["number"])
+    context.user_data["variants"] = drafts
+    kb = ReplyKeyboardMarkup([[f"{d['number']}. {d['tone']}"] for d in drafts], one_time_keyboard=True,
+                             resize_keyboard=True)
+    await update.message.reply_text("Which version should I use?", reply_markup=kb)
+    return CHOOSE_VARIANT
+
+def _use_variant(context, draft):
+    context.user_data["tone"] = draft["tone"]
+    context.user_data["generated_email"] = draft["email"]
+    context.user_data["generated_subject"] = draft["subject"]
+
+async def choose_variant(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    choice = update.message.text.strip()
+    drafts = context.user_data.get("variants", [])
+    picked = next((d for d in drafts if choice.split(".")[0].strip() == str(d["number"])
+                   or choice.lower() == d["tone"].lower()), None)
+    if picked is None:
+        await update.message.reply_text("Please pick one of the versions above (e.g. 1).")
+        return CHOOSE_VARIANT
+    context.user_data.pop("variants", None)
+    _use_variant(context, picked)
+    return await _show_summary(update, context)
+
 # Update confirm_send to handle both attachment and non-attachment flows
 async def confirm_send(update: Update, context: ContextTypes.DEFAULT_TYPE):
     choice = update.message.text.strip().lower()
     if "send" in choice or "✅" in choice:
         # If we already have attachments, send directly
-        if "files" in context.user_data and context.user_data["files"]:
+        if _attachments(context).files(update.effective_user.id):
             return await _send_now(update, context)
         else:
             # Otherwise ask if they want to add attachments
@@ -255,14 +381,14 @@ async def confirm_send(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return ATTACH_OR_SEND
     else:
         await update.message.reply_text("❌ Email canceled.")
-        return ConversationHandler.END
+        return _end_conversation(update, context)
 
 # Make _send_now more robust with fallbacks for missing keys
 async def _send_now(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Check if we have the necessary data
     if "generated_email" not in context.user_data or "generated_subject" not in context.user_data:
         await update.message.reply_text("⚠️ Email content is missing. Let's start over.")
-        return ConversationHandler.END
+        return _end_conversation(update, context)
         
     # Send via HF /send-email
     data = {
@@ -270,33 +396,149 @@ async def _send_now(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "subject": context.user_data["generated_subject"],
         "body": context.user_data["generated_email"]
     }
+    if SEND_DEFERRED:
+        data["deferred"] = "true"
 
-    files = []
-    for (filename, bio, mime) in context.user_data.get("files", []):
-        files.append(("attachments", (filename, bio, mime)))
+    files = _attachments(context).files(update.effective_user.id)
+    if await _throttled(update, context, "send", 1, "then try sending again"):
+        return None
 
     try:
         await update.message.reply_text("📤 Sending email...")
-        r = requests.post(f"{API_BASE}/send-email", data=data, files=files if files else None, timeout=60)
-        resp = r.json()
-        if r.ok:
+        with timed_call("send"):
+            resp = await _backend(context).send(data, files, _client(update))
+        if resp.get("status") == "queued":
+            await update.message.reply_text(f"📬 Email to {resp.get('to', data['recipient'])} queued for delivery (job {resp.get('job_id')})")
+        elif resp.get("refused"):
+            await update.message.reply_text(f"⚠️ Email sent, but the mail server refused: {resp['refused']}")
+        else:
             await update.message.reply_text(f"✅ Email sent to {resp.get('to', data['recipient'])} successfully!")
+    except BackendError as e:
+        error_msg = str(e)
+        if "BadCredentials" in error_msg:
+            await update.message.reply_text("❌ Email login failed. Please check GMAIL_USER and GMAIL_PASS in server config.")
         else:
-            error_msg = resp.get('error', str(resp))
-            if "BadCredentials" in str(error_msg):
-                await update.message.reply_text("❌ Email login failed. Please check GMAIL_USER and GMAIL_PASS in server config.")
-            else:
-                await update.message.reply_text(f"❌ Failed: {error_msg}")
+            await update.message.reply_text(f"❌ Failed: {error_msg}")
     except Exception as e:
         await update.message.reply_text(f"❌ Error: {str(e)[:100]}...")
 
-    return ConversationHandler.END
+    return _end_conversation(update, context)
+
+def _backend(context) -> EmailBackend:
+    return context.application.bot_data["backend"]
+
+def _client(update: Update) -> str:
+    # How the API tells chats apart for its own rate limits and fair queueing
+    return f"tg:{update.effective_chat.id}"
+
+async def _throttled(update: Update, context: ContextTypes.DEFAULT_TYPE, kind: str, cost: int,
+                     retry_hint: str) -> bool:
+    # True (after telling the user when to retry) if the chat is over its limit;
+    # the caller then stays in the current step
+    wait = context.application.bot_data["limits"][kind].take(update.effective_chat.id, cost)
+    if not wait:
+        return False
+    THROTTLED.labels(kind).inc()
+    what = "emails generated" if kind == "generate" else "emails sent"
+    await update.message.reply_text(f"⏳ Too many {what} in a short time. Please wait {math.ceil(wait)}s, "
+                                    f"{retry_hint}.")
+    return True
+
+async def _startup(application: Application):
+    if BOT_BACKEND == "inprocess":
+        backend = InProcessBackend()
+    else:
+        backend = RemoteBackend(ApiClient(
+            API_BASE,
+            max_connections=int(os.getenv("API_MAX_CONNECTIONS", "20")),
+            retries=int(os.getenv("API_RETRIES", "2")),
+            client_secret=os.getenv("CLIENT_ID_SECRET"),
+        ))
+    await backend.start()
+    application.bot_data["backend"] = backend
+    application.bot_data["limits"] = {
+        "generate": RateLimiter(GENERATE_PER_MINUTE, GENERATE_BURST),
+        "send": RateLimiter(SEND_PER_MINUTE, SEND_BURST),
+    }
+
+    store = AttachmentStore(
+        memory_budget=int(os.getenv("ATTACHMENT_MEMORY_BUDGET", str(64 * 1024 * 1024))),
+        spill_threshold=int(os.getenv("ATTACHMENT_SPILL_THRESHOLD", str(2 * 1024 * 1024))),
+        max_per_owner=int(os.getenv("MAX_ATTACHMENTS", "10")),
+        ttl=float(os.getenv("ATTACHMENT_TTL", "1800")),
+    )
+    store.start()
+    application.bot_data["attachments"] = store
+
+    if application.persistence is not None:
+        application.persistence.attachments = store
+
+    cache_bytes = int(os.getenv("FILE_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+    if cache_bytes > 0:
+        cache_dir = os.getenv("FILE_CACHE_DIR", os.path.join(ROOT_DIR, "data", "file_cache"))
+        application.bot_data["file_cache"] = FileCache(Path(cache_dir), max_bytes=cache_bytes)
+
+async def _shutdown(application: Application):
+    backend = application.bot_data.pop("backend", None)
+    if backend is not None:
+        await backend.close()
+    store = application.bot_data.pop("attachments", None)
+    if store is not None:
+        await store.close()
+    cache = application.bot_data.pop("file_cache", None)
+    if cache is not None:
+        cache.close()
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("❌ Cancelled.")
+    return _end_conversation(update, context)
+
+def _attachments(context) -> AttachmentStore:
+    return context.application.bot_data["attachments"]
+
+def _end_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Attachments only live as long as the conversation that collected them
+    batch = context.application.bot_data.get("ingest", {}).pop(update.effective_user.id, None)
+    if batch is not None:
+        batch.cancel()
+    _attachments(context).release(update.effective_user.id)
     return ConversationHandler.END
 
-async def generate_email_from_api(context):
+async def restore_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Runs before the conversation handler: picks up progress another worker saved
+    # and drops conversations that sat idle past CONVERSATION_TIMEOUT
+    if update.effective_user is None:
+        return
+    persistence = context.application.persistence
+    message = update.effective_message
+    if await persistence.sync(update.effective_user.id, context.user_data):
+        _end_conversation(update, context)
+        if message is not None and not (message.text or "").startswith("/"):
+            await message.reply_text("⌛ Your previous email draft expired. Send /start to begin a new one.")
+    elif missing := persistence.missing_files(update.effective_user.id):
+        if message is not None:
+            await message.reply_text("⚠️ These attachments could not be recovered and won't be sent: "
+                                     + ", ".join(missing) + ". Please send them again.")
+
+async def save_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Runs after the conversation handler, so a restart never loses a step;
+    # records that didn't change are not rewritten. PTB would only mark the
+    # user's data as touched after this handler returns.
+    if update.effective_user is not None:
+        context.application.mark_data_for_update_persistence(user_ids=update.effective_user.id)
+    await context.application.update_persistence()
+
+def _build_persistence():
+    if BOT_PERSISTENCE == "off":
+        return None
+    data_dir = os.path.join(ROOT_DIR, "data")
+    if BOT_PERSISTENCE == "file":
+        records = FileStore(Path(PERSISTENCE_PATH or os.path.join(data_dir, "conversations")))
+    else:
+        records = SQLiteStore(Path(PERSISTENCE_PATH or os.path.join(data_dir, "conversations.sqlite3")))
+    return ConversationPersistence(records, timeout=CONVERSATION_TIMEOUT)
+
+def _generation_fields(context):
     # Include position/field based on role
     role = context.user_data["role"]
     position = context.user_data.get("position", "")
@@ -307,7 +549,7 @@ async def generate_email_from_api(context):
     else:
         position_info = position
     
-    data = {
+    return {
         "role": role,
         "tone": context.user_data["tone"],
         "topic": context.user_data["topic"],
@@ -316,24 +558,79 @@ async def generate_email_from_api(context):
         "position": position_info,
         "recipient_name": context.user_data.get("recipient_name", "Dear Sir/Madam")
     }
+
+async def generate_email_from_api(context, client: Optional[str] = None):
+    data = _generation_fields(context)
     
     try:
-        r = requests.post(f"{API_BASE}/generate-email", data=data, timeout=30)
-        r.raise_for_status()
-        resp = r.json()
+        with timed_call("generate"):
+            resp = await _backend(context).generate(data, client)
         return resp.get("email", ""), resp.get("subject", "")
     except Exception as e:
         return f"⚠️ Failed to generate email: {str(e)}", ""
 
+async def stream_email_from_api(context, on_text, client: Optional[str] = None):
+    # Consume /generate-email/stream; on_text gets the accumulated draft after each chunk
+    text, subject = "", ""
+    with timed_call("stream"):
+        async for event, data in _backend(context).stream(_generation_fields(context), client):
+            if event == "meta":
+                subject = data.get("subject", "")
+            elif event == "delta":
+                text += data.get("text", "")
+                await on_text(text)
+            elif event == "done":
+                return data.get("email", text.strip()), data.get("subject", subject)
+            elif event == "error":
+                raise RuntimeError(data.get("error", "generation failed"))
+    return text.strip(), subject
+
+async def _generate_with_preview(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    status = await update.message.reply_text("⏳ Generating your email, please wait...")
+    if not BOT_STREAMING:
+        return await generate_email_from_api(context, _client(update))
+
+    last_edit = 0.0
+    shown = ""
+
+    async def on_text(text):
+        nonlocal last_edit, shown
+        now = time.monotonic()
+        if now - last_edit < STREAM_EDIT_INTERVAL or not text.strip():
+            return
+        last_edit = now
+        shown = text[:4000]
+        try:
+            await status.edit_text(f"✍️ {shown} ▌")
+        except telegram.error.RetryAfter as e:
+            # Flood control: skip edits until Telegram lets us back in
+            last_edit = now + e.retry_after
+        except telegram.error.TelegramError:
+            pass
+
+    try:
+        email_text, subject = await stream_email_from_api(context, on_text, _client(update))
+    except Exception as e:
+        return f"⚠️ Failed to generate email: {str(e)}", ""
+    if email_text[:4000] != shown:
+        try:
+            await status.edit_text(email_text[:4000])
+        except telegram.error.TelegramError:
+            pass
+    return email_text, subject
+
 # Add this missing function for subject handling
 async def get_subject(update: Update, context: ContextTypes.DEFAULT_TYPE):
     subject_choice = update.message.text.strip()
     if subject_choice.lower() != "auto":
         context.user_data["subject"] = subject_choice
+    if await _throttled(update, context, "generate", len(_tones(context)), "then send the subject again"):
+        return None
+    if len(_tones(context)) > 1:
+        return await _offer_variants(update, context)
     
     # Generate email
-    await update.message.reply_text("⏳ Generating your email, please wait...")
-    email_text, subject = await generate_email_from_api(context)
+    email_text, subject = await _generate_with_preview(update, context)
     context.user_data["generated_email"] = email_text
     context.user_data["generated_subject"] = subject
     
@@ -343,6 +640,69 @@ async def get_subject(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(preview, reply_markup=kb)
     return CONFIRM
 
+def build_webhook_app(application: Application):
+    # ASGI front end for webhook mode: Telegram POSTs updates here and they are
+    # queued on the Application, which processes them like polled updates. Plain
+    # Starlette, imported only here: FastAPI would add ~0.4 s to every cold start
+    # for three routes, and polling mode needs no web server at all.
+    from starlette.applications import Starlette
+    from starlette.requests import Request
+    from starlette.responses import JSONResponse, Response
+    from starlette.routing import Route
+
+    @asynccontextmanager
+    async def lifespan(_):
+        async with application:
+            if application.post_init:
+                await application.post_init(application)
+            await application.bot.set_webhook(
+                url=f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES,
+                max_connections=min(100, BOT_CONCURRENCY),
+            )
+            await application.start()
+            yield
+            await application.stop()
+            if application.post_shutdown:
+                await application.post_shutdown(application)
+
+    async def telegram_webhook(request: Request):
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(token, WEBHOOK_SECRET):
+            return Response(status_code=403)
+        # Anything that isn't a valid update gets a 400: a 500 would make
+        # Telegram retry the same payload forever
+        try:
+            payload = await request.json()
+            if not isinstance(payload, dict):
+                return Response(status_code=400)
+            update = Update.de_json(payload, application.bot)
+        except (TypeError, KeyError, AttributeError, ValueError):
+            return Response(status_code=400)
+        await application.update_queue.put(update)
+        return Response(status_code=200)
+
+    async def health(request: Request):
+        store = application.bot_data.get("attachments")
+        cache = application.bot_data.get("file_cache")
+        return JSONResponse({
+            "status": "ok",
+            "pending_updates": application.update_queue.qsize(),
+            "attachments": store.stats() if store is not None else None,
+            "file_cache": await asyncio.to_thread(cache.stats) if cache is not None else None,
+        })
+
+    async def metrics(request: Request):
+        body, content_type = render_metrics()
+        return Response(body, media_type=content_type)
+
+    return Starlette(lifespan=lifespan, routes=[
+        Route(WEBHOOK_PATH, telegram_webhook, methods=["POST"]),
+        Route("/health", health),
+        Route("/metrics", metrics),
+    ])
+
 # Update main() to use webhooks when deployed
 def main():
     token = TELEGRAM_TOKEN
@@ -353,38 +713,60 @@ def main():
     is_production = os.environ.get("PRODUCTION", "False").lower() == "true"
     
     # Build application
-    app = Application.builder().token(token).job_queue(None).build()
+    persistence = _build_persistence()
+    builder = (
+        Application.builder().token(token).job_queue(None)
+        .concurrent_updates(PerChatUpdateProcessor(BOT_CONCURRENCY))
+        .post_init(_startup)
+        .post_shutdown(_shutdown)
+    )
+    if persistence is not None:
+        builder = builder.persistence(persistence)
+    app = builder.build()
     
     # Add handlers
-    conv = ConversationHandler(
-        entry_points=[CommandHandler("start", start)],
+    conv = shared_conversation(
+        persistence,
+        entry_points=[CommandHandler("start", timed_handler(start))],
         states={
-            ROLE: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_role)],
-            NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_name)],
-            POSITION: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_position)],
-            TONE: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_tone)],
-            TOPIC: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_topic)],
-            RECIPIENT_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_recipient_name)],
-            RECIPIENT: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_recipient)],
-            SUBJECT: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_subject)],
-            CONFIRM: [MessageHandler(filters.TEXT & ~filters.COMMAND, confirm_send)],
-            ATTACH_OR_SEND: [MessageHandler(filters.TEXT & ~filters.COMMAND, attach_or_send)],
+            ROLE: [MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(get_role))],
+            NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(get_name))],
+            POSITION: [MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(get_position))],
+            TONE: [MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(get_tone))],
+            TOPIC: [MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(get_topic))],
+            RECIPIENT_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(get_recipient_name))],
+            RECIPIENT: [MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(get_recipient))],
+            SUBJECT: [MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(get_subject))],
+            CONFIRM: [MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(confirm_send))],
+            CHOOSE_VARIANT: [MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(choose_variant))],
+            ATTACH_OR_SEND: [MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(attach_or_send))],
             WAIT_ATTACHMENTS: [
-                MessageHandler(filters.PHOTO | filters.Document.ALL, receive_attachment),
-                CommandHandler("done", done_attachments)
+                MessageHandler(filters.PHOTO | filters.Document.ALL, timed_handler(receive_attachment)),
+                CommandHandler("done", timed_handler(done_attachments))
             ],
         },
-        fallbacks=[CommandHandler("cancel", cancel)],
+        fallbacks=[CommandHandler("cancel", timed_handler(cancel))],
+        name="email",
     )
     app.add_handler(conv)
+    if persistence is not None:
+        app.add_handler(TypeHandler(Update, timed_handler(restore_conversation)), group=-1)
+        app.add_handler(TypeHandler(Update, timed_handler(save_conversation)), group=1)
     
     # Use webhook in production, polling in development
     if is_production:
-        # Set up webhook mode (handled by FastAPI)
-        print("🤖 Telegram bot running in webhook mode...")
+        if not WEBHOOK_URL:
+            raise RuntimeError("Set WEBHOOK_URL to the bot's public URL for webhook mode")
+        import uvicorn
+        print(f"🤖 Telegram bot running in webhook mode on port {PORT}...")
+        uvicorn.run(build_webhook_app(app), host="0.0.0.0", port=PORT)
     else:
         # Use polling for local development
         print("🤖 Telegram bot running in polling mode... /start")
+        if METRICS_PORT:
+            from prometheus_client import start_http_server
+            render_metrics()  # registers every metric, so the first scrape lists them all
+            start_http_server(METRICS_PORT)
         app.run_polling()
         
     return app
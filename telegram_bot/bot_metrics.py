@@ -0,0 +1,48 @@
+import functools, time
+from contextlib import contextmanager
+
+from lazy_metrics import Counter, Histogram  # api/lazy_metrics.py; bot.py puts the API directory on the path
+
+# Prometheus metrics for the bot. Served on the webhook app's /metrics, or on
+# METRICS_PORT in polling mode. Names differ from the API's (email_api_*) so
+# both can share one registry when the bot runs the API in-process.
+# prometheus_client is only imported once a metric is first used.
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+HANDLER_SECONDS = Histogram("email_bot_handler_seconds", "Conversation handler latency", ["handler"],
+                            buckets=BUCKETS)
+BACKEND_SECONDS = Histogram("email_bot_backend_seconds", "Calls to the email backend (generate, stream, send)",
+                            ["call", "result"], buckets=BUCKETS)
+DOWNLOAD_SECONDS = Histogram("email_bot_download_seconds", "Telegram file downloads, retries included",
+                             buckets=BUCKETS)
+DOWNLOADS = Counter("email_bot_downloads_total", "Attachment fetches by outcome (cached, downloaded, failed)",
+                    ["result"])
+DOWNLOAD_BYTES = Counter("email_bot_download_bytes_total", "Bytes downloaded from Telegram")
+THROTTLED = Counter("email_bot_throttled_total", "Generations and sends refused by the per-chat rate limits",
+                    ["kind"])
+
+
+def timed_handler(handler):
+    # Wraps a PTB callback so its latency is recorded under the function's name
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await handler(update, context)
+        finally:
+            HANDLER_SECONDS.labels(handler.__name__).observe(time.perf_counter() - started)
+
+    return wrapper
+
+
+@contextmanager
+def timed_call(call: str):
+    # Times a backend call, labelled ok or error by whether the block raised
+    started = time.perf_counter()
+    result = "error"
+    try:
+        yield
+        result = "ok"
+    finally:
+        BACKEND_SECONDS.labels(call, result).observe(time.perf_counter() - started)
@@ -0,0 +1,84 @@
+import hashlib, os, sqlite3, tempfile, threading, time
+from pathlib import Path
+from typing import BinaryIO, Optional
+
+
+class FileCache:
+    # Content-addressed store for downloaded Telegram files. Blobs are named by
+    # their SHA-256, so the same bytes are kept once however many file_unique_ids
+    # (or users) point at them; the least recently used blobs are evicted once the
+    # cache grows past max_bytes.
+    def __init__(self, root: Path, max_bytes: int = 512 * 1024 * 1024):
+        self.root = Path(root)
+        self.blobs = self.root / "blobs"
+        self.blobs.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(self.root / "index.sqlite3"), check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS blobs (sha TEXT PRIMARY KEY, size INTEGER, last_used REAL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS files (unique_id TEXT PRIMARY KEY, sha TEXT)")
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, unique_id: str) -> Optional[Path]:
+        with self._lock:
+            row = self._db.execute("SELECT sha FROM files WHERE unique_id=?", (unique_id,)).fetchone()
+            path = self.blobs / row[0] if row else None
+            if path is None or not path.exists():
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE blobs SET last_used=? WHERE sha=?", (time.time(), row[0]))
+            self.hits += 1
+            return path
+
+    def put(self, unique_id: str, fileobj: BinaryIO) -> Path:
+        # Copies fileobj into the cache (hashing as it goes) and returns the blob path
+        fileobj.seek(0)
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp = tempfile.mkstemp(dir=self.root, prefix=".incoming_")
+        try:
+            with os.fdopen(fd, "wb") as out:
+                while chunk := fileobj.read(1024 * 1024):
+                    digest.update(chunk)
+                    out.write(chunk)
+                    size += len(chunk)
+            sha = digest.hexdigest()
+            path = self.blobs / sha
+            with self._lock:
+                if path.exists():
+                    os.unlink(tmp)
+                else:
+                    os.replace(tmp, path)
+                self._db.execute("INSERT OR REPLACE INTO blobs (sha, size, last_used) VALUES (?, ?, ?)",
+                                 (sha, size, time.time()))
+                self._db.execute("INSERT OR REPLACE INTO files (unique_id, sha) VALUES (?, ?)", (unique_id, sha))
+                self._evict(keep=sha)
+            return path
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+    def _evict(self, keep: str):
+        # Open attachments keep their file handles, so unlinking under them is safe
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+        while total > self.max_bytes:
+            row = self._db.execute("SELECT sha, size FROM blobs WHERE sha != ? ORDER BY last_used LIMIT 1",
+                                   (keep,)).fetchone()
+            if row is None:
+                break
+            sha, size = row
+            (self.blobs / sha).unlink(missing_ok=True)
+            self._db.execute("DELETE FROM blobs WHERE sha=?", (sha,))
+            self._db.execute("DELETE FROM files WHERE sha=?", (sha,))
+            total -= size
+
+    def stats(self) -> dict:
+        with self._lock:
+            count, size = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs").fetchone()
+        return {"blobs": count, "bytes": size, "hits": self.hits, "misses": self.misses}
+
+    def close(self):
+        self._db.close()
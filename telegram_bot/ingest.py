@@ -0,0 +1,73 @@
+import asyncio
+from typing import Awaitable, Callable, List, Optional, Set, Tuple
+
+Reporter = Callable[[List[str], List[Tuple[str, BaseException]]], Awaitable]
+
+
+class IngestBatch:
+    # Attachment downloads for one chat. Files run concurrently (up to `concurrency`)
+    # in background tasks, so the handler returns at once and the chat keeps
+    # responding; once nothing is in flight and no new file has arrived for `quiet`
+    # seconds, the burst (e.g. an album) is reported with a single message.
+    def __init__(self, concurrency: int = 4, quiet: float = 1.0):
+        self.quiet = quiet
+        self._slots = asyncio.Semaphore(max(1, concurrency))
+        self._pending: Set[asyncio.Task] = set()
+        self._ok: List[str] = []
+        self._failed: List[Tuple[str, BaseException]] = []
+        self._version = 0
+        self._reporter: Optional[asyncio.Task] = None
+        self._report: Optional[Reporter] = None
+
+    def submit(self, name: str, fetch: Callable[[], Awaitable], report: Reporter):
+        # report is refreshed on every file so the summary replies to the latest message
+        self._report = report
+        self._version += 1
+        task = asyncio.ensure_future(self._run(name, fetch))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+        if self._reporter is None or self._reporter.done():
+            self._reporter = asyncio.ensure_future(self._report_when_quiet())
+
+    async def _run(self, name: str, fetch: Callable[[], Awaitable]):
+        async with self._slots:
+            try:
+                await fetch()
+                self._ok.append(name)
+            except Exception as e:
+                self._failed.append((name, e))
+
+    async def _report_when_quiet(self):
+        while True:
+            if self._pending:
+                await asyncio.wait(set(self._pending))
+                continue
+            seen = self._version
+            await asyncio.sleep(self.quiet)
+            if not self._pending and seen == self._version:
+                break
+        # Shielded so drain() cancelling us can't drop a report that is being sent
+        await asyncio.shield(self.flush())
+
+    async def flush(self):
+        if not (self._ok or self._failed) or self._report is None:
+            return
+        ok, failed = self._ok, self._failed
+        self._ok, self._failed = [], []
+        await self._report(ok, failed)
+
+    async def drain(self):
+        # Wait for every download, then report right away instead of after the quiet period
+        while self._pending:
+            await asyncio.wait(set(self._pending))
+        if self._reporter is not None:
+            self._reporter.cancel()
+            self._reporter = None
+        await self.flush()
+
+    def cancel(self):
+        for task in list(self._pending):
+            task.cancel()
+        if self._reporter is not None:
+            self._reporter.cancel()
+            self._reporter = None
@@ -0,0 +1,393 @@
+import asyncio, json, os, sqlite3, tempfile, threading, time
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from telegram import Update
+from telegram.ext import BaseHandler, BasePersistence, ConversationHandler, PersistenceInput
+
+from attachments import AttachmentLimitError, AttachmentStore
+
+
+class RecordStore:
+    # Key -> (JSON payload, last update time). One record per user.
+    def get(self, key: str) -> Optional[Tuple[str, float]]:
+        raise NotImplementedError
+
+    def put(self, key: str, payload: str, updated: float):
+        raise NotImplementedError
+
+    def delete(self, key: str):
+        raise NotImplementedError
+
+    def items(self) -> Iterator[Tuple[str, str, float]]:
+        raise NotImplementedError
+
+    def purge(self, before: float) -> int:
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SQLiteStore(RecordStore):
+    # Default backend. WAL mode lets several bot processes on one host share the file.
+    def __init__(self, path: Path):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None, timeout=10)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS conversations "
+                         "(key TEXT PRIMARY KEY, payload TEXT, updated REAL)")
+
+    def get(self, key: str) -> Optional[Tuple[str, float]]:
+        with self._lock:
+            return self._db.execute("SELECT payload, updated FROM conversations WHERE key=?", (key,)).fetchone()
+
+    def put(self, key: str, payload: str, updated: float):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO conversations (key, payload, updated) VALUES (?, ?, ?)",
+                             (key, payload, updated))
+
+    def delete(self, key: str):
+        with self._lock:
+            self._db.execute("DELETE FROM conversations WHERE key=?", (key,))
+
+    def items(self) -> Iterator[Tuple[str, str, float]]:
+        with self._lock:
+            rows = self._db.execute("SELECT key, payload, updated FROM conversations").fetchall()
+        return iter(rows)
+
+    def purge(self, before: float) -> int:
+        with self._lock:
+            return self._db.execute("DELETE FROM conversations WHERE updated < ?", (before,)).rowcount
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class FileStore(RecordStore):
+    # One small JSON file per key, replaced atomically; the file's mtime is the
+    # update time. Stand-in for a shared key-value store: point it at a volume
+    # every bot worker mounts.
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key: str) -> Path:
+        return self.root / f"{key}.json"
+
+    def get(self, key: str) -> Optional[Tuple[str, float]]:
+        path = self._path(key)
+        try:
+            return path.read_text(encoding="utf-8"), path.stat().st_mtime
+        except FileNotFoundError:
+            return None
+
+    def put(self, key: str, payload: str, updated: float):
+        fd, tmp = tempfile.mkstemp(dir=self.root, prefix=".incoming_")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as out:
+                out.write(payload)
+            os.utime(tmp, (updated, updated))
+            os.replace(tmp, self._path(key))
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+    def delete(self, key: str):
+        self._path(key).unlink(missing_ok=True)
+
+    def items(self) -> Iterator[Tuple[str, str, float]]:
+        for path in self.root.glob("*.json"):
+            found = self.get(path.stem)
+            if found is not None:
+                yield path.stem, found[0], found[1]
+
+    def purge(self, before: float) -> int:
+        removed = 0
+        for path in self.root.glob("*.json"):
+            try:
+                if path.stat().st_mtime < before:
+                    path.unlink()
+                    removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
+
+
+class ConversationPersistence(BasePersistence):
+    # Persists user_data and ConversationHandler states as one compact JSON record
+    # per user. Only users with a conversation in progress are kept, a record is
+    # rewritten only when its content changed, and attachments are stored as
+    # references to file-cache paths rather than bytes (in-memory and temp-file
+    # attachments are not kept). Records untouched for `timeout` seconds expire.
+    # Conversation keys must end with the user id (the default per_user=True).
+    # Build conversations with shared_conversation() so steps taken on another
+    # worker are picked up.
+    def __init__(self, records: RecordStore, timeout: float = 86400, update_interval: float = 60):
+        super().__init__(store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True,
+                                                     callback_data=False),
+                         update_interval=update_interval)
+        self.records = records
+        self.timeout = timeout
+        self.attachments: Optional[AttachmentStore] = None  # set once the bot has started
+        self._state: Dict[int, dict] = {}    # user id -> {"data": ..., "conv": {name: {key: state}}}
+        self._written: Dict[int, str] = {}   # user id -> payload last read or written
+        self._updated: Dict[int, float] = {}  # user id -> update time of that payload
+        self._loading: Optional[asyncio.Future] = None
+        self._names: List[str] = []
+        # name -> {conversation key -> state}: progress made on another worker that
+        # this worker's handler has yet to pick up (None: the conversation ended)
+        self._adopted: Dict[str, Dict[tuple, Optional[object]]] = {}
+        self._missing: Dict[int, List[str]] = {}  # user id -> attachments that could not be restored
+        self._next_purge = 0.0
+        self.stats = {"writes": 0, "skipped": 0, "adopted": 0, "expired": 0}
+
+    def track(self, name: str):
+        # Conversations whose states sync() hands over when another worker moved them on
+        self._names.append(name)
+        self._adopted.setdefault(name, {})
+
+    def _expired(self, updated: float) -> bool:
+        return self.timeout > 0 and updated < time.time() - self.timeout
+
+    async def _load(self):
+        # PTB asks for user data and each conversation separately; the store is read once
+        if self._loading is None:
+            self._loading = asyncio.ensure_future(asyncio.to_thread(self._read_all))
+            for key, payload, updated in await self._loading:
+                record = json.loads(payload)
+                self._state[int(key)] = {"data": record["data"], "conv": record["conv"]}
+                self._written[int(key)] = payload
+                self._updated[int(key)] = updated
+        else:
+            await self._loading
+
+    def _read_all(self) -> List[Tuple[str, str, float]]:
+        rows = []
+        for key, payload, updated in self.records.items():
+            if self._expired(updated):
+                self.records.delete(key)
+            else:
+                rows.append((key, payload, updated))
+        return rows
+
+    def _payload(self, user_id: int) -> Optional[str]:
+        state = self._state.get(user_id)
+        if not state or not state["conv"]:
+            return None
+        files = []
+        if self.attachments is not None:
+            # Only file-cache references can be re-attached; the rest are listed by
+            # name so the user can be asked to send them again
+            files = [[a.filename, a.mime, str(a.path) if a.reference else None]
+                     for a in self.attachments.files(user_id)]
+        return json.dumps({"data": state["data"], "conv": state["conv"], "files": files},
+                          sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+
+    async def _save(self, user_id: int):
+        # Lets the other updates of the same persistence run land first, so a
+        # state change and a user_data change make one write, not two
+        await asyncio.sleep(0)
+        payload = self._payload(user_id)
+        if payload == self._written.get(user_id):
+            self.stats["skipped"] += 1
+            return
+        if payload is None:
+            self._forget(user_id)
+            await asyncio.to_thread(self.records.delete, str(user_id))
+        else:
+            self._written[user_id] = payload
+            self._updated[user_id] = time.time()
+            await asyncio.to_thread(self.records.put, str(user_id), payload, self._updated[user_id])
+        self.stats["writes"] += 1
+        if time.time() >= self._next_purge and self.timeout > 0:
+            self._next_purge = time.time() + min(600, self.timeout)
+            await asyncio.to_thread(self.records.purge, time.time() - self.timeout)
+
+    def _forget(self, user_id: int):
+        self._state.pop(user_id, None)
+        self._written.pop(user_id, None)
+        self._updated.pop(user_id, None)
+
+    async def sync(self, user_id: int, user_data: dict) -> bool:
+        # Call before the conversation handler sees an update. Adopts the stored
+        # record if another worker wrote it since we last did, re-attaches files
+        # after a restart, and resets conversations that went idle for too long.
+        # Returns True when the user's conversation has just expired. Store calls
+        # run in a thread: SQLite may wait up to 10 s on another worker's write lock.
+        found = await asyncio.to_thread(self.records.get, str(user_id))
+        if found is not None:
+            expired = self._expired(found[1])
+        else:
+            # Gone from the store: ended by another worker, or purged after expiring
+            expired = user_id in self._updated and self._expired(self._updated[user_id])
+        if expired:
+            await asyncio.to_thread(self.records.delete, str(user_id))
+            self.stats["expired"] += 1
+            found = None
+        payload = found[0] if found else None
+        if payload != self._written.get(user_id) or expired:
+            record = json.loads(payload) if payload else {"data": {}, "conv": {}, "files": []}
+            user_data.clear()
+            user_data.update(record["data"])
+            self._adopt_states(self._state.get(user_id, {}).get("conv", {}), record["conv"])
+            if payload:
+                self._state[user_id] = {"data": record["data"], "conv": record["conv"]}
+                self._written[user_id] = payload
+                self._updated[user_id] = found[1]
+            else:
+                self._forget(user_id)
+            self.stats["adopted"] += 1
+        if payload and self.attachments is not None and not self.attachments.files(user_id):
+            self._restore_files(user_id, json.loads(payload)["files"])
+        return expired
+
+    def _adopt_states(self, ours: dict, theirs: dict):
+        # PTB reads persisted states only at startup. States that differ from what
+        # this worker last saved are queued for the conversation's _AdoptState
+        # handler, which applies them on the user's next update.
+        for name in self._names:
+            old, new = ours.get(name, {}), theirs.get(name, {})
+            for k in set(old) | set(new):
+                if old.get(k) != new.get(k):
+                    self._adopted[name][tuple(int(p) for p in k.split(":"))] = new.get(k)
+
+    def _restore_files(self, user_id: int, files: list):
+        missing = []
+        for filename, mime, path in files:
+            if path is None or not os.path.exists(path):
+                missing.append(filename)  # never cached, or evicted from the file cache since
+                continue
+            try:
+                self.attachments.add_reference(user_id, filename, mime, Path(path))
+            except (AttachmentLimitError, FileNotFoundError):
+                missing.append(filename)
+        if missing:
+            self._missing[user_id] = missing
+
+    def missing_files(self, user_id: int) -> List[str]:
+        # Names of attachments sync() could not restore; reported once
+        return self._missing.pop(user_id, [])
+
+    async def get_user_data(self) -> Dict[int, dict]:
+        await self._load()
+        return {user_id: dict(state["data"]) for user_id, state in self._state.items()}
+
+    async def get_conversations(self, name: str) -> dict:
+        await self._load()
+        out = {}
+        for state in self._state.values():
+            for key, value in state["conv"].get(name, {}).items():
+                out[tuple(int(p) for p in key.split(":"))] = value
+        return out
+
+    async def update_conversation(self, name: str, key: tuple, new_state: Optional[object]) -> None:
+        user_id = key[-1]
+        state = self._state.setdefault(user_id, {"data": {}, "conv": {}})
+        states = state["conv"].setdefault(name, {})
+        if new_state is None:
+            states.pop(":".join(map(str, key)), None)
+        else:
+            states[":".join(map(str, key))] = new_state
+        if not states:
+            del state["conv"][name]
+        await self._save(user_id)
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._state.setdefault(user_id, {"data": {}, "conv": {}})["data"] = data
+        await self._save(user_id)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._state.pop(user_id, None)
+        await self._save(user_id)
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def flush(self) -> None:
+        self.records.close()
+
+
+class _AdoptState(BaseHandler):
+    # First handler of every state (and entry point) of a shared conversation.
+    # It matches only when another worker moved this user's conversation to a
+    # different step. The update then goes to the handlers of that step, and
+    # their result (or the adopted step itself) becomes the conversation's new
+    # state through PTB's usual return-value path.
+    def __init__(self, persistence: ConversationPersistence, name: str):
+        super().__init__(self._unused)
+        self.persistence = persistence
+        self.name = name
+        self.conversation: Optional[ConversationHandler] = None
+
+    async def _unused(self, update, context):
+        pass
+
+    def check_update(self, update: object):
+        if not isinstance(update, Update) or update.effective_chat is None or update.effective_user is None:
+            return None
+        key = (update.effective_chat.id, update.effective_user.id)
+        return key if key in self.persistence._adopted.get(self.name, {}) else None
+
+    async def handle_update(self, update, application, check_result, context):
+        state = self.persistence._adopted[self.name].pop(check_result, None)
+        conv = self.conversation
+        candidates = conv.entry_points if state is None else conv.states.get(state, [])
+        for handler in [*candidates, *conv.fallbacks]:
+            if isinstance(handler, _AdoptState):
+                continue
+            check = handler.check_update(update)
+            if check is not None and check is not False:
+                result = await handler.handle_update(update, application, check, context)
+                if result is not None:
+                    return result
+                break
+        return ConversationHandler.END if state is None else state
+
+
+def shared_conversation(persistence: Optional[ConversationPersistence], name: str, entry_points: list,
+                        states: dict, fallbacks: list, **kwargs) -> ConversationHandler:
+    # A ConversationHandler that follows steps saved by other bot workers sharing
+    # the persistence store. Without persistence it is a plain ConversationHandler.
+    if persistence is None:
+        return ConversationHandler(entry_points=entry_points, states=states, fallbacks=fallbacks,
+                                   name=name, **kwargs)
+    adopt = _AdoptState(persistence, name)
+    conversation = ConversationHandler(
+        entry_points=[adopt, *entry_points],
+        states={state: [adopt, *handlers] for state, handlers in states.items()},
+        fallbacks=fallbacks, name=name, persistent=True, **kwargs)
+    adopt.conversation = conversation
+    persistence.track(name)
+    return conversation
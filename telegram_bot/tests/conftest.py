@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The bot modules import each other as siblings (`from attachments import ...`)
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,43 @@
+import pytest
+
+from attachments import AttachmentLimitError, AttachmentStore
+
+
+def _download(store: AttachmentStore, owner, data: bytes = b"data"):
+    attachment = store.open(owner, "photo.jpg", "image/jpeg", len(data))
+    attachment.fileobj.write(data)
+    return attachment
+
+
+def test_downloads_in_flight_count_against_the_limit():
+    store = AttachmentStore(max_per_owner=3)
+    # An album: every open() happens before any download finishes
+    in_flight = [store.open(1, f"photo{i}.jpg", "image/jpeg", 4) for i in range(3)]
+    with pytest.raises(AttachmentLimitError):
+        store.open(1, "photo3.jpg", "image/jpeg", 4)
+    for attachment in in_flight:
+        store.add(attachment)
+    assert len(store.files(1)) == 3
+    with pytest.raises(AttachmentLimitError):
+        store.open(1, "photo3.jpg", "image/jpeg", 4)
+
+
+def test_discard_frees_the_slot(tmp_path):
+    store = AttachmentStore(max_per_owner=2)
+    store.add(_download(store, 1))
+    failed = store.open(1, "photo.jpg", "image/jpeg", 4)
+    store.discard(failed)
+    # The same slot can go to a file cache reference instead
+    cached = tmp_path / "cached.jpg"
+    cached.write_bytes(b"data")
+    store.add_reference(1, "photo.jpg", "image/jpeg", cached)
+    assert len(store.files(1)) == 2
+    with pytest.raises(AttachmentLimitError):
+        store.add_reference(1, "photo.jpg", "image/jpeg", cached)
+
+
+def test_limit_is_per_owner():
+    store = AttachmentStore(max_per_owner=1)
+    store.open(1, "a.txt", "text/plain", 1)
+    store.add(_download(store, 2))
+    assert len(store.files(2)) == 1
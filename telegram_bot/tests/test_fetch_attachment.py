@@ -0,0 +1,56 @@
+import asyncio
+from types import SimpleNamespace
+
+import bot
+from attachments import AttachmentStore
+from file_cache import FileCache
+
+
+class FakeTelegramFile:
+    def __init__(self, data: bytes):
+        self.data = data
+        self.file_unique_id = "photo-1"
+        self.file_size = len(data)
+        self.downloads = 0
+
+    async def get_file(self):
+        return self
+
+    async def download_to_memory(self, out):
+        self.downloads += 1
+        out.write(self.data)
+
+
+def _context(tmp_path, store):
+    cache = FileCache(tmp_path / "file_cache")
+    application = SimpleNamespace(bot_data={"attachments": store, "file_cache": cache})
+    return SimpleNamespace(application=application), cache
+
+
+def _fetch(context, tg_file):
+    update = SimpleNamespace(effective_user=SimpleNamespace(id=7))
+    return asyncio.run(bot._fetch_attachment(update, context, tg_file, "photo.jpg", "image/jpeg"))
+
+
+def test_cached_file_is_not_downloaded_again(tmp_path):
+    store = AttachmentStore()
+    context, _ = _context(tmp_path, store)
+    tg_file = FakeTelegramFile(b"jpeg bytes")
+    _fetch(context, tg_file)
+    attachment = _fetch(context, tg_file)
+    assert tg_file.downloads == 1
+    assert attachment.reference and attachment.fileobj.read() == b"jpeg bytes"
+
+
+def test_evicted_after_lookup_falls_back_to_download(tmp_path, monkeypatch):
+    store = AttachmentStore()
+    context, cache = _context(tmp_path, store)
+    tg_file = FakeTelegramFile(b"jpeg bytes")
+    path = _fetch(context, tg_file).path
+    # Evicted between the lookup and opening the blob
+    monkeypatch.setattr(cache, "lookup", lambda unique_id: path)
+    path.unlink()
+    attachment = _fetch(context, tg_file)
+    assert tg_file.downloads == 2
+    assert attachment.fileobj.read() == b"jpeg bytes"
+    assert len(store.files(7)) == 2
@@ -0,0 +1,211 @@
+import asyncio, time
+
+from telegram import Update
+from telegram.ext import Application, CallbackContext, CommandHandler, ConversationHandler, MessageHandler, filters
+
+from persistence import ConversationPersistence, FileStore, SQLiteStore, shared_conversation
+from attachments import AttachmentStore
+
+USER = 7
+KEY = (USER, USER)  # (chat id, user id) of a private chat
+
+
+def _handler(persistence: ConversationPersistence, seen: list = None) -> ConversationHandler:
+    # Step n answers with a message and moves on to step n + 1
+    def step(n):
+        async def callback(update, context):
+            if seen is not None:
+                seen.append(n)
+            return n + 1
+        return [MessageHandler(filters.TEXT & ~filters.COMMAND, callback)]
+
+    async def start(update, context):
+        return 0
+
+    return shared_conversation(persistence, name="email", entry_points=[CommandHandler("start", start)],
+                               states={n: step(n) for n in range(6)}, fallbacks=[])
+
+
+def _worker(path, timeout: float = 86400):
+    # One bot process: its own connection to the shared store, and a live handler
+    persistence = ConversationPersistence(SQLiteStore(path), timeout=timeout)
+    return persistence, _handler(persistence)
+
+
+async def _step(persistence: ConversationPersistence, state: int, data: dict):
+    await persistence.update_user_data(USER, data)
+    await persistence.update_conversation("email", KEY, state)
+
+
+def test_adopts_progress_written_by_another_worker(tmp_path):
+    path = tmp_path / "conversations.sqlite3"
+    first, _ = _worker(path)
+    second, handler = _worker(path)
+
+    async def main():
+        await _step(first, 3, {"role": "developer", "tone": "formal"})
+        user_data = {}
+        expired = await second.sync(USER, user_data)
+        return expired, user_data
+
+    expired, user_data = asyncio.run(main())
+    assert not expired
+    assert user_data == {"role": "developer", "tone": "formal"}
+    assert second._adopted["email"] == {KEY: 3}
+    assert second.stats["adopted"] == 1
+
+
+def test_unchanged_record_is_not_adopted_again(tmp_path):
+    path = tmp_path / "conversations.sqlite3"
+    first, _ = _worker(path)
+    second, _ = _worker(path)
+
+    async def main():
+        await _step(first, 1, {"role": "developer"})
+        await second.sync(USER, {})
+        await second.sync(USER, {})
+
+    asyncio.run(main())
+    assert second.stats["adopted"] == 1
+
+
+def test_conversation_ended_elsewhere_is_dropped(tmp_path):
+    path = tmp_path / "conversations.sqlite3"
+    first, _ = _worker(path)
+    second, handler = _worker(path)
+
+    async def main():
+        await _step(first, 2, {"role": "developer"})
+        user_data = {}
+        await second.sync(USER, user_data)
+        await first.update_conversation("email", KEY, None)
+        await first.drop_user_data(USER)
+        await second.sync(USER, user_data)
+        return user_data
+
+    assert asyncio.run(main()) == {}
+    assert second._adopted["email"] == {KEY: None}
+
+
+def test_idle_conversation_expires(tmp_path):
+    path = tmp_path / "conversations.sqlite3"
+    persistence, handler = _worker(path, timeout=60)
+
+    async def main():
+        await _step(persistence, 4, {"role": "developer"})
+        # Written long ago, e.g. by a worker that has since gone away
+        payload, _ = persistence.records.get(str(USER))
+        persistence.records.put(str(USER), payload, time.time() - 3600)
+        user_data = {"role": "developer"}
+        expired = await persistence.sync(USER, user_data)
+        return expired, user_data
+
+    expired, user_data = asyncio.run(main())
+    assert expired
+    assert user_data == {}
+    assert persistence.records.get(str(USER)) is None
+    assert persistence._adopted["email"] == {KEY: None}
+    assert persistence.stats["expired"] == 1
+
+
+def test_expired_records_are_skipped_at_startup(tmp_path):
+    store = SQLiteStore(tmp_path / "conversations.sqlite3")
+    store.put("1", '{"data":{},"conv":{"email":{"1:1":0}},"files":[]}', time.time() - 3600)
+    store.put("2", '{"data":{},"conv":{"email":{"2:2":5}},"files":[]}', time.time())
+    persistence = ConversationPersistence(store, timeout=60)
+    assert asyncio.run(persistence.get_conversations("email")) == {(2, 2): 5}
+    assert store.get("1") is None
+
+
+def test_file_store_round_trip(tmp_path):
+    store = FileStore(tmp_path / "conversations")
+    store.put("7", "{}", 1000.0)
+    assert store.get("7") == ("{}", 1000.0)
+    assert store.purge(2000.0) == 1
+    assert store.get("7") is None
+
+
+def test_sync_does_not_block_the_event_loop(tmp_path):
+    class SlowStore(SQLiteStore):
+        # Like a SQLite call waiting on another worker's write lock
+        def get(self, key):
+            time.sleep(0.3)
+            return super().get(key)
+
+    persistence = ConversationPersistence(SlowStore(tmp_path / "conversations.sqlite3"))
+
+    async def main():
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        task = asyncio.create_task(ticker())
+        await persistence.sync(USER, {})
+        task.cancel()
+        return ticks
+
+    assert asyncio.run(main()) >= 10
+
+
+def _text_update(application: Application, text: str, update_id: int = 1) -> Update:
+    return Update.de_json({"update_id": update_id, "message": {
+        "message_id": update_id, "date": 0, "text": text,
+        "chat": {"id": USER, "type": "private"}, "from": {"id": USER, "is_bot": False, "first_name": "U"},
+    }}, application.bot)
+
+
+def test_handler_continues_at_the_adopted_step(tmp_path):
+    path = tmp_path / "conversations.sqlite3"
+    first, _ = _worker(path)
+    second = ConversationPersistence(SQLiteStore(path))
+    seen = []
+    handler = _handler(second, seen)
+    application = Application.builder().token("123:abc").build()
+
+    async def handle(update):
+        check = handler.check_update(update)
+        if check is not None:
+            await handler.handle_update(update, application, check, CallbackContext.from_update(update, application))
+
+    async def main():
+        await _step(first, 3, {"role": "developer"})
+        await second.sync(USER, {})
+        # This worker never saw the conversation start, yet the message lands on step 3
+        await handle(_text_update(application, "formal"))
+        return handler.check_update(_text_update(application, "next", 2))
+
+    state, key, _, _ = asyncio.run(main())
+    assert seen == [3]
+    assert (state, key) == (4, KEY)
+    assert second._adopted["email"] == {}
+
+
+def test_missing_attachments_are_reported(tmp_path):
+    path = tmp_path / "conversations.sqlite3"
+    first, _ = _worker(path)
+    second, _ = _worker(path)
+    cached = tmp_path / "cached.pdf"
+    cached.write_bytes(b"pdf")
+    first.attachments = AttachmentStore()
+    first.attachments.add_reference(USER, "kept.pdf", "application/pdf", cached)
+    photo = first.attachments.open(USER, "photo.jpg", "image/jpeg", 3)  # never cached
+    photo.fileobj.write(b"jpg")
+    first.attachments.add(photo)
+    evicted = tmp_path / "evicted.pdf"
+    evicted.write_bytes(b"pdf")
+    first.attachments.add_reference(USER, "evicted.pdf", "application/pdf", evicted)
+    second.attachments = AttachmentStore()
+
+    async def main():
+        await _step(first, 3, {"role": "developer"})
+        evicted.unlink()
+        await second.sync(USER, {})
+
+    asyncio.run(main())
+    assert [a.filename for a in second.attachments.files(USER)] == ["kept.pdf"]
+    assert second.missing_files(USER) == ["photo.jpg", "evicted.pdf"]
+    assert second.missing_files(USER) == []
@@ -0,0 +1,43 @@
+import pytest
+from starlette.testclient import TestClient
+from telegram.ext import Application
+
+import bot
+
+
+@pytest.fixture
+def client():
+    application = Application.builder().token("123:abc").build()
+    # No lifespan: the Application is not started, updates just land on its queue
+    return TestClient(bot.build_webhook_app(application)), application
+
+
+def _post(client, body, secret=bot.WEBHOOK_SECRET):
+    return client.post(bot.WEBHOOK_PATH, content=body, headers={"X-Telegram-Bot-Api-Secret-Token": secret,
+                                                                 "Content-Type": "application/json"})
+
+
+@pytest.mark.parametrize("body", [
+    "not json",
+    "[1, 2]",
+    "{}",
+    '{"update_id": 1, "message": "oops"}',
+    '{"update_id": 1, "message": {"chat": 5}}',
+])
+def test_malformed_updates_are_rejected(client, body):
+    http, application = client
+    assert _post(http, body).status_code == 400
+    assert application.update_queue.empty()
+
+
+def test_valid_update_is_queued(client):
+    http, application = client
+    body = ('{"update_id": 1, "message": {"message_id": 1, "date": 0, "text": "/start",'
+            ' "chat": {"id": 7, "type": "private"}, "from": {"id": 7, "is_bot": false, "first_name": "U"}}}')
+    assert _post(http, body).status_code == 200
+    assert application.update_queue.get_nowait().message.text == "/start"
+
+
+def test_wrong_secret_is_forbidden(client):
+    http, _ = client
+    assert _post(http, "{}", secret="nope").status_code == 403
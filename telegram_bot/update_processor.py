@@ -0,0 +1,54 @@
+import asyncio
+from typing import Any, Awaitable, Dict, Hashable, List
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+# What PTB's semaphore is given, so only ours ever limits anything
+_UNBOUNDED = 2 ** 31
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    # Updates from different chats are handled concurrently, but updates from the
+    # same chat run one at a time in arrival order, so ConversationHandler state
+    # transitions for a chat never race each other. The concurrency limit is ours,
+    # taken after the chat's lock: PTB's own slot is taken before do_process_update
+    # is called, so with it a chat's backlog would sit on slots other chats need.
+    def __init__(self, max_concurrent_updates: int):
+        if max_concurrent_updates < 1:
+            raise ValueError("max_concurrent_updates must be a positive integer")
+        super().__init__(_UNBOUNDED)
+        self._limit = max_concurrent_updates
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._chats: Dict[Hashable, List] = {}  # chat id -> [lock, pending updates]
+
+    @property
+    def max_concurrent_updates(self) -> int:
+        # The base class sizes its semaphore from this before _limit exists
+        return getattr(self, "_limit", _UNBOUNDED)
+
+    @property
+    def current_concurrent_updates(self) -> int:
+        return self._limit - self._slots._value
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            async with self._slots:
+                await coroutine
+            return
+        entry = self._chats.setdefault(chat.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0], self._slots:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                self._chats.pop(chat.id, None)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass